@@ -0,0 +1,103 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure the memory used by the command tasks, with tracemalloc
+(python 3 only).
+
+Two kinds of tasks are measured:
+
+ - idle tasks: created, but their output is not read yet;
+ - finished tasks: local commands that ran, printed some lines and
+   were waited for, and are only kept by the caller (e.g. to look at
+   their exit codes).
+
+Usage::
+
+    python benchmarks/footprint.py [--idle N] [--finished N] [--lines N]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from rcontrol.core import CommandTask  # noqa: E402
+from rcontrol.local import LocalSession, ProcessReader  # noqa: E402
+
+
+def measure(create, count):
+    """
+    Return the number of bytes allocated per object by **create**,
+    keeping all the objects alive.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = create(count)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / float(count)
+
+
+def idle_tasks(count):
+    session = LocalSession()
+    tasks = [CommandTask(session, ProcessReader, 'true')
+             for _ in range(count)]
+    # forget the tasks from the session, only the caller keeps them
+    del session._tasks[:]
+    return tasks
+
+
+def finished_tasks(count, lines=100):
+    session = LocalSession()
+    tasks = []
+    # run the commands by batches to not exhaust the processes limit
+    for i in range(0, count, 50):
+        batch = [session.execute(['seq', str(lines)])
+                 for _ in range(min(50, count - i))]
+        for task in batch:
+            task.wait()
+        tasks.extend(batch)
+    return tasks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--idle', type=int, default=10000,
+                        help='number of idle tasks (default: %(default)s)')
+    parser.add_argument('--finished', type=int, default=1000,
+                        help='number of finished tasks'
+                        ' (default: %(default)s)')
+    parser.add_argument('--lines', type=int, default=100,
+                        help='number of lines printed by the finished'
+                        ' tasks (default: %(default)s)')
+    args = parser.parse_args(argv)
+    # warm up (imports, caches)
+    measure(idle_tasks, 10)
+    measure(finished_tasks, 10)
+    print('idle task:     %8.0f bytes' % measure(idle_tasks, args.idle))
+    print('finished task: %8.0f bytes' % measure(
+        lambda count: finished_tasks(count, args.lines), args.finished))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+
+
+def _controller_load():
+    """
+    Return the load average of the last minute divided by the number of
+    cpus, or None if it is not available.
+    """
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError, NotImplementedError):
+        return None
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of tasks in flight, adapting the limit to how the
+    tasks behave with an AIMD scheme (like the TCP congestion control):
+
+     - each task that succeeds in time increases the limit by
+       **increase** / limit, so the limit grows by about **increase** each
+       time a full window of tasks succeeds;
+     - a task that fails, times out, is slower than **latency_target**,
+       or finishes while the controller load is above **max_load**,
+       multiplies the limit by **decrease**. This happens at most once
+       per window of tasks: the tasks started before the previous
+       decrease do not decrease the limit again.
+
+    The limit always stays between **min_limit** and **max_limit**. The
+    **history** attribute is a deque of (timestamp, limit) recorded each
+    time the (integer) limit changes, keeping the last **history_size**
+    changes.
+
+    It is used by :meth:`rcontrol.core.SessionManager.execute` and
+    :meth:`rcontrol.core.SessionManager.copy_file`, and can be used
+    directly with :meth:`acquire` and :meth:`release`, or with
+    :meth:`track` for tasks.
+
+    :param initial: the initial limit.
+    :param min_limit: the minimum limit.
+    :param max_limit: the maximum limit.
+    :param increase: the additive increase.
+    :param decrease: the multiplicative decrease factor.
+    :param latency_target: if not None, a task duration in seconds above
+        which the limit is decreased.
+    :param max_load: if not None, the load average per cpu of the
+        controller above which the limit is decreased.
+    :param history_size: the maximum length of **history**.
+    """
+    def __init__(self, initial=8, min_limit=1, max_limit=256, increase=1.0,
+                 decrease=0.5, latency_target=None, max_load=None,
+                 history_size=1000):
+        if not 0 < decrease < 1:
+            raise ValueError('decrease must be between 0 and 1')
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError('invalid limits: %r, %r' % (min_limit,
+                                                         max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.max_load = max_load
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+        self._load = None
+        self._load_time = 0.0
+        self.history = deque([(time.time(), self.limit)],
+                             maxlen=history_size)
+        self._stats = dict(completed=0, errors=0, timeouts=0, slow=0,
+                           overloaded=0, latency=0.0)
+
+    @property
+    def limit(self):
+        """
+        The current limit, as an integer.
+        """
+        return int(self._limit)
+
+    def in_flight(self):
+        """
+        Return the number of tasks in flight.
+        """
+        return self._in_flight
+
+    def acquire(self):
+        """
+        Wait until a new task can be started, and return the start time
+        to give to :meth:`release`.
+        """
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return time.time()
+
+    def _overloaded(self, now):
+        if self.max_load is None:
+            return False
+        # the load average is not checked more than once per second
+        if now - self._load_time >= 1:
+            self._load = _controller_load()
+            self._load_time = now
+        return self._load is not None and self._load > self.max_load
+
+    def release(self, start, error=False, timed_out=False):
+        """
+        Notify that a task is done, and adapt the limit.
+
+        :param start: the start time returned by :meth:`acquire`.
+        :param error: True if the task failed.
+        :param timed_out: True if the task timed out.
+        """
+        now = time.time()
+        latency = now - start
+        slow = (self.latency_target is not None and
+                latency > self.latency_target)
+        with self._cond:
+            self._in_flight -= 1
+            stats = self._stats
+            stats['completed'] += 1
+            stats['latency'] += latency
+            overloaded = self._overloaded(now)
+            if error:
+                stats['errors'] += 1
+            if timed_out:
+                stats['timeouts'] += 1
+            if slow:
+                stats['slow'] += 1
+            if overloaded:
+                stats['overloaded'] += 1
+            previous = self.limit
+            if error or timed_out or slow or overloaded:
+                if start >= self._last_decrease:
+                    self._limit = max(self._limit * self.decrease,
+                                      self.min_limit)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self._limit + self.increase / self._limit,
+                                  self.max_limit)
+            if self.limit != previous:
+                self.history.append((now, self.limit))
+            self._cond.notify_all()
+
+    def track(self, start_task):
+        """
+        Wait for a slot, start a task by calling **start_task** and
+        release the slot once the task is done. Return the task.
+        """
+        start = self.acquire()
+        try:
+            task = start_task()
+        except Exception:
+            self.release(start, error=True)
+            raise
+
+        def done(task):
+            timed_out = getattr(task, 'timed_out', None)
+            timed_out = bool(timed_out and timed_out())
+            self.release(start, error=bool(task.error()) and not timed_out,
+                         timed_out=timed_out)
+        task.add_done_callback(done)
+        return task
+
+    def stats(self):
+        """
+        Return a dict of counters: 'completed', 'errors', 'timeouts',
+        'slow', 'overloaded' (number of tasks done in each case),
+        'mean_latency' (in seconds), 'limit' and 'in_flight'.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            latency = stats.pop('latency')
+            stats['mean_latency'] = (latency / stats['completed']
+                                     if stats['completed'] else None)
+            stats['limit'] = self.limit
+            stats['in_flight'] = self._in_flight
+            return stats
@@ -0,0 +1,183 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import re
+import threading
+from collections import namedtuple, OrderedDict
+
+OutputGroup = namedtuple('OutputGroup', 'names output exit_code')
+
+_NUMBERS = re.compile(r'\d+')
+
+
+class _Capture(object):
+    """
+    Hash the lines of one host output while they are read.
+
+    While the lines are the same as the **reference** - the output of an
+    existing group - they are only counted; they are copied once the
+    output diverges from it.
+    """
+    def __init__(self, mask_numbers, reference=None):
+        self.mask_numbers = mask_numbers
+        self.hash = hashlib.sha1()
+        self.reference = reference
+        self.count = 0
+        self.lines = [] if reference is None else None
+
+    def add(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if self.lines is not None:
+            self.lines.append(line)
+        elif (self.count < len(self.reference) and
+              self.reference[self.count] == line):
+            self.count += 1
+        else:
+            self.lines = list(self.reference[:self.count])
+            self.lines.append(line)
+            self.reference = None
+        if self.mask_numbers:
+            line = _NUMBERS.sub(u'#', line)
+        self.hash.update(line.encode('utf-8') + b'\n')
+
+    def output(self):
+        """
+        Return the lines read, as a tuple.
+        """
+        if self.lines is not None:
+            return tuple(self.lines)
+        if self.count == len(self.reference):
+            return self.reference
+        return self.reference[:self.count]
+
+
+class OutputAggregator(object):
+    """
+    Group the hosts that gave the same output, like **dshbak -c**.
+
+    Each distinct output is stored only once, so the memory used depends
+    on the number of distinct outputs rather than the number of hosts.
+    The outputs are compared with a hash of their lines and the exit
+    code of the command. While a command runs, its lines are compared
+    with the output of the biggest group, and only copied once they
+    differ.
+
+    :param mask_numbers: if True, the numbers are ignored when comparing
+        the outputs, so that outputs that only differ by numbers (dates,
+        pids, sizes...) are in the same group. The output kept for a group
+        is then the output of its first host.
+    """
+    def __init__(self, mask_numbers=False):
+        self.mask_numbers = mask_numbers
+        self._lock = threading.Lock()
+        # key -> [names, output, exit_code]
+        self._groups = OrderedDict()
+        # the biggest group, whose output new captures are compared with
+        self._biggest = None
+
+    def add(self, name, lines, exit_code=None):
+        """
+        Add the output of a host.
+
+        :param name: the name of the host
+        :param lines: the lines of the output
+        :param exit_code: the exit code of the command, if any
+        """
+        capture = self._capture()
+        for line in lines:
+            capture.add(line)
+        self._add(name, capture, exit_code)
+
+    def _capture(self):
+        with self._lock:
+            biggest = self._biggest
+        return _Capture(self.mask_numbers,
+                        biggest[1] if biggest is not None else None)
+
+    def _add(self, name, capture, exit_code):
+        key = (capture.hash.digest(), exit_code)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = [[name], capture.output(),
+                                             exit_code]
+            else:
+                group[0].append(name)
+            if self._biggest is None or \
+                    len(group[0]) > len(self._biggest[0]):
+                self._biggest = group
+
+    def execute(self, session, name, command, **kwargs):
+        """
+        Execute a command on a session, adding its output once finished.
+        The standard error is combined with the output unless
+        **combine_stderr** is False.
+
+        Return the command task.
+
+        :param session: the session that runs the command
+        :param name: the name of the host, used in the groups
+        :param command: the command to execute
+        :param kwargs: named arguments passed to :meth:`execute`. Note
+            that **expected_exit_code** defaults to None, as the exit code
+            is part of the result.
+        """
+        capture = self._capture()
+        on_stdout = kwargs.pop('on_stdout', None)
+        on_done = kwargs.pop('on_done', None)
+
+        def _on_stdout(task, line):
+            capture.add(line)
+            if on_stdout:
+                on_stdout(task, line)
+
+        def _on_done(task):
+            self._add(name, capture,
+                      None if task.timed_out() else task.exit_code())
+            if on_done:
+                on_done(task)
+
+        kwargs.setdefault('combine_stderr', True)
+        kwargs.setdefault('expected_exit_code', None)
+        return session.execute(command, on_stdout=_on_stdout,
+                               on_done=_on_done, **kwargs)
+
+    def groups(self):
+        """
+        Return the list of :class:`OutputGroup` (names, output, exit_code),
+        the biggest groups first. **output** is a tuple of lines.
+        """
+        with self._lock:
+            groups = [OutputGroup(list(names), output, exit_code)
+                      for names, output, exit_code in self._groups.values()]
+        groups.sort(key=lambda g: len(g.names), reverse=True)
+        return groups
+
+    def report(self):
+        """
+        Return a text report of the groups, the biggest groups first.
+        """
+        parts = []
+        for group in self.groups():
+            title = '%s (%d)' % (','.join(group.names), len(group.names))
+            if group.exit_code:
+                title += ' exit code: %s' % group.exit_code
+            elif group.exit_code is None:
+                title += ' no exit code'
+            sep = '-' * min(len(title), 79)
+            parts.append('\n'.join([sep, title, sep] + list(group.output)))
+        return '\n'.join(parts) + '\n' if parts else ''
@@ -15,11 +15,21 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import os
+import posixpath
 import sys
 import threading
+import time
 import six
 from collections import OrderedDict
+from six.moves.queue import Queue, Full
 from rcontrol import fs
+from rcontrol.matcher import OutputMatcher
+from rcontrol.aggregate import OutputAggregator
+from rcontrol.sinks import OutputSink
+from rcontrol.governor import get_governor
+from rcontrol.adaptive import AdaptiveLimiter
 import abc
 import warnings
 
@@ -45,6 +55,10 @@ class ExitCodeError(TaskError):
     """Raised when the exit code of a command is unexpected"""
 
 
+class ChecksumError(TaskError):
+    """Raised when the checksum of a copied file does not match"""
+
+
 class TaskErrors(BaseTaskError):
     """A list of task errors"""
     def __init__(self, errors):
@@ -52,6 +66,10 @@ class TaskErrors(BaseTaskError):
         BaseTaskError.__init__(self, '\n'.join(str(e) for e in self.errors))
 
 
+# protects the done callbacks of the tasks
+_done_lock = threading.Lock()
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Task(object):
     """
@@ -63,21 +81,95 @@ class Task(object):
         instance task as the parameter. It is called when the task is
         done (finished or timed out). If defined, :meth:`error_handled`
         will return True.
+    :param priority: the priority of the task when it waits for
+        resources (see :class:`rcontrol.governor.ResourceGovernor`) or for
+        a callback executor: the highest priorities are served first
+        within a group.
+    :param group: the fairness group of the task (a session, a
+        tenant...). The waiting tasks are served fairly across groups.
+        Defaults to the name of the session (see
+        :meth:`BaseSession.host_name`).
     """
-    def __init__(self, session, on_done=None):
+    # tasks may be created by the hundreds of thousands: no __dict__.
+    # The private names are given mangled, as six.add_metaclass needs
+    # the names of the class attributes.
+    __slots__ = ('session', 'priority', 'group', 'explicit_wait',
+                 '_reservation', '_Task__on_done', '_Task__done',
+                 '_Task__done_callbacks', '__weakref__')
+
+    def __init__(self, session, on_done=None, priority=0, group=None):
         self.session = session
+        self.priority = priority
+        self.group = session.host_name() if group is None else group
         self.__on_done = on_done
+        self.__done = False
+        # the list is only created when needed
+        self.__done_callbacks = None
         self.explicit_wait = False
+        # (governor, host, counts) of the resources reserved by the task
+        self._reservation = None
         # register the task instance to the session
         session._register_task(self)
 
+    def add_done_callback(self, callback):
+        """
+        Add a callable, called with the task instance when the task is
+        done (finished or timed out). It is called immediately if the
+        task is already done.
+
+        Unlike **on_done**, this does not change :meth:`error_handled`.
+        """
+        with _done_lock:
+            if not self.__done:
+                if self.__done_callbacks is None:
+                    self.__done_callbacks = []
+                self.__done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _reserve(self, **counts):
+        # reserve resources in the installed governor, if any, waiting
+        # for them if needed. Subclasses must call this before using the
+        # resources.
+        governor = get_governor()
+        if governor is None:
+            return
+        host = str(self.session)
+        governor.acquire(host, priority=self.priority, group=self.group,
+                         **counts)
+        self._reservation = (governor, host, counts)
+
+    def _release(self):
+        reservation, self._reservation = self._reservation, None
+        if reservation is not None:
+            governor, host, counts = reservation
+            governor.release(host, **counts)
+
+    def _run_nested(self, callback, *args, **kwargs):
+        # call a callback that may start new tasks while the resources of
+        # this task are still reserved
+        reservation = self._reservation
+        if reservation is None:
+            return callback(*args, **kwargs)
+        with reservation[0].nested():
+            return callback(*args, **kwargs)
+
     def _unregister(self):
         # this must be called by subclasses when the task needs to be
         # unregistered from the session. This is called from a thread,
         # when the task is finished (or for a timeout)
+        self._release()
         self.session._unregister_task(self)
         if self.__on_done:
-            self.__on_done(self)
+            on_done, self.__on_done = self.__on_done, _handled
+            # do not keep the callback (and what it references) once
+            # called; _handled keeps error_handled() unchanged
+            on_done(self)
+        with _done_lock:
+            self.__done = True
+            callbacks, self.__done_callbacks = self.__done_callbacks, None
+        for callback in callbacks or ():
+            callback(self)
 
     def error_handled(self):
         """
@@ -124,11 +216,36 @@ class Task(object):
         return self._wait(raise_if_error=raise_if_error)
 
 
+def _iter_chunks(data, chunk_size=16384):
+    """
+    Iterate over bytes chunks of some data (bytes, text, a file object
+    or an iterable of chunks).
+    """
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    if isinstance(data, bytes):
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+    elif hasattr(data, 'read'):
+        chunk = data.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = data.read(chunk_size)
+    else:
+        for chunk in data:
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+
 def _async(meth, name):
     def new_meth(self, *args, **kwargs):
         on_done = kwargs.pop('on_done', None)
+        priority = kwargs.pop('priority', 0)
+        group = kwargs.pop('group', None)
         return ThreadableTask(self, meth, (self,) + args, kwargs,
-                              on_done=on_done)
+                              on_done=on_done, priority=priority,
+                              group=group)
     new_meth.__name__ = name
     new_meth.__doc__ = """
     Asynchronous version of :meth:`%s`.
@@ -136,8 +253,9 @@ def _async(meth, name):
     This method returns an instance of a :class:`ThreadableTask`.
 
     Note that you can use the **on_done** keyword argument to define a
-    callback that will be called at the end of the execution (see
-    the :class:`Task` constructor).
+    callback that will be called at the end of the execution, and the
+    **priority** and **group** keyword arguments (see the :class:`Task`
+    constructor).
 """ % meth.__name__
     return new_meth
 
@@ -158,6 +276,14 @@ class BaseSession(object):
     """
     Represent an abstraction of a session on a remote or local machine.
     """
+    # the default output sink of the commands (see
+    # SessionManager.set_output_sink)
+    output_sink = None
+    # the fs.TokenBucket limiting the bandwidth of the copies from or to
+    # this session (see set_bandwidth_limit)
+    bandwidth = None
+    # the name of the session in a SessionManager (see host_name)
+    name = None
 
     def __init__(self, auto_close=True):
         # a lock for tasks and silent errors access
@@ -168,8 +294,17 @@ class BaseSession(object):
         # it is finished, we save in this list the errors of tasks
         # that are finished before wait_for_tasks is called.
         self._silent_errors = []
+        self._shells = []
         self.auto_close = auto_close
 
+    def host_name(self):
+        """
+        Return the name of the host, as used for the files of the output
+        sinks: the name of the session in a :class:`SessionManager` if it
+        was added to one, else a name given by the session type.
+        """
+        return self.name or str(self)
+
     def _register_task(self, task):
         assert isinstance(task, Task)
         with self._lock:
@@ -265,6 +400,39 @@ class BaseSession(object):
             class:`CommandTask` subclass.
         """
 
+    def execute_batch(self, commands, concurrent=False, **kwargs):
+        """
+        Execute many commands in one command execution, and return a list
+        of :class:`CommandTask` instances (one per command). See
+        :func:`rcontrol.shell.execute_batch`.
+
+        :param commands: a list of commands. Each item is either a string,
+            or a tuple (command, kwargs) to give specific arguments to
+            the command task.
+        :param concurrent: if True, run the commands concurrently.
+        :param kwargs: named arguments passed to all the command tasks.
+        """
+        # the shell module imports this one
+        from rcontrol.shell import execute_batch
+        return execute_batch(self, commands, concurrent=concurrent, **kwargs)
+
+    def open_shell(self):
+        """
+        Start and return a :class:`rcontrol.shell.PersistentShell`, to run
+        many commands without starting a new process or channel for each
+        of them.
+
+        The shell is closed with the session.
+        """
+        shell = self._create_shell()
+        with self._lock:
+            self._shells.append(shell)
+        return shell
+
+    def _create_shell(self):
+        # Sessions supporting persistent shells must implement this.
+        raise NotImplementedError
+
     @abc.abstractmethod
     def walk(self, top, topdown=True, onerror=None, followlinks=False):
         """
@@ -277,6 +445,56 @@ class BaseSession(object):
         Create a directory. Equivalent to os.mkdir.
         """
 
+    def makedirs(self, path, exist_ok=True):
+        """
+        Create a directory and its missing parents. Equivalent to
+        os.makedirs.
+
+        :param exist_ok: if False, an OSError is raised if the directory
+            already exists.
+        """
+        if self.exists(path):
+            if exist_ok and self.isdir(path):
+                return
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        parent = posixpath.dirname(path.rstrip('/'))
+        if parent and parent != path:
+            self.makedirs(parent, exist_ok=True)
+        self.mkdir(path)
+
+    def apply_fs_ops(self, ops):
+        """
+        Apply a list of file system changes, in order, stopping at the
+        first error. Sessions do this with as few round trips as possible;
+        consecutive operations of the same kind may be applied together,
+        so the ones next to a failing operation may be applied anyway.
+
+        Each operation is a tuple:
+
+         - ('mkdir', path) or ('mkdir', path, mode)
+         - ('chmod', path, mode)
+         - ('rename', src, dest)
+         - ('unlink', path)
+         - ('symlink', target, path) (create the link **path** that
+           points to **target**)
+
+        By default this executes one shell script (see
+        :func:`rcontrol.fs.fs_ops_script`), sent on the command input.
+        An IOError is raised on the first error.
+        """
+        script = fs.fs_ops_script(ops)
+        if not script:
+            return
+        errors = []
+        task = self.execute('/bin/sh -e', stdin=script.encode('utf-8'),
+                            combine_stderr=False, expected_exit_code=None,
+                            output_sink=False,
+                            on_stderr=lambda t, line: errors.append(
+                                fs._text(line)))
+        if task.wait() != 0:
+            raise IOError('file system operations failed on %s: %s'
+                          % (self, '\n'.join(errors)))
+
     @abc.abstractmethod
     def exists(self, path):
         """
@@ -295,21 +513,131 @@ class BaseSession(object):
         Return True if the path is a link. Equivalent to os.path.islink.
         """
 
-    def s_copy_file(self, src, dest_os, dest, chunk_size=16384):
+    def stat(self, path, follow_symlinks=True):
+        """
+        Return the attributes of a path (with at least st_mode, st_size,
+        st_mtime, st_atime, st_uid and st_gid). Equivalent to os.stat, or
+        os.lstat if **follow_symlinks** is False.
+
+        By default this executes the GNU **stat** command and returns an
+        os.stat_result.
+        """
+        attrs = fs._command_stat(self, [path], follow_symlinks)
+        if attrs is None:
+            raise OSError(errno.ENOSYS, 'the stat command is not usable on %s'
+                          % self, path)
+        if path not in attrs:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        mode, size, mtime, atime, uid, gid = attrs[path]
+        return os.stat_result((mode, 0, 0, 0, uid, gid, size, atime, mtime,
+                               mtime))
+
+    def stat_many(self, paths, follow_symlinks=True):
         """
-        Copy a file from this session to another session.
+        Return a dict that associate each path to its attributes (see
+        :meth:`stat`), or None if the path does not exist.
+
+        Sessions may implement this with less round trips than calling
+        :meth:`stat` for each path.
+        """
+        result = {}
+        for path in paths:
+            try:
+                result[path] = self.stat(path, follow_symlinks)
+            except (IOError, OSError):
+                result[path] = None
+        return result
+
+    def _server_find(self, top, include, exclude, min_mtime, max_mtime,
+                     max_depth):
+        # Sessions able to search files on the remote side should
+        # override this and return an iterator of fs.FindEntry, or None
+        # to walk the tree from here (see fs.find).
+        return None
+
+    def set_bandwidth_limit(self, rate, burst=None):
+        """
+        Limit the bandwidth of the copies from or to this session, in
+        bytes per second (None for no limit). This can be changed while
+        files are copied. See :class:`rcontrol.fs.TokenBucket`.
+        """
+        if self.bandwidth is None:
+            self.bandwidth = fs.TokenBucket(rate, burst)
+        else:
+            self.bandwidth.set_rate(rate, burst)
+
+    def s_copy_file(self, src, dest_os, dest, chunk_size=16384,
+                    verify=None, expected_digest=None, direct=False,
+                    rate_limit=None):
+        """
+        Copy a file from this session to another session, and return
+        its :class:`rcontrol.fs.TransferStats` (None for a direct
+        transfer).
 
         :param src: full path of the file to copy in this session
         :param dest_os: session to copy to
         :param dest: full path of the file to copy in the dest session
+        :param verify: if not None, the name of a hash algorithm (e.g.
+            'sha256') used to check the copied file. See
+            :func:`rcontrol.fs.copy_file`.
+        :param expected_digest: an optional hex digest the copied data
+            must match.
+        :param direct: if True, try to transfer the file directly between
+            the two hosts, without relaying the data through this
+            process. This is only supported between ssh sessions (see
+            :meth:`rcontrol.ssh.SshSession.direct_copy_file`); the data
+            is relayed as usual if the direct transfer is not possible.
+        :param rate_limit: if not None, the maximum bandwidth of the copy
+            in bytes per second, or a :class:`rcontrol.fs.TokenBucket`.
+            The limits of both sessions and the global limit also apply
+            (see :func:`rcontrol.fs.copy_file`). None of these limits
+            apply to a direct transfer.
         """
-        fs.copy_file(self, src, dest_os, dest, chunk_size=chunk_size)
+        if direct and self._direct_copy_file(src, dest_os, dest, direct):
+            if verify or expected_digest:
+                fs.check_copy_digest(self, src, dest_os, dest,
+                                     verify or 'sha256', expected_digest)
+            return None
+        return fs.copy_file(self, src, dest_os, dest, chunk_size=chunk_size,
+                            verify=verify, expected_digest=expected_digest,
+                            rate_limit=rate_limit)
+
+    def _direct_copy_file(self, src, dest_session, dest, method):
+        # Sessions that are able to send a file directly to another
+        # session should override this and return True on success.
+        return False
 
     copy_file = _async(s_copy_file, "copy_file")
 
-    def s_copy_dir(self, src, dest_session, dest, chunk_size=16384):
+    def s_broadcast_file(self, src, destinations, max_parallel=None,
+                         chunk_size=16384, slow_timeout=10, rate_limit=None):
+        """
+        Copy a file from this session to many destinations, reading the
+        source only once. See :func:`rcontrol.fs.broadcast_file`.
+
+        :param src: full path of the file to copy in this session
+        :param destinations: a list of (session, path) tuples
+        :param max_parallel: maximum number of destinations written at
+            the same time, or None for no limit.
+        :param slow_timeout: time in seconds after which a destination
+            that can not keep up is copied separately.
+        :param rate_limit: if not None, the maximum bandwidth used to
+            send the data to all the destinations, in bytes per second.
+        """
+        return fs.broadcast_file(self, src, destinations,
+                                 max_parallel=max_parallel,
+                                 chunk_size=chunk_size,
+                                 slow_timeout=slow_timeout,
+                                 rate_limit=rate_limit)
+
+    broadcast_file = _async(s_broadcast_file, "broadcast_file")
+
+    def s_copy_dir(self, src, dest_session, dest, chunk_size=16384,
+                   verify=None, rate_limit=None):
         """
-        Recursively copy a directory from a session to another one.
+        Recursively copy a directory from a session to another one, and
+        return the list of the :class:`rcontrol.fs.TransferStats` of the
+        files.
 
         **dest** must not exist, it will be created automatically.
 
@@ -317,8 +645,14 @@ class BaseSession(object):
         :param dest_session: session to copy to
         :param dest: path of the dir to copy in the dest session (must
             not exists)
+        :param verify: if not None, a hash algorithm name used to check
+            every copied file (see :meth:`s_copy_file`).
+        :param rate_limit: if not None, the maximum bandwidth of the whole
+            copy (see :meth:`s_copy_file`).
         """
-        fs.copy_dir(self, src, dest_session, dest, chunk_size=chunk_size)
+        return fs.copy_dir(self, src, dest_session, dest,
+                           chunk_size=chunk_size, verify=verify,
+                           rate_limit=rate_limit)
 
     copy_dir = _async(s_copy_dir, "copy_dir")
 
@@ -326,6 +660,10 @@ class BaseSession(object):
         """
         Close the session.
         """
+        with self._lock:
+            shells, self._shells = self._shells, []
+        for shell in shells:
+            shell.close()
 
     def __enter__(self):
         return self
@@ -345,6 +683,13 @@ class BaseSession(object):
                     print('ERROR: %s' % error)
 
 
+def _handled(task):
+    """
+    An on_done callback that does nothing, for the tasks whose errors are
+    reported by other means.
+    """
+
+
 class SessionManager(OrderedDict):
     """
     A specialized OrderedDict that keep sessions instances.
@@ -357,6 +702,11 @@ class SessionManager(OrderedDict):
 
     It should be used inside a **with** block, to wait for pending
     tasks and close sessions if needed automatically.
+
+    The names of the attributes of the class (e.g. 'execute' or 'keys')
+    can not be used to set sessions as attributes, as these would not be
+    reachable in the namespace: a ValueError is raised. Such sessions
+    can still be set and reached as items.
     """
 
     def __setitem__(self, name, value):
@@ -365,9 +715,15 @@ class SessionManager(OrderedDict):
         if not isinstance(value, BaseSession):
             raise TypeError('only BaseSession instances can be set')
         OrderedDict.__setitem__(self, name, value)
+        if value.name is None:
+            value.name = name
 
     def __setattr__(self, name, value):
         if isinstance(value, BaseSession):
+            if hasattr(type(self), name):
+                raise ValueError('%r can not be used as a session name: it'
+                                 ' is an attribute of %s'
+                                 % (name, type(self).__name__))
             self[name] = value
         else:
             self.__dict__[name] = value
@@ -413,6 +769,152 @@ class SessionManager(OrderedDict):
             raise TaskErrors(errors)
         return errors
 
+    def distribute_file(self, src_session, src, dest, names=None,
+                        fanout=2, seeds=None, direct=None, **kwargs):
+        """
+        Copy a file to the sessions of this manager, using the sessions
+        that already received the file to forward it to the others (see
+        :func:`rcontrol.fs.distribute_file`).
+
+        Return a dict that associate each session name to the name of the
+        session it received the file from (None for **src_session** if it
+        is not part of the manager).
+
+        :param src_session: the session that holds the file
+        :param src: the path of the file in **src_session**
+        :param dest: the path of the file in the destination sessions
+        :param names: names of the destination sessions. Defaults to all
+            the sessions of the manager but **src_session**.
+        :param fanout: number of hosts each host sends the file to at
+            the same time.
+        :param seeds: number of hosts **src_session** sends the file to at
+            the same time (defaults to **fanout**).
+        :param direct: if True, try to copy directly between hosts. By
+            default, only if no **rate_limit** is given.
+        :param kwargs: other arguments of
+            :func:`rcontrol.fs.distribute_file`, like **rate_limit**.
+        """
+        if names is None:
+            names = [n for n, s in self.items() if s is not src_session]
+        destinations = [(self[name], dest) for name in names]
+        parents = fs.distribute_file(src_session, src, destinations,
+                                     fanout=fanout, seeds=seeds,
+                                     direct=direct, **kwargs)
+        session_names = dict((id(s), n) for n, s in self.items())
+        return OrderedDict(
+            (name, session_names.get(id(parent)))
+            for name, (parent, _) in zip(names, parents))
+
+    def aggregate(self, command, names=None, mask_numbers=False,
+                  limiter=None, **kwargs):
+        """
+        Execute a command on the sessions, wait for it, and return an
+        :class:`rcontrol.aggregate.OutputAggregator` that groups the
+        sessions which gave the same output: ::
+
+          print(sess_manager.aggregate('uname -r').report())
+
+        The number of commands running at the same time is adapted like
+        in :meth:`execute`, so that the outputs of the first sessions are
+        known when the next ones start.
+
+        :param command: the command to execute
+        :param names: names of the sessions. Defaults to all the sessions.
+        :param mask_numbers: if True, ignore the numbers when comparing
+            the outputs.
+        :param limiter: an :class:`rcontrol.adaptive.AdaptiveLimiter`.
+            A new one with the default settings is used if None.
+        :param kwargs: named arguments passed to the :meth:`execute` method
+            of the sessions.
+        """
+        aggregator = OutputAggregator(mask_numbers=mask_numbers)
+        self._run_limited(
+            names,
+            lambda name, session: aggregator.execute(session, name, command,
+                                                     **kwargs),
+            limiter, False)
+        return aggregator
+
+    def _run_limited(self, names, start_task, limiter, raise_if_error):
+        if names is None:
+            names = list(self.keys())
+        if limiter is None:
+            limiter = AdaptiveLimiter()
+        tasks = OrderedDict()
+        for name in names:
+            tasks[name] = limiter.track(lambda: start_task(name, self[name]))
+        errors = []
+        for task in tasks.values():
+            task.wait(raise_if_error=False)
+            error = task.error()
+            if error:
+                errors.append(error)
+        if raise_if_error and errors:
+            raise TaskErrors(errors)
+        return tasks
+
+    def execute(self, command, names=None, limiter=None,
+                raise_if_error=True, **kwargs):
+        """
+        Execute a command on the sessions, with a number of commands
+        running at the same time adapted to how fast and how well they
+        run (see :class:`rcontrol.adaptive.AdaptiveLimiter`). Wait for the
+        commands and return a dict of session name to command task.
+
+        :param command: the command to execute
+        :param names: names of the sessions. Defaults to all the sessions.
+        :param limiter: an :class:`rcontrol.adaptive.AdaptiveLimiter`.
+            A new one with the default settings is used if None.
+        :param raise_if_error: if True, raise the errors of the commands
+            with :class:`TaskErrors`.
+        :param kwargs: named arguments passed to the :meth:`execute`
+            method of the sessions.
+        """
+        # the errors are reported here, not by wait_for_tasks
+        kwargs.setdefault('on_done', _handled)
+        return self._run_limited(
+            names, lambda name, session: session.execute(command, **kwargs),
+            limiter, raise_if_error)
+
+    def copy_file(self, src_session, src, dest, names=None, limiter=None,
+                  raise_if_error=True, **kwargs):
+        """
+        Copy a file to the sessions, with a number of copies running at
+        the same time adapted like in :meth:`execute`. Wait for the
+        copies and return a dict of session name to copy task.
+
+        :param src_session: the session that holds the file
+        :param src: the path of the file in **src_session**
+        :param dest: the path of the file in the destination sessions
+        :param names: names of the destination sessions. Defaults to all
+            the sessions of the manager but **src_session**.
+        :param kwargs: named arguments passed to
+            :meth:`BaseSession.copy_file`.
+        """
+        if names is None:
+            names = [n for n, s in self.items() if s is not src_session]
+        kwargs.setdefault('on_done', _handled)
+        return self._run_limited(
+            names,
+            lambda name, session: src_session.copy_file(src, session, dest,
+                                                        **kwargs),
+            limiter, raise_if_error)
+
+    def set_output_sink(self, sink, names=None):
+        """
+        Set the default output sink of the commands executed on the
+        sessions. The output of each session is written under the
+        session name in the sink.
+
+        :param sink: an :class:`rcontrol.sinks.OutputSink`, or None to
+            remove the sink.
+        :param names: names of the sessions. Defaults to all the sessions.
+        """
+        if names is None:
+            names = list(self.keys())
+        for name in names:
+            self[name].output_sink = sink.host(name) if sink else None
+
     def close(self):
         """
         close the sessions.
@@ -470,22 +972,59 @@ class CommandTask(Task):
         possibly from stderr if streams are combined..
     :param on_stderr: a callable that takes two parameter, the command
         task instance and the line read. Called on line read from stderr.
+    :param stdin: data to send to the command standard input. It can be
+        bytes, a file object opened in binary mode or an iterable of
+        bytes chunks; it is streamed by a dedicated thread, then the
+        command stdin is closed. An error reading the data is reported as
+        an error of the task. If True, the command stdin is opened and
+        you are responsible to send data with :meth:`write` and to call
+        :meth:`close_stdin`. If None (the default), nothing is sent.
+    :param raw_stdout: if True, on_stdout is called with the raw chunks of
+        bytes read from stdout instead of lines.
+    :param max_queue_lines: maximum number of lines read but not yet
+        given to the callbacks. None (the default) means no limit.
+    :param max_queue_bytes: maximum size in bytes of the lines read but not
+        yet given to the callbacks. None (the default) means no limit.
+    :param queue_overflow: what to do when the output is read faster than
+        the callbacks handle it and a limit is reached: 'block' (the
+        default) stops reading the output, which slows down the command;
+        'drop' drops the lines; 'sample' keeps one line out of ten.
+    :param output_patterns: patterns to look for in the output, as a dict
+        of regular expressions to callables, or a list of regular
+        expressions. See :meth:`on_output`.
+    :param output_sink: an :class:`rcontrol.sinks.OutputSink` (or
+        :class:`rcontrol.sinks.HostSink`) that receives the output lines.
+        Defaults to the **output_sink** attribute of the session; False
+        means no sink. The stdout is not written to the sink when
+        **raw_stdout** is True.
+    :param priority: the priority of the command (see :class:`Task`),
+        also used for its callbacks in the **callback_executor**.
+    :param group: the fairness group of the command (see :class:`Task`).
     """
+    __slots__ = ('_stdin', '_stdin_error', '_combine_stderr', '_output_sink',
+                 '_sink_stdout', '_matcher', '_reader',
+                 '__exit_code', '__expected_exit_code', '__timed_out',
+                 '__finished_callback', '__timeout_callback',
+                 '__stdout_callback', '__stderr_callback')
+
     def __init__(self, session, reader_class, command, expected_exit_code=0,
                  combine_stderr=None, timeout=None, output_timeout=None,
                  on_finished=None, on_timeout=None, on_stdout=None,
-                 on_stderr=None, on_done=None,
+                 on_stderr=None, on_done=None, stdin=None,
+                 raw_stdout=False, max_queue_lines=None, max_queue_bytes=None,
+                 queue_overflow='block', callback_executor=None,
+                 output_patterns=None, output_sink=None, priority=0,
+                 group=None,
                  # deprecated aliases
                  finished_callback=None, timeout_callback=None,
                  stdout_callback=None, stderr_callback=None):
-        Task.__init__(self, session, on_done=on_done)
-
-        if combine_stderr is None:
-            combine_stderr = not stderr_callback
-        self._combine_stderr = combine_stderr
+        Task.__init__(self, session, on_done=on_done, priority=priority,
+                      group=group)
 
         self.__exit_code = None
         self.__expected_exit_code = expected_exit_code
+        self._stdin = stdin
+        self._stdin_error = None
         self.__timed_out = False
 
         def _warn(name):
@@ -506,41 +1045,221 @@ class CommandTask(Task):
             _warn("stderr")
             on_stderr = stderr_callback
 
+        if combine_stderr is None:
+            combine_stderr = not on_stderr
+        self._combine_stderr = combine_stderr
+
         self.__finished_callback = on_finished
         self.__timeout_callback = on_timeout
         self.__stdout_callback = on_stdout
         self.__stderr_callback = on_stderr
 
+        if output_sink is None:
+            output_sink = session.output_sink
+        if isinstance(output_sink, OutputSink):
+            output_sink = output_sink.host(session.host_name())
+        self._output_sink = output_sink or None
+        self._sink_stdout = not raw_stdout
+
+        self._matcher = OutputMatcher()
+        if output_patterns:
+            if isinstance(output_patterns, dict):
+                output_patterns = output_patterns.items()
+            else:
+                output_patterns = [(p, None) for p in output_patterns]
+            for pattern, callback in output_patterns:
+                self.on_output(pattern, callback)
+
         self._reader = reader_class(
             stdout_callback=self._on_stdout,
             stderr_callback=self._on_stderr,
             timeout=timeout,
             output_timeout=output_timeout,
             timeout_callback=self._on_timeout,
-            finished_callback=self._on_finished
+            finished_callback=self._on_finished,
+            raw_stdout=raw_stdout,
+            max_queue_lines=max_queue_lines,
+            max_queue_bytes=max_queue_bytes,
+            queue_overflow=queue_overflow,
+            callback_executor=callback_executor,
+            priority=self.priority,
+            group=self.group
         )
 
     def _set_exit_code(self, exit_code):
         self.__exit_code = exit_code
 
+    def _start_stdin(self):
+        # must be called by subclasses once the command is started
+        if self._stdin is None or self._stdin is True:
+            return
+        thread = threading.Thread(target=self._stream_stdin,
+                                  args=(self._stdin,))
+        thread.daemon = True
+        thread.start()
+
+    def _stream_stdin(self, stdin):
+        chunks = _iter_chunks(stdin)
+        try:
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except Exception as exc:
+                    # the error must be known before the command sees
+                    # the end of its input
+                    self._stdin_error = TaskError(
+                        self.session, self,
+                        'unable to read the standard input: %s' % exc)
+                    break
+                try:
+                    self._write_stdin(chunk)
+                except (IOError, OSError) as exc:
+                    if exc.errno != errno.EPIPE:
+                        self._stdin_error = TaskError(
+                            self.session, self,
+                            'unable to write the standard input: %s' % exc)
+                    # else the command does not read its input anymore
+                    break
+        finally:
+            try:
+                self._close_stdin()
+            except (IOError, OSError, EOFError):
+                pass
+
+    def _kill(self):
+        # Subclasses should stop the command here, so that it does not
+        # run for nothing when its output is not read anymore.
+        pass
+
+    def _write_stdin(self, data):
+        # Subclasses must implement this, and raise an IOError with the
+        # EPIPE errno if the command does not read its input anymore.
+        raise NotImplementedError
+
+    def _close_stdin(self):
+        raise NotImplementedError
+
+    def _check_stdin(self):
+        if self._stdin is not True:
+            raise ValueError('the command must be created with stdin=True'
+                             ' to write to its standard input')
+
+    def write(self, data):
+        """
+        Write bytes to the command standard input. This blocks until the
+        command accept the data.
+
+        The task must have been created with **stdin=True**, else a
+        ValueError is raised.
+        """
+        self._check_stdin()
+        self._write_stdin(data)
+
+    def close_stdin(self):
+        """
+        Close the command standard input.
+        """
+        self._check_stdin()
+        self._close_stdin()
+
+    def on_output(self, pattern, callback=None, plain=False):
+        """
+        Look for a pattern in the output lines (stdout and stderr).
+
+        Many patterns can be registered: those without groups are all
+        checked with only one regular expression search per line.
+        An exception raised by a callback is reported as an error of the
+        task.
+
+        :param pattern: a regular expression, or a plain string if
+            **plain** is True.
+        :param callback: if not None, a callable that takes two
+            parameters, the command task instance and the match object.
+            Called for each line that matches.
+        """
+        matcher = self._matcher
+        if callback is not None:
+            func = callback
+
+            def callback(match):
+                func(self, match)
+        matcher.add(pattern, callback, plain=plain)
+
+    def wait_for_output(self, pattern, timeout=None, plain=False):
+        """
+        Block until an output line matches the pattern, and return the
+        match object. A line that matched earlier is returned
+        immediately: any line if the pattern was registered before (with
+        **output_patterns** or :meth:`on_output`), else one of the last
+        100 lines while the command is running.
+
+        Return None if the command finished without any matching line.
+
+        :param timeout: the maximum time to wait for in seconds, or None.
+            A :class:`TimeoutError` is raised if the timeout is elapsed
+            and the command is still running.
+        """
+        matcher = self._matcher
+        match = matcher.wait(pattern, timeout=timeout, plain=plain)
+        if match is None:
+            if matcher.error is not None:
+                raise TaskError(self.session, self, matcher.error)
+            if not matcher.is_finished():
+                raise TimeoutError(self.session, self,
+                                   "timeout waiting for %r" % (pattern,))
+        return match
+
     def _on_stdout(self, line):
+        if self._output_sink is not None and self._sink_stdout:
+            self._output_sink.write('stdout', line)
+        self._run_nested(self._matcher.feed, line)
         if self.__stdout_callback:
-            self.__stdout_callback(self, line)
+            self._run_nested(self.__stdout_callback, self, line)
 
     def _on_stderr(self, line):
+        if self._output_sink is not None:
+            self._output_sink.write('stderr', line)
+        self._run_nested(self._matcher.feed, line)
         if self.__stderr_callback:
-            self.__stderr_callback(self, line)
+            self._run_nested(self.__stderr_callback, self, line)
 
     def _on_timeout(self):
         self.__timed_out = True
         self._unregister()
-        if self.__timeout_callback:
-            self.__timeout_callback(self)
+        self._matcher.finish()
+        callback = self.__timeout_callback
+        self._release_callbacks()
+        if callback:
+            callback(self)
 
     def _on_finished(self):
         self._unregister()
-        if self.__finished_callback:
-            self.__finished_callback(self)
+        self._matcher.finish()
+        callback = self.__finished_callback
+        self._release_callbacks()
+        if callback:
+            callback(self)
+
+    def _release_callbacks(self):
+        # once done, only the result state is kept: drop the callbacks
+        # and what they reference
+        self.__finished_callback = self.__timeout_callback = None
+        self.__stdout_callback = self.__stderr_callback = None
+        self._output_sink = None
+        if self._stdin is not True:
+            self._stdin = None
+
+    def flow_stats(self):
+        """
+        Return the flow control counters of the output reading, as a
+        dict: 'throttled' (number of times the reading had to wait for the
+        callbacks), 'throttle_time' (total time waiting, in seconds),
+        'dropped' (number of dropped lines), 'peak_lines' and 'peak_bytes'
+        (maximum number and size of lines waiting for the callbacks).
+        """
+        return self._reader.flow_stats()
 
     def timed_out(self):
         """
@@ -558,11 +1277,20 @@ class CommandTask(Task):
         """
         Return an instance of Exception if any, else None.
 
-        Actually check for a :class:`TimeoutError` or a
-        :class:`ExitCodeError`.
+        Actually check for a :class:`TimeoutError`, a :class:`TaskError`
+        if the data given with **stdin** could not be sent or if an
+        output callback (or an output pattern callback) raised an
+        exception, or a :class:`ExitCodeError`.
         """
         if self.__timed_out:
             return TimeoutError(self.session, self, "timeout")
+        if self._stdin_error is not None:
+            return self._stdin_error
+        callback_error = self._reader.callback_error()
+        if callback_error is None:
+            callback_error = self._matcher.error
+        if callback_error is not None:
+            return TaskError(self.session, self, callback_error)
         if self.__exit_code is not None and \
                 self.__expected_exit_code is not None and \
                 self.__exit_code != self.__expected_exit_code:
@@ -579,24 +1307,480 @@ class CommandTask(Task):
     def _wait(self, raise_if_error):
         if self._reader.is_alive():
             self._reader.thread.join()
+            self._reader.join_callbacks()
         if raise_if_error:
             self.raise_if_error()
         return self.__exit_code
 
 
+# commands (compress, decompress) usable to compress pipes data
+PIPE_COMPRESSORS = {
+    'gzip': ('gzip -c', 'gzip -dc'),
+    'bzip2': ('bzip2 -c', 'bzip2 -dc'),
+    'xz': ('xz -c', 'xz -dc'),
+    'zstd': ('zstd -q -c', 'zstd -q -dc'),
+}
+
+
+class Pipeline(object):
+    """
+    The stages of a pipeline created with :func:`pipe`.
+
+    The **tasks** attribute holds the list of the command tasks, in the
+    pipeline order. The **broken** attribute is True if the last command
+    exited before the first one was finished: the first command is then
+    stopped, like with a SIGPIPE, and the pipeline has an error.
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.broken = False
+
+    def is_running(self):
+        """
+        Return True if a stage of the pipeline is still running.
+        """
+        return any(t.is_running() for t in self.tasks)
+
+    def error(self):
+        """
+        Return a :class:`TaskErrors` with the errors of the stages, or
+        None if there are no errors.
+        """
+        errors = [e for e in (t.error() for t in self.tasks) if e]
+        if self.broken:
+            # the error of the stopped command is not relevant
+            src = self.tasks[0]
+            errors = [e for e in errors if e.task is not src]
+            errors.insert(0, TaskError(
+                src.session, src, 'the output is not read anymore: the'
+                ' next command exited before the end'))
+        if errors:
+            return TaskErrors(errors)
+
+    def exit_codes(self):
+        """
+        Return the list of the stages exit codes.
+        """
+        return [t.exit_code() for t in self.tasks]
+
+    def wait(self, raise_if_error=True):
+        """
+        Wait for all the stages, and return their exit codes.
+
+        :param raise_if_error: if True, raise the errors of the stages as
+            a :class:`TaskErrors`.
+        """
+        for task in self.tasks:
+            task.wait(raise_if_error=False)
+        error = self.error()
+        if raise_if_error and error:
+            raise error
+        return self.exit_codes()
+
+
+def pipe(src_session, src_command, dest_session, dest_command,
+         buffer_size=16, compress=None, src_kwargs=None, dest_kwargs=None):
+    """
+    Execute two commands, sending the stdout of the first one to the
+    stdin of the second one. The sessions can be different.
+
+    The data goes through this process in raw chunks, with at most
+    **buffer_size** chunks in memory: the source command is slowed down
+    if the destination command is slower. If the destination command
+    exits first, the source command is stopped (a local command is
+    killed, with the processes it started on linux; the channel of a
+    remote command is closed) and the pipeline is broken.
+
+    Return a :class:`Pipeline`, from which the errors and exit codes of
+    both commands are available.
+
+    :param compress: if not None, the name of a compression program (one
+        of **PIPE_COMPRESSORS**, like 'gzip') used to compress the data on
+        the source host and decompress it on the destination host.
+    :param src_kwargs: named arguments for the source command execution.
+    :param dest_kwargs: named arguments for the destination command
+        execution.
+    """
+    src_kwargs = dict(src_kwargs or {})
+    dest_kwargs = dict(dest_kwargs or {})
+    if compress:
+        compressor, decompressor = PIPE_COMPRESSORS[compress]
+        # keep the source command exit code, not the compressor one
+        src_command = ('exec 4>&1; rc=$({ { ( %s\n); echo $? >&3; }'
+                       ' | %s >&4; } 3>&1); exit $rc') % (src_command,
+                                                          compressor)
+        dest_command = '%s | ( %s\n)' % (decompressor, dest_command)
+
+    chunks = Queue(buffer_size)
+    dest_done = threading.Event()
+    src_done = threading.Event()
+    pipeline = Pipeline([])
+    lock = threading.Lock()
+
+    def put(chunk):
+        # block while the buffer is full, unless nobody reads anymore
+        while not dest_done.is_set():
+            try:
+                chunks.put(chunk, True, 0.1)
+                return
+            except Full:
+                pass
+
+    def stop():
+        dest_done.set()
+        try:
+            # unblock the stdin writer if it waits for data
+            chunks.put_nowait(None)
+        except Full:
+            pass
+        stop_src()
+
+    def stop_src():
+        # stop the source once the destination is done, if it is
+        # started and not finished
+        with lock:
+            if not pipeline.tasks or src_done.is_set() or pipeline.broken:
+                return
+            pipeline.broken = True
+        pipeline.tasks[0]._kill()
+
+    def src_finished():
+        src_done.set()
+        put(None)
+
+    def read_chunks():
+        chunk = chunks.get()
+        while chunk is not None:
+            yield chunk
+            chunk = chunks.get()
+
+    def chain(callback, func):
+        def new_callback(task, *args):
+            func(*args)
+            if callback:
+                callback(task, *args)
+        return new_callback
+
+    for name in ('on_finished', 'on_timeout'):
+        dest_kwargs[name] = chain(dest_kwargs.get(name), stop)
+        src_kwargs[name] = chain(src_kwargs.get(name), src_finished)
+    src_kwargs['on_stdout'] = chain(src_kwargs.get('on_stdout'), put)
+    src_kwargs['raw_stdout'] = True
+    src_kwargs.setdefault('combine_stderr', False)
+
+    dest = dest_session.execute(dest_command, stdin=read_chunks(),
+                                **dest_kwargs)
+    src = src_session.execute(src_command, **src_kwargs)
+    with lock:
+        pipeline.tasks = [src, dest]
+    if dest_done.is_set():
+        stop_src()
+    return pipeline
+
+
+class GraphNode(object):
+    """
+    A node of a :class:`TaskGraph`.
+
+    The **state** attribute is one of 'pending', 'ready' (waiting for a
+    free slot), 'running', 'succeeded', 'failed' or 'skipped' (a
+    dependency failed). Once started, **task** is the task of the node,
+    and **error** its error if it failed.
+    """
+    def __init__(self, name, start, sessions, depends):
+        self.name = name
+        self.sessions = tuple(s for s in sessions if s is not None)
+        self.depends = tuple(depends)
+        self.dependents = []
+        self.state = 'pending'
+        self.task = None
+        self.error = None
+        self.ready_time = None
+        self.start_time = None
+        self.end_time = None
+        self._start = start
+
+    def queue_wait(self):
+        """
+        Return the time in seconds the node waited for a free slot once
+        its dependencies were done, or None if it was not started.
+        """
+        if self.start_time is not None:
+            return self.start_time - self.ready_time
+
+    def duration(self):
+        """
+        Return the time in seconds the node ran, or None if it is not
+        done.
+        """
+        if self.end_time is not None:
+            return self.end_time - self.start_time
+
+    def __repr__(self):
+        return '<GraphNode %s (%s)>' % (self.name, self.state)
+
+
+class TaskGraph(object):
+    """
+    Run tasks with dependencies between them.
+
+    Each node is started as soon as all its dependencies succeeded, and
+    the nodes that depend (even indirectly) on a failed node are
+    skipped. Example::
+
+        graph = TaskGraph(host_limit=2)
+        graph.add_copy('upload', local, 'app.tar', remote, '/tmp/app.tar')
+        graph.add_command('stop', remote, 'service app stop')
+        graph.add_command('install', remote, 'tar xf /tmp/app.tar',
+                          depends=['upload', 'stop'])
+        graph.add_command('start', remote, 'service app start',
+                          depends=['install'])
+        graph.run()
+        print(graph.report())
+
+    The graph reports the errors of its nodes itself: they are not
+    reported again by :meth:`BaseSession.wait_for_tasks`.
+
+    :param max_running: if not None, the maximum number of nodes running
+        at the same time.
+    :param host_limit: if not None, the maximum number of nodes running
+        at the same time on a session (a copy uses both its sessions).
+    """
+    def __init__(self, max_running=None, host_limit=None):
+        self.max_running = max_running
+        self.host_limit = host_limit
+        self.nodes = OrderedDict()
+        self._cond = threading.Condition()
+        self._ready = []
+        self._running = 0
+        self._host_running = {}
+        self._remaining = 0
+
+    def add(self, name, start, sessions=(), depends=()):
+        """
+        Add a node, and return its :class:`GraphNode`.
+
+        :param name: the name of the node, used in the dependencies
+        :param start: a callable that starts the node task and returns
+            it
+        :param sessions: the sessions the task runs on, for the host
+            limit
+        :param depends: the names of the nodes that must succeed before
+            this one is started
+        """
+        if name in self.nodes:
+            raise ValueError('duplicate node: %r' % name)
+        node = self.nodes[name] = GraphNode(name, start, sessions, depends)
+        return node
+
+    def add_command(self, name, session, command, depends=(), **kwargs):
+        """
+        Add a node that executes a command on a session. The other named
+        arguments are given to :meth:`BaseSession.execute`.
+        """
+        kwargs.setdefault('on_done', _handled)
+        return self.add(name, lambda: session.execute(command, **kwargs),
+                        (session,), depends)
+
+    def add_copy(self, name, src_session, src, dest_session, dest,
+                 depends=(), **kwargs):
+        """
+        Add a node that copies a file between sessions. The other named
+        arguments are given to :meth:`BaseSession.copy_file`.
+        """
+        kwargs.setdefault('on_done', _handled)
+        return self.add(
+            name,
+            lambda: src_session.copy_file(src, dest_session, dest, **kwargs),
+            (src_session, dest_session), depends)
+
+    def _check(self):
+        for node in self.nodes.values():
+            for dep in node.depends:
+                if dep not in self.nodes:
+                    raise ValueError('node %r depends on unknown node %r'
+                                     % (node.name, dep))
+        # detect cycles by removing the nodes without dependencies
+        counts = dict((n.name, len(set(n.depends)))
+                      for n in self.nodes.values())
+        dependents = dict((name, []) for name in self.nodes)
+        for node in self.nodes.values():
+            for dep in set(node.depends):
+                dependents[dep].append(node.name)
+        free = [name for name, count in counts.items() if not count]
+        while free:
+            for name in dependents[free.pop()]:
+                counts[name] -= 1
+                if not counts[name]:
+                    free.append(name)
+        cycle = [name for name, count in counts.items() if count]
+        if cycle:
+            raise ValueError('dependency cycle between nodes: %s'
+                             % ', '.join(map(str, cycle)))
+
+    def _set_ready(self, node, now):
+        node.state = 'ready'
+        node.ready_time = now
+        self._ready.append(node)
+
+    def _fits(self, node):
+        if self.max_running is not None and \
+                self._running >= self.max_running:
+            return False
+        if self.host_limit is not None:
+            for session in node.sessions:
+                if self._host_running.get(session, 0) >= self.host_limit:
+                    return False
+        return True
+
+    def _pop_startable(self):
+        # the ready nodes are started in order, but a node blocked by
+        # its host limit does not block the nodes of other hosts
+        for i, node in enumerate(self._ready):
+            if self._fits(node):
+                return self._ready.pop(i)
+
+    def _skip(self, node):
+        for dependent in node.dependents:
+            if dependent.state == 'pending':
+                dependent.state = 'skipped'
+                self._remaining -= 1
+                self._skip(dependent)
+
+    def _node_done(self, node, task, error=None):
+        if task is not None:
+            error = task.error()
+        with self._cond:
+            now = time.time()
+            node.task = task
+            node.end_time = now
+            self._running -= 1
+            for session in node.sessions:
+                self._host_running[session] -= 1
+            self._remaining -= 1
+            if error:
+                node.state = 'failed'
+                node.error = error
+                self._skip(node)
+            else:
+                node.state = 'succeeded'
+                for dependent in node.dependents:
+                    if dependent.state == 'pending' and all(
+                            self.nodes[d].state == 'succeeded'
+                            for d in dependent.depends):
+                        self._set_ready(dependent, now)
+            self._cond.notify_all()
+
+    def run(self, raise_if_error=True):
+        """
+        Run the graph and wait until all the nodes are done or skipped.
+        A graph can only be run once.
+
+        :param raise_if_error: If True, the errors of the failed nodes are
+            raised using :class:`TaskErrors`. Else the errors are returned
+            as a list.
+        """
+        self._check()
+        now = time.time()
+        with self._cond:
+            for node in self.nodes.values():
+                node.dependents = []
+            for node in self.nodes.values():
+                for dep in set(node.depends):
+                    self.nodes[dep].dependents.append(node)
+                if not node.depends:
+                    self._set_ready(node, now)
+            self._remaining = len(self.nodes)
+        while True:
+            with self._cond:
+                node = self._pop_startable()
+                while node is None and self._remaining:
+                    self._cond.wait()
+                    node = self._pop_startable()
+                if node is None:
+                    break
+                node.state = 'running'
+                node.start_time = time.time()
+                self._running += 1
+                for session in node.sessions:
+                    self._host_running[session] = \
+                        self._host_running.get(session, 0) + 1
+            try:
+                task = node._start()
+            except Exception:
+                session = node.sessions[0] if node.sessions else None
+                self._node_done(node, None, TaskError(session, node.name,
+                                                      sys.exc_info()[1]))
+                continue
+            task.add_done_callback(
+                lambda task, node=node: self._node_done(node, task))
+        errors = [n.error for n in self.nodes.values() if n.error]
+        if raise_if_error and errors:
+            raise TaskErrors(errors)
+        return errors
+
+    def critical_path(self):
+        """
+        Return the list of the nodes that determined the graph duration:
+        the node that finished last, preceded by its dependency that
+        finished last, and so on.
+        """
+        done = [n for n in self.nodes.values() if n.end_time is not None]
+        if not done:
+            return []
+        node = max(done, key=lambda n: n.end_time)
+        path = [node]
+        while True:
+            deps = [self.nodes[d] for d in node.depends
+                    if self.nodes[d].end_time is not None]
+            if not deps:
+                break
+            node = max(deps, key=lambda n: n.end_time)
+            path.append(node)
+        path.reverse()
+        return path
+
+    def report(self):
+        """
+        Return a text report of the nodes (state, time spent waiting for
+        a free slot and running time), and of the critical path.
+        """
+        def seconds(value):
+            return '-' if value is None else '%.2fs' % value
+
+        width = max([len(str(name)) for name in self.nodes] + [4])
+        lines = ['%-*s %-9s %8s %8s' % (width, 'node', 'state', 'wait',
+                                        'duration')]
+        for node in self.nodes.values():
+            lines.append('%-*s %-9s %8s %8s' % (
+                width, node.name, node.state, seconds(node.queue_wait()),
+                seconds(node.duration())))
+        path = self.critical_path()
+        if path:
+            lines.append('critical path: %s (%s)' % (
+                ' -> '.join(str(n.name) for n in path),
+                seconds(path[-1].end_time - path[0].ready_time)))
+        return '\n'.join(lines) + '\n'
+
+
 class ThreadableTask(Task):
     """
     A task ran in a background thread.
     """
+    __slots__ = ('exception', '_result', 'thread')
+
     def __init__(self, session, callable, args, kwargs,
-                 on_done=None):
-        Task.__init__(self, session, on_done=on_done)
+                 on_done=None, priority=0, group=None):
+        Task.__init__(self, session, on_done=on_done, priority=priority,
+                      group=group)
         # Set up exception handling
         self.exception = None
+        self._result = None
+        self._reserve(threads=1)
 
         def wrapper(*args, **kwargs):
             try:
-                callable(*args, **kwargs)
+                self._result = self._run_nested(callable, *args, **kwargs)
             except Exception:
                 self.exception = TaskError(session, self, sys.exc_info()[1])
             finally:
@@ -616,6 +1800,14 @@ class ThreadableTask(Task):
     def error(self):
         return self.exception
 
+    def result(self):
+        """
+        Return the value returned by the callable (e.g. the
+        :class:`rcontrol.fs.TransferStats` of a copy), or None if it is
+        not finished or failed.
+        """
+        return self._result
+
     def _wait(self, raise_if_error):
         if self.thread.is_alive():
             self.thread.join()
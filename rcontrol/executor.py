@@ -0,0 +1,153 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+from collections import deque
+
+from rcontrol.scheduling import FairQueue
+
+
+class CallbackExecutor(object):
+    """
+    Run the callbacks of tasks outside of the threads that read the
+    commands output.
+
+    Callbacks submitted with the same key (e.g. the same task) are run
+    one after the other, in the submission order. The exceptions raised
+    by the callbacks of the commands are reported as errors of their
+    task (see :meth:`rcontrol.streamreader.StreamsReader.callback_error`).
+
+    Subclasses must implement :meth:`submit`.
+    """
+    def submit(self, key, func, *args):
+        """
+        Schedule the call of **func** with the given arguments.
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """
+        Stop the executor.
+        """
+
+
+class ThreadPoolCallbackExecutor(CallbackExecutor):
+    """
+    Run callbacks in a shared pool of threads.
+
+    Callbacks with different keys run in parallel, while callbacks with
+    the same key keep their order. Callbacks of a busy key are
+    interleaved with the callbacks of the other keys.
+
+    The keys are scheduled with a :class:`rcontrol.scheduling.FairQueue`,
+    using their **group** and **priority** attributes if they have them
+    (the commands output readers get those of their command). Keys
+    without a group are each in their own group.
+
+    It can be shared by many tasks, possibly from many sessions. The
+    exceptions raised by the functions given directly to :meth:`submit`
+    are kept in the **errors** list attribute.
+
+    :param max_workers: the number of threads in the pool.
+    :param weights: a dict of group to weight.
+    """
+    def __init__(self, max_workers=4, weights=None):
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        # key -> deque of pending (func, args). A key is present while
+        # it has callbacks waiting or running.
+        self._pending = {}
+        # keys ready to be processed by a worker
+        self._ready = FairQueue(weights)
+        self._threads = []
+        self._shutdown = False
+        self.errors = []
+
+    def _start_workers(self):
+        while len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args):
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('the executor is shut down')
+            if not self._threads:
+                self._start_workers()
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = deque([(func, args)])
+                self._push_ready(key)
+                self._cond.notify()
+            else:
+                pending.append((func, args))
+
+    def _push_ready(self, key):
+        group = getattr(key, 'group', None)
+        self._ready.push(key, key if group is None else group,
+                         getattr(key, 'priority', 0))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._shutdown:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.pop()
+                func, args = self._pending[key][0]
+            try:
+                func(*args)
+            except Exception:
+                self.errors.append(sys.exc_info()[1])
+            with self._cond:
+                pending = self._pending[key]
+                pending.popleft()
+                if pending:
+                    self._push_ready(key)
+                    self._cond.notify()
+                else:
+                    del self._pending[key]
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads once the pending callbacks are done.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            threads = self._threads[:]
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class AsyncioCallbackExecutor(CallbackExecutor):
+    """
+    Run callbacks in an asyncio event loop.
+
+    The callbacks are scheduled with **loop.call_soon_threadsafe**, so
+    they are run in the loop thread in the submission order.
+
+    :param loop: the asyncio event loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def submit(self, key, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
@@ -13,35 +13,905 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import fnmatch
+import hashlib
 import posixpath
+import re
+import stat
+import sys
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from six.moves import shlex_quote
+from six.moves.queue import Queue, Full, Empty
 
+from rcontrol import core
 
-def copy_file(src_os, src, dest_os, dest, chunk_size=16384):
+# hash algorithms that can be checked on the remote side, with the
+# command used to compute the digest.
+DIGEST_COMMANDS = {
+    'md5': 'md5sum',
+    'sha1': 'sha1sum',
+    'sha224': 'sha224sum',
+    'sha256': 'sha256sum',
+    'sha384': 'sha384sum',
+    'sha512': 'sha512sum',
+}
+
+
+# format of the stat command used by _command_stat: raw mode in hex,
+# size, mtime, atime, uid, gid and the name. The name is followed by a
+# '/' since the lines of output lose their trailing spaces.
+STAT_FORMAT = '%f %s %Y %X %u %g %n/'
+
+# default location of the content-addressed store on remote hosts
+CACHE_DIR = '~/.rcontrol/cas'
+
+# the names of the blobs of the store
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+# an entry returned by find. type is a letter like in the find -printf
+# %y directive: 'f' (regular file), 'd' (directory), 'l' (symbolic
+# link), 'p' (fifo), 's' (socket), 'c' or 'b' (devices).
+FindEntry = namedtuple('FindEntry', 'path type size mtime')
+
+
+class TransferStats(namedtuple('TransferStats',
+                               'src dest size duration throttled')):
+    """
+    The statistics of a file copy: the source and destination paths, the
+    number of bytes copied, the duration of the copy and the time spent
+    waiting for the bandwidth limits, in seconds.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """
+        The achieved rate in bytes per second, or None if the copy took
+        no measurable time.
+        """
+        if self.duration > 0:
+            return self.size / self.duration
+
+    def __str__(self):
+        rate = self.rate
+        return '%s -> %s: %d bytes in %.2fs (%s, throttled %.2fs)' % (
+            self.src, self.dest, self.size, self.duration,
+            '-' if rate is None else '%.1f KiB/s' % (rate / 1024),
+            self.throttled)
+
+
+class TokenBucket(object):
+    """
+    A token bucket, to limit a bandwidth.
+
+    Each byte transferred takes a token; tokens are added at **rate**
+    per second, up to **burst** tokens. A transfer that takes more tokens
+    than available waits until the missing tokens are added, so the
+    bucket can be shared by many threads. A change of rate applies to
+    the transfers already waiting.
+
+    :param rate: the rate in bytes per second, or None for no limit.
+    :param burst: the maximum number of bytes transferred at once after
+        an idle period. Defaults to **rate** (one second of transfer).
+    """
+    def __init__(self, rate=None, burst=None):
+        self._cond = threading.Condition()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        # the total of the tokens added, to know when a waiting transfer
+        # got what it misses
+        self._added = 0.0
+        self._time = time.time()
+        self.set_rate(rate, burst)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            tokens = min(self._tokens + (now - self._time) * self.rate,
+                         self.burst)
+            self._added += max(tokens - self._tokens, 0)
+            self._tokens = tokens
+        self._time = now
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate (None for no limit) and the burst. This can be
+        called while transfers are using the bucket.
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError('the rate must be positive')
+        with self._cond:
+            self._refill(time.time())
+            # the waiting transfers compute their wait again
+            self._cond.notify_all()
+            if rate is None:
+                self.rate = self.burst = None
+                return
+            burst = rate if burst is None else burst
+            # a limit that is set starts with a full bucket
+            self._tokens = burst if self.rate is None else \
+                min(self._tokens, burst)
+            self.rate = rate
+            self.burst = burst
+
+    def consume(self, count):
+        """
+        Take **count** tokens, waiting if needed. Return the time waited
+        in seconds.
+        """
+        with self._cond:
+            if self.rate is None:
+                return 0.0
+            start = time.time()
+            self._refill(start)
+            self._tokens -= count
+            if self._tokens >= 0:
+                return 0.0
+            # the tokens consumed before are added first
+            target = self._added - self._tokens
+            while self.rate is not None and self._added < target:
+                self._cond.wait((target - self._added) / self.rate)
+                self._refill(time.time())
+        return time.time() - start
+
+
+# the bandwidth limit of all the copies relayed by this process
+_global_bucket = TokenBucket()
+
+
+def set_bandwidth_limit(rate, burst=None):
+    """
+    Limit the total bandwidth of the copies relayed by this process, in
+    bytes per second (None for no limit). See :class:`TokenBucket`.
+    """
+    _global_bucket.set_rate(rate, burst)
+
+
+def _session_bucket(session):
+    # the bandwidth limit of a session, if any (see
+    # BaseSession.set_bandwidth_limit)
+    bucket = getattr(session, 'bandwidth', None)
+    return bucket if isinstance(bucket, TokenBucket) else None
+
+
+def _bucket(rate_limit):
+    if rate_limit is None or isinstance(rate_limit, TokenBucket):
+        return rate_limit
+    return TokenBucket(rate_limit)
+
+
+def _throttle(buckets, count):
+    return sum(bucket.consume(count) for bucket in buckets
+               if bucket is not None)
+
+
+def _text(line):
+    if isinstance(line, bytes):
+        return line.decode('utf-8', 'replace')
+    return line
+
+
+def _command_output(session, command):
+    """
+    Execute a command on a session, wait for it and return the list of
+    lines written on stdout (as text).
+
+    An :class:`rcontrol.core.ExitCodeError` is raised if the command
+    fails.
+    """
+    lines = []
+    task = session.execute(command, combine_stderr=False, output_sink=False,
+                           on_stdout=lambda t, line: lines.append(_text(line)))
+    task.wait()
+    return lines
+
+
+def _command_stat(session, paths, follow_symlinks=True):
+    """
+    Stat many paths with the GNU **stat** command executed in a session.
+
+    Return a dict that associate the existing paths to a tuple (st_mode,
+    st_size, st_mtime, st_atime, st_uid, st_gid), or None if the stat
+    command is not usable.
+    """
+    if not paths:
+        return {}
+    lines = []
+    # the paths are sent on stdin, and xargs splits them in command
+    # lines short enough: only one command is executed.
+    command = ('stat -c %%n / >/dev/null 2>&1 || exit 127;'
+               ' xargs -0 stat %s-c %s --') % (
+        '-L ' if follow_symlinks else '', shlex_quote(STAT_FORMAT))
+    stdin = b'\0'.join(
+        p if isinstance(p, bytes) else p.encode('utf-8') for p in paths)
+    task = session.execute(
+        command, combine_stderr=False, expected_exit_code=None,
+        output_sink=False, stdin=stdin,
+        on_stdout=lambda t, line: lines.append(line))
+    # 123: the stat command failed for some paths, e.g. missing ones
+    if task.wait() not in (0, 123):
+        return None
+    result = {}
+    for line in lines:
+        fields = _text(line).split(' ', 6)
+        if len(fields) != 7 or not fields[6].endswith('/'):
+            return None
+        result[fields[6][:-1]] = tuple(
+            [int(fields[0], 16)] + [int(f) for f in fields[1:6]])
+    return result
+
+
+def fs_ops_script(ops, batch_size=100):
+    """
+    Return a shell script that applies file system operations (see
+    :meth:`rcontrol.core.BaseSession.apply_fs_ops`). It should be run
+    with **sh -e** to stop at the first error.
+
+    Consecutive operations of the same kind are grouped in one command
+    line, up to **batch_size** paths.
+    """
+    lines = []
+    group_key, group = None, []
+
+    def flush():
+        if group:
+            lines.append('%s -- %s' % (group_key, ' '.join(
+                shlex_quote(p) for p in group)))
+            del group[:]
+
+    for op in ops:
+        name, args = op[0], op[1:]
+        if name == 'mkdir' and len(args) == 1:
+            key = 'mkdir'
+        elif name == 'mkdir' and len(args) == 2:
+            key = 'mkdir -m %o' % args[1]
+        elif name == 'chmod' and len(args) == 2:
+            key = 'chmod %o' % args[1]
+        elif name == 'unlink' and len(args) == 1:
+            key = 'rm'
+        elif name == 'rename' and len(args) == 2:
+            key = None
+            command = 'mv -f'
+        elif name == 'symlink' and len(args) == 2:
+            key = None
+            command = 'ln -s'
+        else:
+            raise ValueError('invalid file system operation: %r' % (op,))
+        if key != group_key or len(group) >= batch_size:
+            flush()
+            group_key = key
+        if key is None:
+            lines.append('%s -- %s' % (command, ' '.join(
+                shlex_quote(a) for a in args)))
+        else:
+            group.append(args[0])
+    flush()
+    return ''.join(line + '\n' for line in lines)
+
+
+def _shell_path(path):
+    """
+    Quote a path for the shell, keeping a leading '~' expandable.
+    """
+    if path == '~':
+        return '"$HOME"'
+    if path.startswith('~/'):
+        return '"$HOME"/' + shlex_quote(path[2:])
+    return shlex_quote(path)
+
+
+def remote_digest(session, path, algorithm='sha256'):
+    """
+    Compute the hex digest of a file by executing a command (like
+    sha256sum) in the given session.
+
+    :class:`rcontrol.core.ChecksumError` is raised if the output of the
+    command is not a digest.
+    """
+    try:
+        command = DIGEST_COMMANDS[algorithm]
+    except KeyError:
+        raise ValueError('unsupported digest algorithm: %r' % algorithm)
+    # read the file on stdin: with a file name, GNU tools prefix the
+    # digest with a backslash when the name has special characters
+    lines = _command_output(session,
+                            '%s < %s' % (command, shlex_quote(path)))
+    fields = lines[0].split() if lines else []
+    digest = fields[0].lower() if fields else ''
+    if len(digest) != hashlib.new(algorithm).digest_size * 2 or \
+            digest.strip('0123456789abcdef'):
+        raise core.ChecksumError(
+            session, None, "%s: unable to read the %s digest from %r"
+            % (path, algorithm, '\n'.join(lines)))
+    return digest
+
+
+def copy_file(src_os, src, dest_os, dest, chunk_size=16384, verify=None,
+              expected_digest=None, rate_limit=None):
+    """
+    Copy a file from a session to another one, and return its
+    :class:`TransferStats`.
+
+    If **verify** is given (a hash algorithm name like 'sha256'), the
+    data is hashed while it is copied, then compared against the digest
+    of the destination file computed remotely (one exec on the
+    destination session), and against **expected_digest** if given.
+    :class:`rcontrol.core.ChecksumError` is raised on mismatch.
+
+    The copy obeys the bandwidth limits of both sessions (see
+    :meth:`rcontrol.core.BaseSession.set_bandwidth_limit`), the global
+    limit (see :func:`set_bandwidth_limit`) and **rate_limit**, a rate
+    in bytes per second or a :class:`TokenBucket` (to change the rate
+    while copying, or share it between copies).
+    """
+    if expected_digest and not verify:
+        verify = 'sha256'
+    # checked before copying, as the digest is computed remotely at end
+    if verify and verify not in DIGEST_COMMANDS:
+        raise ValueError('unsupported digest algorithm: %r' % verify)
+    hasher = hashlib.new(verify) if verify else None
+    buckets = (_bucket(rate_limit), _session_bucket(src_os),
+               _session_bucket(dest_os), _global_bucket)
+    size, throttled = 0, 0.0
+    start = time.time()
     with src_os.open(src, 'rb') as fr:
         with dest_os.open(dest, 'wb') as fw:
             data = fr.read(chunk_size)
             while data:
+                throttled += _throttle(buckets, len(data))
                 fw.write(data)
+                size += len(data)
+                if hasher:
+                    hasher.update(data)
                 data = fr.read(chunk_size)
+    stats = TransferStats(src, dest, size, time.time() - start, throttled)
+    if hasher:
+        _check_digest(dest_os, dest, verify, hasher.hexdigest(),
+                      expected_digest)
+    return stats
+
+
+def check_copy_digest(src_os, src, dest_os, dest, algorithm='sha256',
+                      expected_digest=None):
+    """
+    Check that a file copied without going through this process has the
+    same digest on both sessions, computed remotely. The digest is also
+    compared to **expected_digest** if given.
+    """
+    _check_digest(dest_os, dest, algorithm,
+                  remote_digest(src_os, src, algorithm), expected_digest)
+
+
+def _check_digest(dest_os, dest, algorithm, digest, expected_digest):
+    if expected_digest and digest != expected_digest.lower():
+        raise core.ChecksumError(
+            dest_os, None, "%s: copied data digest %s, expected %s"
+            % (dest, digest, expected_digest))
+    remote = remote_digest(dest_os, dest, algorithm)
+    if remote != digest:
+        raise core.ChecksumError(
+            dest_os, None, "%s: remote digest %s, expected %s"
+            % (dest, remote, digest))
+
+
+def put_cached(src_session, src, dest_session, dest, cache_dir=CACHE_DIR,
+               digest=None, link=False, verify=True, max_size=None,
+               chunk_size=16384):
+    """
+    Copy a file using a content-addressed store on the destination host.
+
+    The file is stored in **cache_dir** under its sha256 digest. If the
+    destination host already has the blob (checked with one exec), the
+    destination file is copied from it, and nothing is uploaded. Else
+    the file is uploaded in the store first.
 
+    Return True if the blob was already in the store.
 
-def copy_dir(src_session, src, dest_session, dest, chunk_size=16384):
-    dest_session.mkdir(dest)
+    :param digest: the sha256 of the source file (in lower case hex) if
+        known, else it is computed by an exec in the source session.
+    :param link: if True, the destination file is a hard link to the
+        blob instead of a copy, when possible. The destination must then
+        never be modified in place, as this would change the blob, and
+        its mtime changes each time the blob is used.
+    :param verify: if True, check the digest of uploaded blobs.
+    :param max_size: if not None, evict the least recently used blobs
+        after an upload so that the store does not exceed this size in
+        bytes (see :func:`evict_cache`).
+    """
+    if digest is None:
+        digest = remote_digest(src_session, src)
+    elif not _SHA256.match(digest):
+        raise ValueError('invalid sha256 digest: %r' % (digest,))
+    if link:
+        materialize = '{ ln -f "$b" %s 2>/dev/null || cp "$b" %s; }' % (
+            shlex_quote(dest), shlex_quote(dest))
+    else:
+        materialize = 'cp "$b" %s' % shlex_quote(dest)
+    lines = _command_output(dest_session, (
+        'c=%s; b="$c/%s"; if [ -f "$b" ]; then'
+        ' touch "$b" && %s && echo hit;'
+        ' else mkdir -p "$c" && cd "$c" && pwd; fi') % (
+            _shell_path(cache_dir), digest, materialize))
+    if lines and lines[0].strip() == 'hit':
+        return True
+    store = lines[0].strip()
+    tmp = posixpath.join(store, '%s.tmp.%s' % (digest, uuid.uuid4().hex))
+    copy_file(src_session, src, dest_session, tmp, chunk_size=chunk_size,
+              verify='sha256' if verify else None,
+              expected_digest=digest if verify else None)
+    _command_output(dest_session, 'b=%s; mv %s "$b" && %s' % (
+        shlex_quote(posixpath.join(store, digest)), shlex_quote(tmp),
+        materialize))
+    if max_size is not None:
+        evict_cache(dest_session, max_size, cache_dir=cache_dir)
+    return False
+
+
+def evict_cache(session, max_size, cache_dir=CACHE_DIR):
+    """
+    Remove the least recently used blobs of a content-addressed store
+    (see :func:`put_cached`) until its total size is at most
+    **max_size** bytes.
+
+    Return the list of the removed digests.
+    """
+    lines = _command_output(session, (
+        'c=%s; [ ! -d "$c" ] || find "$c" -maxdepth 1 -type f'
+        ' ! -name "*.tmp.*" -printf "%%T@ %%s %%f\\n"') % _shell_path(
+            cache_dir))
+    blobs = []
+    for line in lines:
+        mtime, size, name = line.split(None, 2)
+        blobs.append((float(mtime), int(size), name.strip()))
+    total = sum(size for _, size, _ in blobs)
+    removed = []
+    for mtime, size, name in sorted(blobs):
+        if total <= max_size:
+            break
+        removed.append(name)
+        total -= size
+    if removed:
+        names = ' '.join(shlex_quote(name) for name in removed)
+        _command_output(session, 'cd %s && rm -f -- %s' % (
+            _shell_path(cache_dir), names))
+    return removed
+
+
+def copy_dir(src_session, src, dest_session, dest, chunk_size=16384,
+             verify=None, rate_limit=None):
+    """
+    Recursively copy a directory from a session to another one, and
+    return the list of the :class:`TransferStats` of the files.
+
+    **rate_limit** limits the bandwidth of the whole copy (see
+    :func:`copy_file`).
+    """
+    rate_limit = _bucket(rate_limit)
     src_len = len(src)
+    # create all the directories with one batch, then copy the files
+    mkdirs = [('mkdir', dest)]
+    copies = []
     for root, dirs, files in src_session.walk(src):
         # Normalize source current directory to be relative to the top
         scontext = root[src_len:].lstrip('/')
         # calculate the dest directory
         dcontext = posixpath.join(dest, scontext)
 
-        # create dirs
         for dir in dirs:
-            path = posixpath.join(dcontext, dir)
-            dest_session.mkdir(path)
+            mkdirs.append(('mkdir', posixpath.join(dcontext, dir)))
 
-        # create files
         for file in files:
-            path = posixpath.join(dcontext, file)
-            spath = posixpath.join(src, scontext, file)
-            copy_file(src_session, spath, dest_session, path,
-                      chunk_size=chunk_size)
+            copies.append((posixpath.join(src, scontext, file),
+                           posixpath.join(dcontext, file)))
+
+    dest_session.apply_fs_ops(mkdirs)
+    return [copy_file(src_session, spath, dest_session, path,
+                      chunk_size=chunk_size, verify=verify,
+                      rate_limit=rate_limit)
+            for spath, path in copies]
+
+
+def _file_type(mode):
+    for test, letter in ((stat.S_ISREG, 'f'), (stat.S_ISDIR, 'd'),
+                         (stat.S_ISLNK, 'l'), (stat.S_ISFIFO, 'p'),
+                         (stat.S_ISSOCK, 's'), (stat.S_ISCHR, 'c'),
+                         (stat.S_ISBLK, 'b')):
+        if test(mode):
+            return letter
+    return 'U'
+
+
+def _match_any(name, patterns):
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+
+def _walk_find(session, top, include, exclude, min_mtime, max_mtime,
+               max_depth):
+    depths = {top: 0}
+    for root, dirs, files in session.walk(top):
+        depth = depths.pop(root, 0) + 1
+        if exclude:
+            # pruning the directories before they are listed
+            dirs[:] = [d for d in dirs if not _match_any(d, exclude)]
+            files = [f for f in files if not _match_any(f, exclude)]
+        names = dirs + files
+        if max_depth is not None and depth >= max_depth:
+            dirs[:] = []
+        for name in dirs:
+            depths[posixpath.join(root, name)] = depth
+        if include:
+            names = [n for n in names if _match_any(n, include)]
+        paths = [posixpath.join(root, name) for name in names]
+        attrs = session.stat_many(paths, follow_symlinks=False)
+        for path in paths:
+            attr = attrs.get(path)
+            if attr is None:
+                continue  # removed since the directory was listed
+            entry = FindEntry(path, _file_type(attr.st_mode), attr.st_size,
+                              attr.st_mtime)
+            if _mtime_match(entry, min_mtime, max_mtime):
+                yield entry
+
+
+def _mtime_match(entry, min_mtime, max_mtime):
+    if min_mtime is not None and entry.mtime < min_mtime:
+        return False
+    if max_mtime is not None and entry.mtime > max_mtime:
+        return False
+    return True
+
+
+def find(session, top, include=None, exclude=None, min_mtime=None,
+         max_mtime=None, max_depth=None):
+    """
+    Search for files in a directory tree, and return an iterator of
+    :class:`FindEntry` (path, type, size, mtime). The links are not
+    followed, and **top** itself is not part of the results.
+
+    When the session supports it (like :class:`rcontrol.ssh.SshSession`
+    with a GNU find on the remote host), the search is done by one
+    **find** command and its results are streamed back; the iterator
+    should then be consumed or closed. Else the tree is walked with
+    :meth:`BaseSession.walk`.
+
+    :param session: the session to search in
+    :param top: the directory to search in
+    :param include: if not None, a list of glob patterns (like '*.log');
+        only the entries with a name that matches one of them are
+        returned. The directories are searched anyway.
+    :param exclude: if not None, a list of glob patterns; the entries
+        with a name that matches one of them are skipped, and such
+        directories are not searched.
+    :param min_mtime: if not None, only the entries modified at this time
+        (a timestamp) or after are returned.
+    :param max_mtime: if not None, only the entries modified at this time
+        or before are returned.
+    :param max_depth: if not None, the maximum depth of the returned
+        entries (1 for the entries directly in **top**). Nothing is
+        returned if it is lower than 1.
+    """
+    if max_depth is not None and max_depth < 1:
+        return iter([])
+    top = top.rstrip('/') or '/'
+    entries = session._server_find(top, include, exclude, min_mtime,
+                                   max_mtime, max_depth)
+    if entries is None:
+        entries = _walk_find(session, top, include, exclude, min_mtime,
+                             max_mtime, max_depth)
+    return entries
+
+
+class _BroadcastWriter(object):
+    """
+    Write the chunks received in a bounded queue to a destination file,
+    in a dedicated thread.
+    """
+    def __init__(self, session, path, queue_size):
+        self.session = session
+        self.path = path
+        self.bucket = _session_bucket(session)
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.dropped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        data = b''
+        try:
+            with self.session.open(self.path, 'wb') as fw:
+                data = self.queue.get()
+                while data is not None and not self.dropped:
+                    if self.bucket is not None:
+                        self.bucket.consume(len(data))
+                    fw.write(data)
+                    data = self.queue.get()
+        except Exception:
+            self.error = sys.exc_info()[1]
+        # consume what remains so the reader is never blocked by us
+        while data is not None:
+            data = self.queue.get()
+
+    def put(self, data, timeout):
+        try:
+            self.queue.put(data, True, timeout)
+        except Full:
+            self.drop()
+
+    def drop(self):
+        self.dropped = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        self.queue.put(None)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _broadcast(src_session, src, destinations, chunk_size, queue_size,
+               slow_timeout, rate_limit):
+    writers = [_BroadcastWriter(session, path, queue_size)
+               for session, path in destinations]
+    sent_buckets = (rate_limit, _global_bucket)
+    read_buckets = (_session_bucket(src_session),)
+    try:
+        with src_session.open(src, 'rb') as fr:
+            data = fr.read(chunk_size)
+            while data:
+                active = [w for w in writers
+                          if not w.dropped and w.error is None]
+                if not active:
+                    break
+                # the global and per copy limits count the data sent to
+                # each destination
+                _throttle(sent_buckets, len(data) * len(active))
+                _throttle(read_buckets, len(data))
+                # the same chunk object is shared by all the writers
+                for writer in active:
+                    writer.put(data, slow_timeout)
+                data = fr.read(chunk_size)
+    finally:
+        for writer in writers:
+            if not writer.dropped:
+                writer.close()
+    return writers
+
+
+def broadcast_file(src_session, src, destinations, max_parallel=None,
+                   chunk_size=16384, queue_size=64, slow_timeout=10,
+                   rate_limit=None):
+    """
+    Copy one file to many (session, path) destinations, reading each
+    chunk of the source only once.
+
+    Each chunk read is handed to one writer thread per destination
+    through a bounded queue (of **queue_size** chunks). A destination
+    that can not accept a chunk within **slow_timeout** seconds is
+    dropped from the broadcast, and copied later on its own with
+    :func:`copy_file` so that it does not stall the others.
+
+    At most **max_parallel** destinations are written at the same time
+    (the source is then read once per group of destinations).
+
+    The copies obey the bandwidth limits like :func:`copy_file`: the
+    global limit and **rate_limit** count the data sent to each
+    destination, and a destination slowed down by its session limit
+    goes through the retry path.
+
+    Return the list of destinations that went through the retry path.
+    :class:`rcontrol.core.TaskErrors` is raised if some copies failed.
+    """
+    destinations = list(destinations)
+    rate_limit = _bucket(rate_limit)
+    if not max_parallel:
+        max_parallel = len(destinations) or 1
+    errors, slow = [], []
+    for i in range(0, len(destinations), max_parallel):
+        writers = _broadcast(src_session, src,
+                             destinations[i:i + max_parallel],
+                             chunk_size, queue_size, slow_timeout,
+                             rate_limit)
+        for writer in writers:
+            if writer.dropped:
+                slow.append(writer)
+            elif writer.error is not None:
+                errors.append(core.TaskError(writer.session, None,
+                                             writer.error))
+    # retry path for the slow destinations
+    for i in range(0, len(slow), max_parallel):
+        threads = []
+        for writer in slow[i:i + max_parallel]:
+            thread = threading.Thread(target=_retry_copy, args=(
+                src_session, src, writer, chunk_size, rate_limit))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for writer in slow[i:i + max_parallel]:
+            if writer.error is not None:
+                errors.append(core.TaskError(writer.session, None,
+                                             writer.error))
+    if errors:
+        raise core.TaskErrors(errors)
+    return [(w.session, w.path) for w in slow]
+
+
+def _retry_copy(src_session, src, writer, chunk_size, rate_limit):
+    # wait for the dropped writer to release the destination file
+    writer.thread.join()
+    writer.error = None
+    try:
+        copy_file(src_session, src, writer.session, writer.path,
+                  chunk_size=chunk_size, rate_limit=rate_limit)
+    except Exception:
+        writer.error = sys.exc_info()[1]
+
+
+class _RelayNode(object):
+    """
+    A host in a relay distribution (see :func:`distribute_file`).
+    """
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self.attempts = 0
+        self.parent = None
+        # the parents that failed to send the file to this node
+        self.bad_parents = set()
+        # the nodes this node failed to send the file to, and that did
+        # not fail with other parents
+        self.failed_children = set()
+        self.evicted = False
+        # number of copy slots put aside while the node is evicted
+        self.dropped_slots = 0
+
+
+def _relay_copy(parent, node, results, chunk_size, direct, rate_limit):
+    try:
+        parent.session.s_copy_file(parent.path, node.session, node.path,
+                                   chunk_size=chunk_size, direct=direct,
+                                   rate_limit=rate_limit)
+    except Exception:
+        results.put((parent, node, sys.exc_info()[1]))
+    else:
+        results.put((parent, node, None))
+
+
+def _blame(root, parent, node, max_source_failures):
+    """
+    Record that **parent** failed to send the file to **node**, and
+    return the parents that can be used again.
+
+    A node that fails with several parents is the broken side: the
+    parents are not blamed for it. Else the parent is blamed, and
+    evicted once it failed for **max_source_failures** different nodes.
+    """
+    node.attempts += 1
+    reinstated = []
+    if node.attempts > 1:
+        for bad in node.bad_parents:
+            bad.failed_children.discard(node)
+            if bad.evicted and \
+                    len(bad.failed_children) < max_source_failures:
+                bad.evicted = False
+                reinstated.append(bad)
+    elif parent is not root:
+        parent.failed_children.add(node)
+        if len(parent.failed_children) >= max_source_failures:
+            parent.evicted = True
+    if parent is not root:
+        node.bad_parents.add(parent)
+    return reinstated
+
+
+def _next_child(parent, retry, pending):
+    # the nodes to retry first, if this parent did not fail with them
+    for i, node in enumerate(retry):
+        if parent not in node.bad_parents:
+            del retry[i]
+            return node
+    if pending:
+        return pending.popleft()
+    return None
+
+
+def distribute_file(src_session, src, destinations, fanout=2, seeds=None,
+                    retries=2, max_source_failures=2, chunk_size=16384,
+                    direct=None, rate_limit=None):
+    """
+    Copy one file to many (session, path) destinations, using the hosts
+    that already received the file to forward it to the others.
+
+    The source session sends the file to **seeds** hosts at the same
+    time (defaults to **fanout**), then each host that received the
+    file sends it in turn to up to **fanout** other hosts at the same
+    time. The number of copies in flight thus grows exponentially, and
+    the total time grows with log(N) instead of N.
+
+    A failed copy is retried (up to **retries** times) from another
+    parent. A host that fails to forward the file to
+    **max_source_failures** different hosts is not used as a parent
+    anymore; the failures of a host that can not receive the file from
+    several parents are charged to that host only.
+
+    Copies between hosts use :meth:`rcontrol.core.BaseSession.s_copy_file`
+    with **direct** so that the data does not go through this process
+    when possible. The direct copies are not bandwidth limited: by
+    default **direct** is True only if there is no **rate_limit**.
+
+    **rate_limit** is the maximum bandwidth of each copy in bytes per
+    second, or a :class:`TokenBucket` shared by all the copies. The
+    limits of the sessions and the global limit also apply to the copies
+    relayed by this process.
+
+    Return a list of the (session, path) parent of each destination,
+    in the destinations order. :class:`rcontrol.core.TaskErrors` is
+    raised if some destinations could not be reached.
+    """
+    if direct is None:
+        direct = rate_limit is None
+    root = _RelayNode(src_session, src)
+    nodes = [_RelayNode(session, path) for session, path in destinations]
+    # one item per free copy slot of the parents
+    free = deque([root] * (seeds or fanout))
+    # the free slots that none of the nodes to retry can use
+    idle = []
+    pending = deque(nodes)
+    retry = deque()
+    results = Queue()
+    running = 0
+    errors = []
+    while pending or retry or running:
+        # start as many copies as there are free slots
+        while free and (pending or retry):
+            parent = free.popleft()
+            if parent.evicted:
+                parent.dropped_slots += 1
+                continue
+            node = _next_child(parent, retry, pending)
+            if node is None:
+                idle.append(parent)
+                continue
+            running += 1
+            thread = threading.Thread(target=_relay_copy, args=(
+                parent, node, results, chunk_size, direct, rate_limit))
+            thread.daemon = True
+            thread.start()
+        if not running:
+            # no parent left for the remaining nodes
+            for node in list(retry) + list(pending):
+                errors.append(core.TaskError(node.session, None,
+                                             'no parent left to copy from'))
+            break
+        parent, node, error = results.get()
+        running -= 1
+        if parent.evicted:
+            parent.dropped_slots += 1
+        else:
+            free.append(parent)
+        if error is None:
+            node.parent = parent
+            free.extend([node] * fanout)
+            continue
+        for bad in _blame(root, parent, node, max_source_failures):
+            free.extend([bad] * bad.dropped_slots)
+            bad.dropped_slots = 0
+        if node.attempts > retries:
+            errors.append(core.TaskError(node.session, None, error))
+        else:
+            retry.append(node)
+            # the idle slots may be usable for this node
+            free.extend(idle)
+            del idle[:]
+    if errors:
+        raise core.TaskErrors(errors)
+    return [(node.parent.session, node.parent.path) for node in nodes]
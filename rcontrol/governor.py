@@ -0,0 +1,293 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from contextlib import contextmanager
+
+from rcontrol.scheduling import FairQueue
+
+# the resources used by the tasks
+RESOURCES = ('threads', 'channels', 'fds')
+
+
+class _Waiter(object):
+    def __init__(self, host, counts):
+        self.host = host
+        self.counts = counts
+        self.granted = False
+        self.event = threading.Event()
+
+
+class ResourceGovernor(object):
+    """
+    Limit the resources used by the tasks of all the sessions: the
+    threads, the ssh channels and the local file descriptors.
+
+    Once installed with :func:`set_governor`, the tasks reserve what they
+    need before starting, and wait if a limit would be exceeded. The
+    resources are released when the tasks are done.
+
+    The waiting tasks are served fairly across their groups (by default,
+    one group per host; see :class:`rcontrol.scheduling.FairQueue`), and
+    by priority within a group, so that a host or a tenant with a lot of
+    background tasks does not delay the others. A waiting task that
+    does not fit the global limits blocks the ones behind it, so that big
+    requests are not starved; a task that only exceeds the limits of its
+    host blocks the other tasks of this host only.
+
+    The tasks started from a thread that already holds resources (a
+    :class:`rcontrol.core.ThreadableTask` or the output callbacks of a
+    command) do not wait, to avoid deadlocks; they are still counted.
+
+    Note that the sftp subsystem and the persistent shells of ssh
+    sessions also use a channel, which is not counted here: keep the
+    per host channel limit under the sshd MaxSessions setting (10 by
+    default) accordingly.
+
+    :param limits: a dict of resource name ('threads', 'channels' or
+        'fds') to the maximum total usage.
+    :param host_limits: a dict of resource name to the maximum usage for
+        one host (one session).
+    :param weights: a dict of group to weight, for the fair scheduling
+        of the waiting tasks.
+    """
+    def __init__(self, limits=None, host_limits=None, weights=None):
+        self.limits = dict(limits or {})
+        self.host_limits = dict(host_limits or {})
+        for name in list(self.limits) + list(self.host_limits):
+            if name not in RESOURCES:
+                raise ValueError('unknown resource: %r' % name)
+        self._lock = threading.Lock()
+        self._usage = dict((name, 0) for name in RESOURCES)
+        self._host_usage = {}
+        self._waiters = FairQueue(weights)
+        self._local = threading.local()
+        self._stats = dict(
+            (name, dict(acquired=0, waits=0, wait_time=0.0, max_wait=0.0,
+                        peak=0))
+            for name in RESOURCES)
+
+    def set_limit(self, resource, limit, per_host=False):
+        """
+        Change the limit of a resource (None for no limit).
+        """
+        if resource not in RESOURCES:
+            raise ValueError('unknown resource: %r' % resource)
+        limits = self.host_limits if per_host else self.limits
+        with self._lock:
+            if limit is None:
+                limits.pop(resource, None)
+            else:
+                limits[resource] = limit
+            self._grant_waiters()
+
+    def set_weight(self, group, weight):
+        """
+        Change the weight of a group of waiting tasks (1 by default).
+        """
+        with self._lock:
+            self._waiters.set_weight(group, weight)
+
+    def _exceeded(self, host, counts):
+        # return None if the request fits, else 'global' or 'host' for
+        # the kind of limit it exceeds
+        host_usage = self._host_usage.get(host, {})
+        exceeded = None
+        for name, count in counts.items():
+            limit = self.limits.get(name)
+            if limit is not None and self._usage[name] + count > limit \
+                    and self._usage[name] > 0:
+                return 'global'
+            limit = self.host_limits.get(name)
+            if limit is not None and host is not None:
+                used = host_usage.get(name, 0)
+                if used + count > limit and used > 0:
+                    exceeded = 'host'
+        return exceeded
+
+    def _take(self, host, counts):
+        host_usage = self._host_usage.setdefault(host, {})
+        for name, count in counts.items():
+            self._usage[name] += count
+            host_usage[name] = host_usage.get(name, 0) + count
+            stats = self._stats[name]
+            stats['acquired'] += count
+            stats['peak'] = max(stats['peak'], self._usage[name])
+
+    def _next_waiter(self):
+        # return the first waiter that fits, skipping the hosts whose
+        # first waiter exceeds the host limits, or None
+        blocked_hosts = set()
+        for waiter in self._waiters:
+            if waiter.host in blocked_hosts:
+                continue
+            exceeded = self._exceeded(waiter.host, waiter.counts)
+            if exceeded is None:
+                return waiter
+            if exceeded == 'global':
+                # big requests must not be starved
+                return None
+            blocked_hosts.add(waiter.host)
+        return None
+
+    def _grant_waiters(self):
+        while self._waiters:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self._waiters.pop(waiter)
+            self._take(waiter.host, waiter.counts)
+            waiter.granted = True
+            waiter.event.set()
+
+    def is_nested(self):
+        """
+        Return True if the current thread holds resources (see
+        :meth:`nested`).
+        """
+        return getattr(self._local, 'depth', 0) > 0
+
+    @contextmanager
+    def nested(self):
+        """
+        A context manager that marks the current thread as holding
+        resources: the reservations made inside do not wait.
+        """
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+
+    def acquire(self, host=None, timeout=None, priority=0, group=None,
+                **counts):
+        """
+        Reserve resources, waiting until they are available. Return True
+        on success, or False if the timeout is elapsed.
+
+        A request is always granted when nothing of the limited resources
+        is used, even if it is bigger than the limit.
+
+        :param host: the host the resources are used for, for the per
+            host limits.
+        :param timeout: maximum time to wait in seconds, or None.
+        :param priority: the priority of the request in its group: the
+            highest priorities are served first.
+        :param group: the fairness group of the request. Defaults to the
+            host.
+        :param counts: the number of each resource, e.g. channels=1.
+        """
+        counts = dict((n, c) for n, c in counts.items() if c)
+        for name in counts:
+            if name not in RESOURCES:
+                raise ValueError('unknown resource: %r' % name)
+        with self._lock:
+            if self.is_nested():
+                self._take(host, counts)
+                return True
+            waiter = _Waiter(host, counts)
+            self._waiters.push(waiter, host if group is None else group,
+                               priority)
+            self._grant_waiters()
+            if waiter.granted:
+                return True
+        start = time.time()
+        waiter.event.wait(timeout)
+        waited = time.time() - start
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                # the waiters behind may fit now
+                self._grant_waiters()
+            for name in counts:
+                stats = self._stats[name]
+                stats['waits'] += 1
+                stats['wait_time'] += waited
+                stats['max_wait'] = max(stats['max_wait'], waited)
+            return waiter.granted
+
+    def release(self, host=None, **counts):
+        """
+        Release resources reserved with :meth:`acquire`.
+        """
+        with self._lock:
+            host_usage = self._host_usage.get(host, {})
+            for name, count in counts.items():
+                if not count:
+                    continue
+                self._usage[name] -= count
+                host_usage[name] = host_usage.get(name, 0) - count
+            if not any(host_usage.values()):
+                self._host_usage.pop(host, None)
+            self._grant_waiters()
+
+    @contextmanager
+    def reserve(self, host=None, priority=0, group=None, **counts):
+        """
+        A context manager that acquires resources for the duration of
+        the block.
+        """
+        self.acquire(host, priority=priority, group=group, **counts)
+        try:
+            with self.nested():
+                yield
+        finally:
+            self.release(host, **counts)
+
+    def usage(self):
+        """
+        Return the current usage, as a dict with a 'total' key (a dict of
+        resource name to usage), a 'hosts' key (a dict of host to a dict
+        of resource name to usage) and a 'waiting' key (the number of
+        reservations waiting).
+        """
+        with self._lock:
+            return {
+                'total': dict(self._usage),
+                'hosts': dict((h, dict(u))
+                              for h, u in self._host_usage.items()),
+                'waiting': len(self._waiters),
+            }
+
+    def stats(self):
+        """
+        Return a dict of resource name to counters: 'acquired' (total
+        reserved), 'waits' (number of reservations that had to wait),
+        'wait_time' (total time waited in seconds), 'max_wait' and 'peak'
+        (maximum usage).
+        """
+        with self._lock:
+            return dict((name, dict(stats))
+                        for name, stats in self._stats.items())
+
+
+_governor = None
+
+
+def set_governor(governor):
+    """
+    Install a process-wide :class:`ResourceGovernor` (or None to remove
+    it). The tasks created after this call use it.
+    """
+    global _governor
+    _governor = governor
+
+
+def get_governor():
+    """
+    Return the installed :class:`ResourceGovernor`, or None.
+    """
+    return _governor
@@ -13,24 +13,31 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import subprocess
 import os
+import shutil
+import signal
 import six
 
 from rcontrol.streamreader import StreamsReader
 from rcontrol.core import CommandTask, BaseSession
+from rcontrol.shell import PersistentShell
 
 
 class ProcessReader(StreamsReader):
     """
     Specialized reader for subprocess.Popen instances.
     """
+    __slots__ = ()
+
     def _create_readers(self, queue, proc):
         stdout_reader = None
         if proc.stdout:
             stdout_reader = self._create_stream_reader(proc.stdout,
                                                        queue,
-                                                       self.stdout_callback)
+                                                       self.stdout_callback,
+                                                       raw=self.raw_stdout)
         stderr_reader = None
         if proc.stderr and proc.stderr != proc.stdout:
             stderr_reader = self._create_stream_reader(proc.stderr,
@@ -39,6 +46,40 @@ class ProcessReader(StreamsReader):
         return stdout_reader, stderr_reader
 
 
+def _argv_popen_args(argv):
+    """
+    Return the (args, kwargs) to give to subprocess.Popen to execute a
+    list of arguments without a shell.
+    """
+    argv = list(argv)
+    if not six.PY3:
+        return argv, {}
+    # With python 3, the pipes are not inherited by the child processes,
+    # so there is no need to close the file descriptors. This, and an
+    # absolute path for the executable, allows subprocess to use
+    # posix_spawn (or vfork) which is cheaper than a fork of this process.
+    return argv, dict(close_fds=False,
+                      executable=shutil.which(argv[0]) or argv[0])
+
+
+def _descendants(pid):
+    """
+    Return the pids of the processes started by a process and by its
+    children, if the system tells them (only on linux); else an empty
+    list.
+    """
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except (IOError, OSError, ValueError):
+        return []
+    pids = []
+    for child in children:
+        pids.append(child)
+        pids.extend(_descendants(child))
+    return pids
+
+
 class LocalExec(CommandTask):
     """
     Execute a local command.
@@ -50,16 +91,57 @@ class LocalExec(CommandTask):
 
     :param session: instance of the :class:`LocalSession` responsible of
         this command execution
-    :param command: the command to execute (a string)
+    :param command: the command to execute. If this is a string, it is
+        run by the shell; else it must be a list of arguments (argv),
+        and the program is executed directly, which is faster.
     :param kwargs: list of argument passed to the base class constructor
     """
+    __slots__ = ('_proc',)
+
     def __init__(self, session, command, **kwargs):
         CommandTask.__init__(self, session, ProcessReader, command, **kwargs)
+        stdin = subprocess.PIPE if self._stdin is not None else None
         stdout = subprocess.PIPE
         stderr = subprocess.STDOUT if self._combine_stderr else subprocess.PIPE
-        self._proc = subprocess.Popen(command, shell=True, stdout=stdout,
-                                      stderr=stderr)
+        if isinstance(command, six.string_types):
+            popen_kwargs = dict(shell=True)
+        else:
+            command, popen_kwargs = _argv_popen_args(command)
+        # the pipes and the threads reading and writing them
+        pipes = (1 + (not self._combine_stderr) +
+                 (self._stdin is not None))
+        self._reserve(fds=pipes,
+                      threads=pipes + 1 - (self._stdin is True))
+        try:
+            self._proc = subprocess.Popen(command, stdin=stdin, stdout=stdout,
+                                          stderr=stderr, **popen_kwargs)
+        except OSError:
+            # the command was not started: forget about the task
+            self._release()
+            self.session._unregister_task(self)
+            raise
         self._reader.start(self._proc)
+        self._start_stdin()
+
+    def _kill(self):
+        # the processes started by a shell would keep the output open
+        pids = _descendants(self._proc.pid)
+        try:
+            self._proc.kill()
+        except OSError:
+            pass  # already finished
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _write_stdin(self, data):
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+
+    def _close_stdin(self):
+        self._proc.stdin.close()
 
     def _on_finished(self):
         if not self.timed_out():
@@ -67,6 +149,28 @@ class LocalExec(CommandTask):
         CommandTask._on_finished(self)
 
 
+class LocalShell(PersistentShell):
+    """
+    A :class:`PersistentShell` running in a local /bin/sh process.
+    """
+    def _start(self):
+        self._proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        return self._proc.stdout, self._proc.stderr
+
+    def _write(self, data):
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+
+    def _stop(self):
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass  # the shell is already gone
+        self._proc.wait()
+
+
 @six.python_2_unicode_compatible
 class LocalSession(BaseSession):
     """
@@ -75,18 +179,49 @@ class LocalSession(BaseSession):
     def __str__(self):
         return "<LocalSession>"
 
+    def host_name(self):
+        return self.name or 'localhost'
+
     def open(self, filename, mode='r', bufsize=-1):
         return open(filename, mode=mode)
 
     def execute(self, command, **kwargs):
         return LocalExec(self, command, **kwargs)
 
+    def _create_shell(self):
+        return LocalShell(self)
+
     def walk(self, top, topdown=True, onerror=None, followlinks=False):
-        os.walk(top, topdown=topdown, onerror=onerror, followlinks=followlinks)
+        return os.walk(top, topdown=topdown, onerror=onerror,
+                       followlinks=followlinks)
 
     def mkdir(self, path):
         os.mkdir(path)
 
+    def makedirs(self, path, exist_ok=True):
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if not (exist_ok and exc.errno == errno.EEXIST and
+                    os.path.isdir(path)):
+                raise
+
+    def apply_fs_ops(self, ops):
+        for op in ops:
+            name, args = op[0], op[1:]
+            if name == 'mkdir':
+                os.mkdir(*args)
+            elif name == 'chmod':
+                os.chmod(*args)
+            elif name == 'rename':
+                os.rename(*args)
+            elif name == 'unlink':
+                os.unlink(*args)
+            elif name == 'symlink':
+                os.symlink(*args)
+            else:
+                raise ValueError('unknown file system operation: %r' % name)
+
     def exists(self, path):
         return os.path.exists(path)
 
@@ -95,3 +230,8 @@ class LocalSession(BaseSession):
 
     def isdir(self, path):
         return os.path.isdir(path)
+
+    def stat(self, path, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(path)
+        return os.lstat(path)
@@ -0,0 +1,223 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+# the flags of a pattern without inline global flags such as (?i)
+_DEFAULT_FLAGS = {
+    bytes: re.compile(b'').flags,
+    type(u''): re.compile(u'').flags,
+}
+
+
+class _Pattern(object):
+    def __init__(self, pattern, plain):
+        self.pattern = pattern
+        self.plain = plain
+        self.callbacks = []
+        self.match = None
+        self._compiled = {}
+
+    def regex(self, kind):
+        """
+        Return the regular expression source, as text or bytes (**kind**).
+        """
+        source = re.escape(self.pattern) if self.plain else self.pattern
+        if kind is bytes and not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        elif kind is not bytes and isinstance(source, bytes):
+            source = source.decode('utf-8')
+        return source
+
+    def compiled(self, kind):
+        try:
+            return self._compiled[kind]
+        except KeyError:
+            regex = self._compiled[kind] = re.compile(self.regex(kind))
+            return regex
+
+    def combinable(self, kind):
+        """
+        Return True if the pattern can be part of an alternation with
+        other patterns: it must not have groups (their numbers would
+        shift and break the backreferences) nor inline global flags.
+        """
+        regex = self.compiled(kind)
+        return regex.groups == 0 and regex.flags == _DEFAULT_FLAGS[kind]
+
+
+class OutputMatcher(object):
+    """
+    Match lines of output against many patterns at once.
+
+    The patterns without groups nor inline global flags - e.g. the plain
+    strings - are compiled in one regular expression (an alternation),
+    so that a line that matches none of them - the common case - is
+    rejected with only one search. The other patterns are searched one
+    by one.
+
+    Lines can be text or bytes; the patterns are converted as needed.
+
+    The last **history** lines are kept until :meth:`finish` is called,
+    so that a pattern registered late still sees them (see :meth:`wait`).
+    Until a pattern is registered, feeding a line only adds it there,
+    without taking the lock.
+
+    An exception raised while matching a line (e.g. by a callback) does
+    not stop the matching of the next lines; the first one is kept in
+    the **error** attribute.
+    """
+    def __init__(self, history=100):
+        self._cond = threading.Condition()
+        self._patterns = OrderedDict()
+        self._combined = {}
+        self._history = deque(maxlen=history)
+        self._finished = False
+        self.error = None
+
+    def add(self, pattern, callback=None, plain=False):
+        """
+        Register a pattern. If the pattern is new, the first of the
+        recent lines that matches it is recorded as its match (see
+        :meth:`wait`), but the callback is only called for the next
+        lines.
+
+        :param pattern: a regular expression, or a plain string if
+            **plain** is True. An invalid regular expression raises
+            :class:`re.error`.
+        :param callback: if not None, a callable called with the match
+            object for each line that matches the pattern.
+        """
+        with self._cond:
+            key = (pattern, plain)
+            entry = self._patterns.get(key)
+            if entry is None:
+                entry = _Pattern(pattern, plain)
+                entry.compiled(type(pattern))
+                # registered before looking at the history: a line fed
+                # meanwhile is either in the history or matched by feed
+                self._patterns[key] = entry
+                self._combined = {}
+                for line in list(self._history or ()):
+                    match = entry.compiled(_kind(line)).search(line)
+                    if match:
+                        entry.match = match
+                        break
+            if callback is not None:
+                entry.callbacks.append(callback)
+            return entry
+
+    def _split_patterns(self, kind):
+        # return the combined regex (or None) and the patterns that must
+        # be searched alone
+        try:
+            return self._combined[kind]
+        except KeyError:
+            pass
+        combined, alone = [], []
+        for entry in self._patterns.values():
+            (combined if entry.combinable(kind) else alone).append(entry)
+        regex = None
+        if combined:
+            regex = re.compile((b'|' if kind is bytes else u'|').join(
+                (b'(?:%s)' if kind is bytes else u'(?:%s)') % p.regex(kind)
+                for p in combined))
+        result = self._combined[kind] = (regex, combined, alone)
+        return result
+
+    def feed(self, line):
+        """
+        Match a line against the registered patterns, calling the
+        callbacks of the patterns that match.
+        """
+        try:
+            self._feed(line)
+        except Exception as exc:
+            with self._cond:
+                if self.error is None:
+                    self.error = exc
+                    self._cond.notify_all()
+
+    def _feed(self, line):
+        history = self._history
+        if history is not None:
+            history.append(line)
+        if not self._patterns:
+            return
+        kind = _kind(line)
+        with self._cond:
+            regex, combined, alone = self._split_patterns(kind)
+            candidates = alone
+            if regex is not None and regex.search(line):
+                candidates = combined + alone
+            matches = []
+            for entry in candidates:
+                match = entry.compiled(kind).search(line)
+                if match:
+                    matches.append((entry, match))
+                    if entry.match is None:
+                        entry.match = match
+                        self._cond.notify_all()
+        for entry, match in matches:
+            for callback in entry.callbacks:
+                callback(match)
+
+    def finish(self):
+        """
+        Notify that there is no more output to match. The lines kept
+        for late patterns are dropped.
+        """
+        with self._cond:
+            self._finished = True
+            self._history = None
+            self._cond.notify_all()
+
+    def is_finished(self):
+        """
+        Return True if :meth:`finish` has been called.
+        """
+        return self._finished
+
+    def wait(self, pattern, timeout=None, plain=False):
+        """
+        Wait until a line matches the pattern and return the first match
+        object. The pattern is registered if it was not already, and a
+        match that happened before - or in the recent lines, until
+        :meth:`finish` is called - is returned immediately.
+
+        Return None if the output is finished without a match, if the
+        timeout is elapsed, or if the matching failed (see **error**).
+        """
+        entry = self.add(pattern, plain=plain)
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._cond:
+            while (entry.match is None and not self._finished and
+                   self.error is None):
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return entry.match
+
+
+def _kind(line):
+    return bytes if isinstance(line, bytes) else type(u'')
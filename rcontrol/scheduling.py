@@ -0,0 +1,155 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+
+
+class FairQueue(object):
+    """
+    A queue shared by groups (e.g. sessions or tenants), weighted-fair
+    across the groups and ordered by priority within a group.
+
+    Each group gets a share of the items popped proportional to its
+    weight (1 by default) while it has items waiting, whatever the number
+    of items the other groups pushed. A group that was idle does not get
+    credit for the time it did not use. Within a group, the items with
+    the highest priority are popped first, then in the order they were
+    pushed.
+
+    This class is not thread safe.
+
+    :param weights: a dict of group to weight.
+    """
+    def __init__(self, weights=None):
+        self.weights = dict(weights or {})
+        # group -> heap of (-priority, seq, item)
+        self._groups = {}
+        # group -> virtual time of the next item of the group
+        self._vtimes = {}
+        # virtual time of the last item popped
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._len = 0
+
+    def set_weight(self, group, weight):
+        """
+        Change the weight of a group.
+        """
+        if weight <= 0:
+            raise ValueError('the weight must be positive')
+        self.weights[group] = weight
+
+    def push(self, item, group=None, priority=0):
+        """
+        Add an item.
+        """
+        heap = self._groups.get(group)
+        if heap is None:
+            heap = self._groups[group] = []
+            self._vtimes[group] = max(self._vtimes.get(group, 0.0),
+                                      self._vtime)
+        heapq.heappush(heap, (-priority, next(self._seq), item))
+        self._len += 1
+
+    def _next_group(self):
+        if not self._len:
+            raise IndexError('the queue is empty')
+        # ties are broken by the order the items were pushed
+        return min(self._groups,
+                   key=lambda g: (self._vtimes[g], self._groups[g][0][1]))
+
+    def peek(self):
+        """
+        Return the next item, without removing it. Raise IndexError if
+        the queue is empty.
+        """
+        return self._groups[self._next_group()][0][2]
+
+    def __iter__(self):
+        """
+        Iterate over the items in the order they would be popped. The
+        queue must not be changed during the iteration.
+        """
+        heads = []
+        for group, heap in self._groups.items():
+            entries = _sorted_entries(heap)
+            entry = next(entries)
+            heads.append((self._vtimes[group], entry[1], entry, group,
+                          entries))
+        heapq.heapify(heads)
+        while heads:
+            vtime, _, entry, group, entries = heapq.heappop(heads)
+            yield entry[2]
+            entry = next(entries, None)
+            if entry is not None:
+                vtime += 1.0 / self.weights.get(group, 1)
+                heapq.heappush(heads, (vtime, entry[1], entry, group,
+                                       entries))
+
+    def pop(self, item=None):
+        """
+        Remove and return the next item, or **item** if given (e.g.
+        when the items before it can not be used yet); in both cases the
+        item counts in the share of its group. Raise IndexError if the
+        queue is empty, or ValueError if **item** is not in the queue.
+        """
+        if item is None:
+            group = self._next_group()
+            heap = self._groups[group]
+            item = heapq.heappop(heap)[2]
+        else:
+            group, heap = self._remove(item)
+        self._len -= 1
+        self._vtime = max(self._vtime, self._vtimes[group])
+        self._vtimes[group] += 1.0 / self.weights.get(group, 1)
+        if not heap:
+            del self._groups[group]
+        # forget the idle groups that are not ahead anymore
+        for idle in [g for g, vtime in self._vtimes.items()
+                     if vtime <= self._vtime and g not in self._groups]:
+            del self._vtimes[idle]
+        return item
+
+    def remove(self, item):
+        """
+        Remove an item. Raise ValueError if it is not in the queue.
+        """
+        group, heap = self._remove(item)
+        self._len -= 1
+        if not heap:
+            del self._groups[group]
+
+    def _remove(self, item):
+        # remove an item from the heap of its group, and return both
+        for group, heap in self._groups.items():
+            for i, entry in enumerate(heap):
+                if entry[2] is item:
+                    heap[i] = heap[-1]
+                    heap.pop()
+                    heapq.heapify(heap)
+                    return group, heap
+        raise ValueError('item not in the queue')
+
+    def __len__(self):
+        return self._len
+
+
+def _sorted_entries(heap):
+    # the entries of a heap in order, sorted only if more than the first
+    # one is needed
+    yield heap[0]
+    for entry in sorted(heap)[1:]:
+        yield entry
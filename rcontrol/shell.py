@@ -0,0 +1,436 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import uuid
+from collections import deque
+import six
+from six.moves import shlex_quote
+
+from rcontrol.streamreader import StreamsReader
+from rcontrol.core import CommandTask, TaskError
+
+
+class _Feed(object):
+    """
+    A pseudo stream reader, fed with lines read elsewhere.
+
+    It looks like a reader thread to :class:`StreamsReader`.
+    """
+    def __init__(self, queue, callback):
+        self.queue = queue
+        self.callback = callback
+        self._done = threading.Event()
+
+    def put(self, line):
+        self.queue.put((line.rstrip(), self.callback))
+
+    def close(self):
+        self._done.set()
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+
+class FeedReader(StreamsReader):
+    """
+    Specialized reader for lines that are demultiplexed from a shared
+    stream, like the output of a :class:`PersistentShell`.
+
+    Lines are given with the **stdout_feed** and **stderr_feed**
+    attributes once the reader is started. The timeouts only start when
+    :meth:`begin` is called, as the command may wait for the previous
+    ones.
+    """
+    __slots__ = ('stdout_feed', 'stderr_feed', '_begun')
+
+    def _create_readers(self, queue):
+        self._begun = threading.Event()
+        self.stdout_feed = _Feed(queue, self.stdout_callback)
+        self.stderr_feed = _Feed(queue, self.stderr_callback)
+        return self.stdout_feed, self.stderr_feed
+
+    def begin(self):
+        """
+        Notify that the command begins.
+        """
+        self._begun.set()
+
+    def _read_lines(self, stdout_reader, stderr_reader, queue):
+        self._begun.wait()
+        return StreamsReader._read_lines(self, stdout_reader, stderr_reader,
+                                         queue)
+
+
+class ShellExec(CommandTask):
+    """
+    A command which output is demultiplexed from a shared stream.
+
+    Instances are created by :meth:`PersistentShell.execute`.
+
+    :param session: the session responsible of this command execution
+    :param command: the command to execute (a string)
+    :param kwargs: list of argument passed to the base class constructor
+    """
+    __slots__ = ('command', '_aborted')
+
+    def __init__(self, session, command, **kwargs):
+        if kwargs.get('stdin') is not None:
+            raise ValueError('stdin is not supported for shell commands')
+        CommandTask.__init__(self, session, FeedReader, command, **kwargs)
+        self.command = command
+        self._aborted = None
+        self._reader.start()
+
+    def _feed_stdout(self, line):
+        self._reader.stdout_feed.put(line)
+
+    def _feed_stderr(self, line):
+        self._reader.stderr_feed.put(line)
+
+    def _end_stdout(self, exit_code):
+        self._set_exit_code(exit_code)
+        self._reader.stdout_feed.close()
+
+    def _end_stderr(self):
+        self._reader.stderr_feed.close()
+
+    def _begin(self):
+        self._reader.begin()
+
+    def _abort(self, msg):
+        self._aborted = msg
+        self._reader.stdout_feed.close()
+        self._reader.stderr_feed.close()
+        self._reader.begin()
+
+    def error(self):
+        """
+        Return an instance of Exception if any, else None.
+
+        In addition to the errors of a :class:`CommandTask`, a
+        :class:`TaskError` is returned if the command could not finish
+        because the underlying shell is gone.
+        """
+        if self._aborted and not self.timed_out():
+            return TaskError(self.session, self, self._aborted)
+        return CommandTask.error(self)
+
+
+def command_script(token, command, combine_stderr):
+    """
+    Return the shell code that run a command and then write end markers
+    on stdout (with the exit code) and stderr.
+
+    The command is evaluated in a subshell, so it can not change the
+    state of (or exit) the shell that runs it, and with stdin
+    redirected from /dev/null.
+    """
+    return ('( eval %s ) </dev/null%s\n'
+            'printf "%%s %%s\\n" %s "$?"\n'
+            'printf "%%s\\n" %s >&2\n') % (
+                shlex_quote(command), ' 2>&1' if combine_stderr else '',
+                token, token)
+
+
+def concurrent_batch_script(token, commands):
+    """
+    Return the shell code that run the given commands concurrently, and
+    then write their outputs one after the other, each followed by end
+    markers like in :func:`command_script`.
+
+    :param commands: a list of (command, combine_stderr) tuples.
+    """
+    script = ['d=$(mktemp -d) || exit 1\n']
+    for i, (command, combine_stderr) in enumerate(commands):
+        stderr = '2>&1' if combine_stderr else '2>"$d/%d.err"' % i
+        script.append('( eval %s ) </dev/null >"$d/%d.out" %s & p%d=$!\n'
+                      % (shlex_quote(command), i, stderr, i))
+    for i in range(len(commands)):
+        script.append(
+            'wait $p%(i)d; c=$?; cat "$d/%(i)d.out"\n'
+            'printf "%%s %%s\\n" %(token)s "$c"\n'
+            '[ ! -f "$d/%(i)d.err" ] || cat "$d/%(i)d.err" >&2\n'
+            'printf "%%s\\n" %(token)s >&2\n' % {'i': i, 'token': token})
+    script.append('rm -rf "$d"\n')
+    return ''.join(script)
+
+
+class Demultiplexer(object):
+    """
+    Dispatch the lines read from shared stdout and stderr streams to
+    the :class:`ShellExec` tasks, in order.
+
+    Each stream is read up to an end marker (a line containing
+    **token**) for the first task, then the next task, and so on.
+
+    Once :meth:`start` is called, the tasks are notified when their
+    command begins, so that their timeouts start then: when the previous
+    task is finished, or right away if **concurrent** is True.
+    """
+    def __init__(self, token, concurrent=False):
+        self.token = token
+        self.btoken = token.encode('ascii')
+        self.concurrent = concurrent
+        self._lock = threading.Lock()
+        self._stdout_tasks = deque()
+        self._stderr_tasks = deque()
+        self._aborted = None
+        self._started = False
+        # the tasks which output was read before start was called
+        self._ended = []
+
+    def start(self):
+        """
+        Notify that the commands are run.
+        """
+        with self._lock:
+            self._started = True
+            ended, self._ended = self._ended, []
+            tasks = list(self._stdout_tasks)
+        for task in ended + (tasks if self.concurrent else tasks[:1]):
+            task._begin()
+
+    def add(self, task):
+        with self._lock:
+            if self._aborted is None:
+                self._stdout_tasks.append(task)
+                self._stderr_tasks.append(task)
+                begin = self._started and (
+                    self.concurrent or len(self._stdout_tasks) == 1)
+            else:
+                begin = None
+        if begin is None:
+            task._abort(self._aborted)
+        elif begin:
+            task._begin()
+
+    def _split(self, line):
+        token = self.btoken if isinstance(line, bytes) else self.token
+        index = line.find(token)
+        if index == -1:
+            return line, None
+        return line[:index], line[index + len(token):]
+
+    def stdout_line(self, line):
+        line, marker = self._split(line)
+        following = None
+        with self._lock:
+            if not self._stdout_tasks:
+                return
+            task = self._stdout_tasks[0]
+            if marker is not None:
+                self._stdout_tasks.popleft()
+                if not self._started:
+                    self._ended.append(task)
+                elif self._stdout_tasks and not self.concurrent:
+                    following = self._stdout_tasks[0]
+        if line:
+            task._feed_stdout(line)
+        if marker is not None:
+            task._end_stdout(int(marker.strip()))
+        if following is not None:
+            following._begin()
+
+    def stderr_line(self, line):
+        line, marker = self._split(line)
+        with self._lock:
+            if not self._stderr_tasks:
+                return
+            task = self._stderr_tasks[0]
+            if marker is not None:
+                self._stderr_tasks.popleft()
+        if line:
+            task._feed_stderr(line)
+        if marker is not None:
+            task._end_stderr()
+
+    def abort(self, msg):
+        """
+        Abort the pending tasks, and the tasks added later.
+        """
+        with self._lock:
+            self._aborted = msg
+            ended, self._ended = self._ended, []
+            tasks = set(self._stdout_tasks) | set(self._stderr_tasks)
+            self._stdout_tasks.clear()
+            self._stderr_tasks.clear()
+        for task in ended:
+            if task not in tasks:
+                task._begin()
+        for task in tasks:
+            task._abort(msg)
+
+
+class PersistentShell(object):
+    """
+    Execute commands in one long-lived shell.
+
+    This avoids the cost of starting a new process (or opening a new
+    ssh channel) for each command, which matters when running a lot of
+    short commands. The commands are queued and run one at a time, in
+    order; each one returns a :class:`ShellExec` task that behaves like
+    any other :class:`CommandTask`.
+
+    Each command runs in a subshell: it can not change the directory or
+    the environment of the next commands. Note that a command that
+    timed out still blocks the next ones until it is finished.
+
+    Subclasses must implement :meth:`_start`, :meth:`_write` and
+    :meth:`_stop`. Instances are usually created with
+    :meth:`BaseSession.open_shell`.
+
+    :param session: the session that runs the shell
+    """
+    def __init__(self, session):
+        self.session = session
+        self._token = '__rcontrol_%s__' % uuid.uuid4().hex
+        self._demux = Demultiplexer(self._token)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._open_streams = 2
+        stdout, stderr = self._start()
+        self._demux.start()
+        self._readers = [
+            self._start_reader(stdout, self._demux.stdout_line),
+            self._start_reader(stderr, self._demux.stderr_line),
+        ]
+
+    def _start_reader(self, stream, callback):
+        thread = threading.Thread(target=self._read_stream,
+                                  args=(stream, callback))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _read_stream(self, stream, callback):
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            callback(line)
+        stream.close()
+        with self._lock:
+            self._open_streams -= 1
+            terminated = not self._open_streams
+        if terminated:
+            self._demux.abort('shell terminated')
+
+    def _start(self):
+        """
+        Start the shell and return its (stdout, stderr) streams.
+        """
+        raise NotImplementedError
+
+    def _write(self, data):
+        """
+        Write bytes to the shell stdin.
+        """
+        raise NotImplementedError
+
+    def _stop(self):
+        """
+        Close the shell stdin and wait for the shell to exit.
+        """
+        raise NotImplementedError
+
+    def execute(self, command, **kwargs):
+        """
+        Queue a command and return the :class:`ShellExec` task.
+
+        :param command: the command to execute (a string)
+        :param kwargs: named arguments passed to the :class:`CommandTask`
+            constructor.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError('the shell is closed')
+            task = ShellExec(self.session, command, **kwargs)
+            self._demux.add(task)
+            script = command_script(self._token, command,
+                                    task._combine_stderr)
+            try:
+                self._write(script.encode('utf-8'))
+            except (IOError, OSError, EOFError) as exc:
+                self._demux.abort('unable to write to the shell: %s' % exc)
+        return task
+
+    def close(self):
+        """
+        Close the shell, once the queued commands are finished.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._stop()
+        for reader in self._readers:
+            reader.join()
+
+
+def execute_batch(session, commands, concurrent=False, **kwargs):
+    """
+    Execute many commands with only one command execution on the
+    session, and return the list of the :class:`ShellExec` tasks, one
+    per command.
+
+    :param session: the session that runs the commands
+    :param commands: a list of commands. Each item is either a string,
+        or a tuple (command, kwargs) to give specific arguments (like
+        **expected_exit_code**) to the command task.
+    :param concurrent: if True, the commands run concurrently on the
+        remote side. Their output is then reported once each command
+        (and the commands before it) are finished.
+    :param kwargs: named arguments passed to all the :class:`ShellExec`
+        tasks. The **timeout** of a task starts when its command begins.
+    """
+    token = '__rcontrol_%s__' % uuid.uuid4().hex
+    demux = Demultiplexer(token, concurrent=concurrent)
+    tasks = []
+    for item in commands:
+        if isinstance(item, six.string_types):
+            command, options = item, {}
+        else:
+            command, options = item
+        task_kwargs = dict(kwargs)
+        task_kwargs.update(options)
+        task = ShellExec(session, command, **task_kwargs)
+        demux.add(task)
+        tasks.append(task)
+
+    if concurrent:
+        script = concurrent_batch_script(
+            token, [(t.command, t._combine_stderr) for t in tasks])
+    else:
+        script = ''.join(command_script(token, t.command, t._combine_stderr)
+                         for t in tasks)
+
+    def on_done(task):
+        demux.abort('batch execution terminated')
+
+    try:
+        session.execute(script, combine_stderr=False, expected_exit_code=None,
+                        output_sink=False,
+                        on_stdout=lambda t, line: demux.stdout_line(line),
+                        on_stderr=lambda t, line: demux.stderr_line(line),
+                        on_finished=on_done, on_timeout=on_done)
+    except Exception as exc:
+        demux.abort('unable to execute the batch: %s' % exc)
+        raise
+    demux.start()
+    return tasks
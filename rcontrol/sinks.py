@@ -0,0 +1,325 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the path separators, replaced in the host names used as file names
+_SEPARATORS = set(('/', os.sep, os.altsep or os.sep))
+
+
+class HostSink(object):
+    """
+    The part of an :class:`OutputSink` dedicated to one host. This is
+    what commands write their output to.
+
+    Instances are created with :meth:`OutputSink.host`.
+    """
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+
+    def write(self, stream, line):
+        """
+        Write a line read from a stream ('stdout' or 'stderr').
+        """
+        self.sink.write(self.name, stream, line)
+
+
+class OutputSink(object):
+    """
+    Base class for the destinations of the commands output.
+
+    A sink can be given to the commands with the **output_sink** argument,
+    or to all the sessions of a :class:`rcontrol.core.SessionManager` with
+    :meth:`rcontrol.core.SessionManager.set_output_sink`.
+
+    Subclasses must implement :meth:`write`, which is called from the
+    threads that read the commands output.
+    """
+    def host(self, name):
+        """
+        Return a :class:`HostSink` to write the output of the host **name**.
+        """
+        return HostSink(self, name)
+
+    def write(self, name, stream, line):
+        """
+        Write a line read from a stream ('stdout' or 'stderr') of the host
+        **name**.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Close the sink.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _LogFile(object):
+    """
+    A log file, possibly compressed, rotated when it is too big.
+    """
+    def __init__(self, path, compress, max_size, backup_count):
+        self.path = path
+        self.compress = compress
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self._open()
+
+    def _open(self):
+        if self.compress == 'gzip':
+            self.fileobj = gzip.open(self.path, 'ab')
+        elif self.compress == 'zstd':
+            self.fileobj = zstandard.ZstdCompressor().stream_writer(
+                open(self.path, 'ab'))
+        else:
+            self.fileobj = open(self.path, 'ab')
+        # size of the uncompressed data written since the file is opened
+        self.size = 0
+
+    def write(self, data):
+        if self.max_size is not None and self.size and \
+                self.size + len(data) > self.max_size:
+            self.rotate()
+        self.fileobj.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.fileobj.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '%s.%d' % (self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, '%s.%d' % (self.path, i + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class FileSink(OutputSink):
+    """
+    Write the commands output to files: one file per host in a directory,
+    or one file for all the hosts.
+
+    The lines are queued and written by one background thread, in big
+    chunks, so the threads that read the commands output never wait for
+    the disk. If the queue is full, new lines are dropped and counted in
+    the **dropped** attribute.
+
+    If writing the files fails, the thread stops, the next lines are
+    dropped and the error is raised by :meth:`flush` and :meth:`close`.
+
+    :param path: the directory of the files (created if needed), named
+        after the hosts with a '.log' extension; the path separators in
+        the host names are replaced by '_'. If **combined** is True, the
+        path of the only file.
+    :param combined: if True, write the output of all the hosts in the
+        same file, each line prefixed with the host name.
+    :param timestamps: if True, prefix each line with the time it was
+        read.
+    :param compress: None, 'gzip' or 'zstd' (this requires the
+        zstandard package). The file names get a '.gz' or '.zst'
+        extension.
+    :param max_size: if not None, the size in bytes of the output written
+        to a file before it is rotated: the file is renamed with a '.1'
+        suffix (the previous '.1' becomes '.2', and so on) and a new file
+        is started.
+    :param backup_count: the number of rotated files kept.
+    :param flush_interval: maximum time in seconds the lines stay in
+        memory before they are written.
+    :param max_pending: maximum number of lines waiting to be written.
+    """
+    EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, combined=False, timestamps=True, compress=None,
+                 max_size=None, backup_count=5, flush_interval=1.0,
+                 max_pending=100000):
+        if compress not in self.EXTENSIONS:
+            raise ValueError('unknown compression: %r' % compress)
+        if compress == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard'
+                             ' package')
+        self.path = path
+        self.combined = combined
+        self.timestamps = timestamps
+        self.compress = compress
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        if not combined and not os.path.isdir(path):
+            os.makedirs(path)
+        self._files = {}
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._error = None
+        # the flush requests taken from the queue and not yet done
+        self._flushes = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, name, stream, line):
+        if self._closed:
+            return
+        if self._error is not None or \
+                len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        # deque.append is thread safe and does not block
+        self._pending.append((time.time(), name, stream, line))
+
+    def _format(self, timestamp, name, stream, line):
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        prefix = []
+        if self.timestamps:
+            prefix.append('%s.%03d' % (
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(timestamp)),
+                int(timestamp * 1000) % 1000))
+        if self.combined:
+            prefix.append(name)
+        if stream == 'stderr':
+            prefix.append('[stderr]')
+        if prefix:
+            line = (' '.join(prefix) + ' ').encode('utf-8') + line
+        return line + b'\n'
+
+    def _file(self, name):
+        logfile = self._files.get(name)
+        if logfile is None:
+            path = self.path if self.combined else \
+                os.path.join(self.path, _file_name(name) + '.log')
+            logfile = self._files[name] = _LogFile(
+                path + self.EXTENSIONS[self.compress], self.compress,
+                self.max_size, self.backup_count)
+        return logfile
+
+    def _write_pending(self):
+        chunks = {}
+        pending = self._pending
+        while pending:
+            item = pending.popleft()
+            if isinstance(item, _Flush):
+                self._flushes.append(item)
+                continue
+            timestamp, name, stream, line = item
+            # in combined mode, all the lines go to the same file
+            chunks.setdefault(None if self.combined else name, []).append(
+                self._format(timestamp, name, stream, line))
+        for name, lines in chunks.items():
+            logfile = self._file(name)
+            if logfile.max_size is None:
+                logfile.write(b''.join(lines))
+            else:
+                for line in lines:
+                    logfile.write(line)
+
+    def _release_flushes(self):
+        flushes, self._flushes = self._flushes, []
+        for flush in flushes:
+            flush.done.set()
+
+    def _run(self):
+        try:
+            while not self._closed:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self._write_pending()
+                for logfile in self._files.values():
+                    logfile.flush()
+                self._release_flushes()
+            self._write_pending()
+            for logfile in self._files.values():
+                logfile.close()
+        except Exception as exc:
+            self._error = exc
+            for logfile in self._files.values():
+                try:
+                    logfile.close()
+                except Exception:
+                    pass
+            # the flush requests still queued are not written either
+            self._pending.clear()
+        self._release_flushes()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def flush(self):
+        """
+        Block until the lines written so far are written to the files.
+        Raise the error that stopped the writing, if any.
+        """
+        if self._closed:
+            return
+        flush = _Flush()
+        self._pending.append(flush)
+        self._wakeup.set()
+        # the thread may be stopped by an error before it takes the flush
+        while not flush.done.wait(0.1):
+            if not self._thread.is_alive():
+                break
+        self._raise_error()
+
+    def close(self):
+        """
+        Write the pending lines and close the files. Raise the error that
+        stopped the writing, if any.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._raise_error()
+
+
+def _file_name(name):
+    # the file stays in the directory, whatever the host name
+    for sep in _SEPARATORS:
+        name = name.replace(sep, '_')
+    return name
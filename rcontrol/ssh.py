@@ -13,23 +13,49 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import errno
 import os
+import posixpath
+import socket
 import stat
+import threading
+import time
+import uuid
+import weakref
 import paramiko
+import paramiko.agent
 import six
+from six.moves import shlex_quote
+from six.moves.queue import Queue, Full
 
 from rcontrol.streamreader import StreamsReader
 from rcontrol.core import CommandTask, BaseSession
+from rcontrol.fs import (_command_output, _command_stat, _shell_path, _text,
+                         _mtime_match, FindEntry)
+from rcontrol.shell import PersistentShell
+
+# line written by the find command of SshSession._server_find once it is
+# known that the remote find supports the required options.
+FIND_HEADER = '__rcontrol_find__'
+
+# ssh options used when a remote host connects to another one
+DIRECT_SSH_OPTIONS = ('-o BatchMode=yes -o ConnectTimeout=10'
+                      ' -o StrictHostKeyChecking=accept-new')
 
 
 class ChannelReader(StreamsReader):
     """
     Specialized reader for paramiko.channel.Channel.
     """
+    __slots__ = ()
+
     def _create_readers(self, queue, channel):
-        stdout_reader = self._create_stream_reader(channel.makefile('r'),
+        mode = 'rb' if self.raw_stdout else 'r'
+        stdout_reader = self._create_stream_reader(channel.makefile(mode),
                                                    queue,
-                                                   self.stdout_callback)
+                                                   self.stdout_callback,
+                                                   raw=self.raw_stdout)
         stderr_reader = None
         if not channel.combine_stderr:
             stderr_reader = \
@@ -51,18 +77,50 @@ class SshExec(CommandTask):
     :param session: instance of the :class:`SshSession` responsible of
         this command execution
     :param command: the command to execute (a string)
+    :param forward_agent: if True, forward the local ssh agent to the
+        remote command.
     :param kwargs: list of argument passed to the base class constructor
     """
-    def __init__(self, session, command, **kwargs):
+    __slots__ = ('_ssh_session',)
+
+    def __init__(self, session, command, forward_agent=False, **kwargs):
         CommandTask.__init__(self, session, ChannelReader, command, **kwargs)
 
-        transport = self.session.ssh_client.get_transport()
-        self._ssh_session = transport.open_session()
+        streams = 1 + (not self._combine_stderr)
+        self._reserve(channels=1,
+                      threads=streams + 1 + (self._stdin not in (None, True)))
+        try:
+            transport = self.session.ssh_client.get_transport()
+            self._ssh_session = transport.open_session()
+        except Exception:
+            # the command was not started: forget about the task
+            self._release()
+            self.session._unregister_task(self)
+            raise
         self._ssh_session.set_combine_stderr(self._combine_stderr)
+        if forward_agent:
+            paramiko.agent.AgentRequestHandler(self._ssh_session)
 
         self._ssh_session.exec_command(command)
 
         self._reader.start(self._ssh_session)
+        self._start_stdin()
+
+    def _kill(self):
+        # the remote command gets a SIGPIPE when it writes its output
+        self._ssh_session.close()
+
+    def _write_stdin(self, data):
+        try:
+            self._ssh_session.sendall(data)
+        except socket.error:
+            if not self._ssh_session.closed:
+                raise
+            # the remote command is gone
+            raise IOError(errno.EPIPE, os.strerror(errno.EPIPE))
+
+    def _close_stdin(self):
+        self._ssh_session.shutdown_write()
 
     def _on_finished(self):
         if not self.timed_out():
@@ -70,6 +128,29 @@ class SshExec(CommandTask):
         CommandTask._on_finished(self)
 
 
+class SshShell(PersistentShell):
+    """
+    A :class:`PersistentShell` running in one ssh channel.
+    """
+    def _start(self):
+        transport = self.session.ssh_client.get_transport()
+        self._channel = transport.open_session()
+        self._channel.exec_command('/bin/sh')
+        return (self._channel.makefile('r'),
+                self._channel.makefile_stderr('r'))
+
+    def _write(self, data):
+        self._channel.sendall(data)
+
+    def _stop(self):
+        try:
+            self._channel.shutdown_write()
+        except (IOError, OSError, EOFError):
+            pass  # the shell is already gone
+        self._channel.recv_exit_status()
+        self._channel.close()
+
+
 def ssh_client(host, username=None, password=None, **kwargs):
     """
     Create a new :class:`paramiko.SSHClient`, connect it and return the
@@ -100,21 +181,137 @@ class SshSession(BaseSession):
     """
     A specialized ssh session.
 
-    Requires an instance of a connected :class:`paramiko.SSHClient`, as
-    returned by :func:`ssh_client`.
+    It uses an instance of a connected :class:`paramiko.SSHClient`, as
+    returned by :func:`ssh_client`, or connects itself with the given
+    connection parameters. In the latter case, the connection is made
+    only when it is first needed: ::
+
+      session = SshSession(host='bilbo', username='user')
+
+    In any case, the sftp subsystem is started on the first file system
+    operation.
 
-    :param client: an instance of a connected :class:`paramiko.SSHClient`
+    :param client: an instance of a connected :class:`paramiko.SSHClient`,
+        or None to connect to **host**.
     :param auto_close: if True, automatically close the ssh session when using
         the 'with' statement.
+    :param stat_cache_ttl: if not 0, the files metadata (used by
+        :meth:`exists`, :meth:`isdir`, :meth:`islink`, :meth:`stat`...)
+        are cached for this number of seconds. The cache is updated by
+        :meth:`walk` and :meth:`stat_many`, and invalidated by the
+        changes made with :meth:`open` and :meth:`mkdir`; changes made by
+        commands are not seen, use :meth:`invalidate_stat_cache`.
+    :param host: the host to connect to, if **client** is None.
+    :param sftp_idle_timeout: if not None, the sftp subsystem is closed
+        once it has not been used for this number of seconds, no
+        operation of the session is running and no file opened with
+        :meth:`open` is still open. It is started again when needed. The
+        operations made directly with :attr:`sftp` are not tracked.
+    :param connect_kwargs: named arguments given to :func:`ssh_client`
+        (username, password, port...) if **client** is None.
     """
-    def __init__(self, client, auto_close=True):
+    def __init__(self, client=None, auto_close=True, stat_cache_ttl=0,
+                 host=None, sftp_idle_timeout=None, **connect_kwargs):
+        if client is None and host is None:
+            raise ValueError('a client or a host is required')
         BaseSession.__init__(self, auto_close=auto_close)
-        self.ssh_client = client
-        self.sftp = client.open_sftp()
+        self._client = client
+        self._host = host
+        self._connect_kwargs = connect_kwargs
+        self._connect_lock = threading.Lock()
+        self._sftp = None
+        self._sftp_last_use = 0
+        # number of operations running with the sftp client
+        self._sftp_in_use = 0
+        self._sftp_timer = None
+        self._sftp_files = weakref.WeakSet()
+        self.sftp_idle_timeout = sftp_idle_timeout
+        self.stat_cache_ttl = stat_cache_ttl
+        # (path, follow_symlinks) -> (expiration time, attributes or None
+        # if the path does not exist)
+        self._stat_cache = {}
+        self._stat_cache_lock = threading.Lock()
+
+    @property
+    def ssh_client(self):
+        """
+        The :class:`paramiko.SSHClient` instance, connected on first use.
+        """
+        client = self._client
+        if client is None:
+            with self._connect_lock:
+                if self._client is None:
+                    self._client = ssh_client(self._host,
+                                              **self._connect_kwargs)
+                client = self._client
+        return client
+
+    def is_connected(self):
+        """
+        Return True if the ssh connection is made.
+        """
+        return self._client is not None
+
+    @property
+    def sftp(self):
+        """
+        The :class:`paramiko.SFTPClient` instance, started on first use.
+        """
+        return self._acquire_sftp(0)
+
+    def _acquire_sftp(self, count):
+        with self._connect_lock:
+            self._sftp_last_use = time.time()
+            if self._sftp is not None:
+                self._sftp_in_use += count
+                return self._sftp
+        # connecting must not be done with the lock held
+        client = self.ssh_client
+        with self._connect_lock:
+            if self._sftp is None:
+                self._sftp = client.open_sftp()
+                if self.sftp_idle_timeout is not None:
+                    self._schedule_sftp_release(self.sftp_idle_timeout)
+            self._sftp_in_use += count
+            return self._sftp
+
+    @contextlib.contextmanager
+    def _sftp_operation(self):
+        # give the sftp client, which is not released until the block ends
+        sftp = self._acquire_sftp(1)
+        try:
+            yield sftp
+        finally:
+            with self._connect_lock:
+                self._sftp_in_use -= 1
+                self._sftp_last_use = time.time()
+
+    def _schedule_sftp_release(self, delay):
+        self._sftp_timer = threading.Timer(delay, self._release_sftp)
+        self._sftp_timer.daemon = True
+        self._sftp_timer.start()
+
+    def _release_sftp(self):
+        with self._connect_lock:
+            if self._sftp is None:
+                return
+            idle = time.time() - self._sftp_last_use
+            in_use = self._sftp_in_use or any(
+                not getattr(f, '_closed', False)
+                for f in list(self._sftp_files))
+            if in_use or idle < self.sftp_idle_timeout:
+                self._schedule_sftp_release(
+                    max(self.sftp_idle_timeout - idle, 0.1))
+                return
+            sftp, self._sftp = self._sftp, None
+            self._sftp_timer = None
+        sftp.close()
 
     def __str__(self):
-        username = getattr(self.ssh_client, 'username', None)
-        hostname = getattr(self.ssh_client, 'hostname', None)
+        client = self._client
+        username = getattr(client, 'username', None) or \
+            self._connect_kwargs.get('username')
+        hostname = getattr(client, 'hostname', None) or self._host
 
         if username and hostname:
             return "<SshSession %s@%s>" % (username, hostname)
@@ -122,58 +319,361 @@ class SshSession(BaseSession):
             return "<SshSession %s>" % hostname
         return BaseSession.__str__(self)
 
+    def host_name(self):
+        if self.name:
+            return self.name
+        return getattr(self._client, 'hostname', None) or self._host or \
+            BaseSession.host_name(self)
+
     def open(self, filename, mode='r', bufsize=-1):
-        return self.sftp.open(filename, mode=mode, bufsize=bufsize)
+        if any(c in mode for c in 'wax+'):
+            self.invalidate_stat_cache(filename, children=False)
+        with self._sftp_operation() as sftp:
+            fileobj = sftp.open(filename, mode=mode, bufsize=bufsize)
+            self._sftp_files.add(fileobj)
+        return fileobj
 
     def execute(self, command, **kwargs):
         return SshExec(self, command, **kwargs)
 
-    def close(self):
-        self.ssh_client.close()
+    def _create_shell(self):
+        return SshShell(self)
 
-    def isdir(self, path):
+    def close(self):
+        BaseSession.close(self)
+        with self._connect_lock:
+            if self._sftp_timer is not None:
+                self._sftp_timer.cancel()
+                self._sftp_timer = None
+            sftp, self._sftp = self._sftp, None
+            client = self._client
+            if self._host is not None:
+                # connect again if the session is used after
+                self._client = None
+        if sftp is not None:
+            sftp.close()
+        if client is not None:
+            client.close()
+
+    def ssh_destination(self):
+        """
+        Return a tuple (username, hostname, port) that another host
+        may use to reach this session with ssh.
+        """
+        transport = self.ssh_client.get_transport()
+        host, port = transport.getpeername()[:2]
+        host = getattr(self.ssh_client, 'hostname', None) or host
+        username = (getattr(self.ssh_client, 'username', None) or
+                    transport.get_username())
+        return username, host, port
+
+    def direct_copy_file(self, src, dest_session, dest, method='agent'):
+        """
+        Copy a file from this host to the host of another
+        :class:`SshSession`, by running ssh on this host. The data does
+        not go through this process.
+
+        Return True on success, False if the transfer was not possible
+        (e.g. the hosts can not reach each other).
+
+        :param method: how this host authenticates on the destination
+            host: 'agent' forwards the local ssh agent, 'key' installs a
+            temporary key pair for the duration of the transfer.
+        """
+        username, host, port = dest_session.ssh_destination()
+        target = '%s -p %d %s %s < %s' % (
+            DIRECT_SSH_OPTIONS, port,
+            shlex_quote('%s@%s' % (username, host)),
+            shlex_quote('cat > %s' % shlex_quote(dest)), shlex_quote(src))
+        if method == 'key':
+            try:
+                keyfile, marker = self._install_temporary_key(dest_session)
+            except Exception:
+                # the key can not be installed: let the caller relay
+                # the data
+                return False
+            try:
+                task = self.execute(
+                    'ssh -o IdentitiesOnly=yes -i %s %s' % (
+                        shlex_quote(keyfile), target),
+                    expected_exit_code=None)
+                return task.wait() == 0
+            finally:
+                self._remove_temporary_key(dest_session, keyfile, marker)
+        task = self.execute('ssh ' + target, expected_exit_code=None,
+                            forward_agent=True)
+        return task.wait() == 0
+
+    def _install_temporary_key(self, dest_session):
+        key = paramiko.RSAKey.generate(2048)
+        marker = 'rcontrol-%s' % uuid.uuid4().hex
+        _command_output(dest_session, (
+            'umask 077 && mkdir -p ~/.ssh && '
+            'printf "%%s\\n" %s >> ~/.ssh/authorized_keys') % shlex_quote(
+                '%s %s %s' % (key.get_name(), key.get_base64(), marker)))
         try:
-            return stat.S_ISDIR(self.sftp.stat(path).st_mode)
-        except IOError:
+            keyfile = _command_output(self, 'mktemp')[0].strip()
+            with self._sftp_operation() as sftp:
+                with sftp.open(keyfile, 'w') as f:
+                    key.write_private_key(f)
+        except Exception:
+            self._revoke_temporary_key(dest_session, marker)
+            raise
+        return keyfile, marker
+
+    def _remove_temporary_key(self, dest_session, keyfile, marker):
+        try:
+            self._revoke_temporary_key(dest_session, marker)
+        finally:
+            _command_output(self, 'rm -f %s' % shlex_quote(keyfile))
+
+    def _revoke_temporary_key(self, dest_session, marker):
+        _command_output(dest_session, (
+            'f=~/.ssh/authorized_keys; grep -v %s "$f" > "$f.rcontrol";'
+            ' cat "$f.rcontrol" > "$f"; rm -f "$f.rcontrol"') % marker)
+
+    def _find_command(self, top, include, exclude, min_mtime, max_mtime,
+                      max_depth):
+        def names(patterns):
+            return '\\( %s \\)' % ' -o '.join(
+                '-name %s' % shlex_quote(p) for p in patterns)
+        args = [_shell_path(top), '-mindepth 1']
+        if max_depth is not None:
+            args.append('-maxdepth %d' % max_depth)
+        if exclude:
+            args.append('%s -prune -o' % names(exclude))
+        if include:
+            args.append(names(include))
+        # the mtime filters are approximated to the second here, and
+        # checked exactly on the results
+        if min_mtime is not None:
+            args.append('-newermt @%d' % (int(min_mtime) - 1))
+        if max_mtime is not None:
+            args.append('! -newermt @%d' % (int(max_mtime) + 1))
+        args.append("-printf '%y %s %T@ %p\\n'")
+        return ("find / -maxdepth 0 -printf '' >/dev/null 2>&1 || exit 127\n"
+                "echo %s\nfind %s") % (FIND_HEADER, ' '.join(args))
+
+    def _server_find(self, top, include, exclude, min_mtime, max_mtime,
+                     max_depth):
+        queue = Queue(1000)
+        abandoned = threading.Event()
+
+        def on_stdout(task, line):
+            # block while the results are not consumed, unless the
+            # iteration is abandoned
+            while not abandoned.is_set():
+                try:
+                    queue.put(line, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        task = self.execute(
+            self._find_command(top, include, exclude, min_mtime, max_mtime,
+                               max_depth),
+            combine_stderr=False, expected_exit_code=None, output_sink=False,
+            max_queue_lines=1000, on_stdout=on_stdout,
+            on_done=lambda t: on_stdout(t, None))
+        first = queue.get()
+        if first is None or _text(first).strip() != FIND_HEADER:
+            # no usable find command
+            task.wait()
+            return None
+        return self._find_entries(task, queue, abandoned, min_mtime,
+                                  max_mtime)
+
+    def _find_entries(self, task, queue, abandoned, min_mtime, max_mtime):
+        try:
+            while True:
+                line = queue.get()
+                if line is None:
+                    break
+                type, size, mtime, path = _text(line).split(' ', 3)
+                entry = FindEntry(path, type, int(size), float(mtime))
+                if _mtime_match(entry, min_mtime, max_mtime):
+                    yield entry
+        finally:
+            abandoned.set()
+        task.wait()
+
+    def _direct_copy_file(self, src, dest_session, dest, method):
+        if not isinstance(dest_session, SshSession):
             return False
-
-    def islink(self, path):
+        if method is True:
+            method = 'agent'
+        return self.direct_copy_file(src, dest_session, dest, method=method)
+
+    def _cache_stat(self, path, follow_symlinks, attr):
+        # the cache associate a path to a dict of follow_symlinks ->
+        # (expiry, attributes)
+        if self.stat_cache_ttl:
+            with self._stat_cache_lock:
+                self._stat_cache.setdefault(path, {})[follow_symlinks] = (
+                    time.time() + self.stat_cache_ttl, attr)
+
+    def _cache_entry(self, path, follow_symlinks):
+        # must be called with the cache lock
+        entries = self._stat_cache.get(path)
+        return entries and entries.get(follow_symlinks)
+
+    def _cached_stat(self, path, follow_symlinks):
+        """
+        Return the attributes of a path, or None if it does not exist.
+        """
+        if self.stat_cache_ttl:
+            with self._stat_cache_lock:
+                entry = self._cache_entry(path, follow_symlinks)
+            if entry and entry[0] > time.time():
+                return entry[1]
         try:
-            return stat.S_ISLNK(self.sftp.lstat(path).st_mode)
+            with self._sftp_operation() as sftp:
+                if follow_symlinks:
+                    attr = sftp.stat(path)
+                else:
+                    attr = sftp.lstat(path)
         except IOError:
-            return False
+            attr = None
+        self._cache_stat(path, follow_symlinks, attr)
+        return attr
+
+    def invalidate_stat_cache(self, path=None, children=True):
+        """
+        Remove the cached metadata of a path and of the paths under it,
+        or of all the paths if **path** is None.
+
+        :param children: if False, only the metadata of the path itself
+            is removed, which does not look at the whole cache.
+        """
+        with self._stat_cache_lock:
+            if path is None:
+                self._stat_cache.clear()
+                return
+            self._stat_cache.pop(path, None)
+            if not children:
+                return
+            prefix = path.rstrip('/') + '/'
+            for key in list(self._stat_cache):
+                if key.startswith(prefix):
+                    del self._stat_cache[key]
+
+    def stat(self, path, follow_symlinks=True):
+        attr = self._cached_stat(path, follow_symlinks)
+        if attr is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return attr
+
+    def stat_many(self, paths, follow_symlinks=True):
+        """
+        Return a dict that associate each path to its attributes (a
+        :class:`paramiko.SFTPAttributes`), or None if it does not exist.
+
+        The paths that are not in the cache are resolved with only one
+        **stat** command, or with sftp requests if the remote **stat**
+        command does not understand the GNU options.
+        """
+        result = {}
+        missing = []
+        now = time.time()
+        with self._stat_cache_lock:
+            for path in paths:
+                entry = self._cache_entry(path, follow_symlinks)
+                if entry and entry[0] > now:
+                    result[path] = entry[1]
+                else:
+                    missing.append(path)
+        if not missing:
+            return result
+        attrs = self._remote_stat(missing, follow_symlinks)
+        if attrs is None:
+            for path in missing:
+                result[path] = self._cached_stat(path, follow_symlinks)
+            return result
+        for path in missing:
+            attr = attrs.get(path)
+            self._cache_stat(path, follow_symlinks, attr)
+            result[path] = attr
+        return result
+
+    def _remote_stat(self, paths, follow_symlinks):
+        # return None if the stat command is not usable
+        fields = _command_stat(self, paths, follow_symlinks)
+        if fields is None:
+            return None
+        attrs = {}
+        for path, values in fields.items():
+            attr = attrs[path] = paramiko.SFTPAttributes()
+            (attr.st_mode, attr.st_size, attr.st_mtime, attr.st_atime,
+             attr.st_uid, attr.st_gid) = values
+        return attrs
+
+    def isdir(self, path):
+        attr = self._cached_stat(path, True)
+        return attr is not None and stat.S_ISDIR(attr.st_mode)
+
+    def islink(self, path):
+        attr = self._cached_stat(path, False)
+        return attr is not None and stat.S_ISLNK(attr.st_mode)
 
     def exists(self, path):
-        try:
-            self.ftp.lstat(path).st_mode
-        except IOError:
-            return False
-        return True
+        return self._cached_stat(path, True) is not None
 
     def mkdir(self, path):
-        self.sftp.mkdir(path)
+        self.invalidate_stat_cache(path)
+        with self._sftp_operation() as sftp:
+            sftp.mkdir(path)
+
+    def makedirs(self, path, exist_ok=True):
+        if not exist_ok and self.exists(path):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        self.invalidate_stat_cache(path)
+        # the missing parents are created too
+        child, parent = path, posixpath.dirname(path.rstrip('/'))
+        while parent and parent != child:
+            self.invalidate_stat_cache(parent, children=False)
+            child, parent = parent, posixpath.dirname(parent)
+        _command_output(self, 'mkdir -p -- %s' % shlex_quote(path))
+
+    def apply_fs_ops(self, ops):
+        for op in ops:
+            # only a renamed directory changes the paths under it
+            for path in op[1:3]:
+                if isinstance(path, six.string_types):
+                    self.invalidate_stat_cache(
+                        path, children=op[0] == 'rename')
+        BaseSession.apply_fs_ops(self, ops)
 
     def walk(self, top, topdown=True, onerror=None, followlinks=False):
         try:
-            names = self.sftp.listdir(top)
+            with self._sftp_operation() as sftp:
+                attrs = sftp.listdir_attr(top)
         except Exception as err:
             if onerror is not None:
                 onerror(err)
             return
 
-        dirs, nondirs = [], []
-        for name in names:
-            if self.isdir(os.path.join(top, name)):
-                dirs.append(name)
+        dirs, nondirs, links = [], [], set()
+        for attr in attrs:
+            path = os.path.join(top, attr.filename)
+            # the attributes of listdir_attr do not follow the links
+            self._cache_stat(path, False, attr)
+            if stat.S_ISLNK(attr.st_mode):
+                links.add(attr.filename)
+                isdir = self.isdir(path)
+            else:
+                self._cache_stat(path, True, attr)
+                isdir = stat.S_ISDIR(attr.st_mode)
+            if isdir:
+                dirs.append(attr.filename)
             else:
-                nondirs.append(name)
+                nondirs.append(attr.filename)
 
         if topdown:
             yield top, dirs, nondirs
 
         for name in dirs:
             path = os.path.join(top, name)
-            if followlinks or not self.islink(path):
+            if followlinks or name not in links:
                 for x in self.walk(path, topdown, onerror, followlinks):
                     yield x
         if not topdown:
@@ -15,7 +15,149 @@
 
 import threading
 import time
-from six.moves.queue import Queue, Empty
+from collections import deque
+from six.moves.queue import Empty
+
+
+def _ignore_line(line):
+    return True
+
+
+def _ignore():
+    return True
+
+
+# the event of the readers that are done: is_alive() is then False
+_DONE = threading.Event()
+_DONE.set()
+
+
+class _DoneThread(object):
+    """
+    Stands for the thread of the readers that are done, so that the
+    Thread objects are not kept.
+    """
+    __slots__ = ()
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
+
+
+_DONE_THREAD = _DoneThread()
+
+# the flow control counters of a queue that did not see any line
+_NO_FLOW_STATS = dict(throttled=0, throttle_time=0.0, dropped=0,
+                      peak_lines=0, peak_bytes=0)
+
+
+class FlowControlQueue(object):
+    """
+    A queue of (line, callback) items between the stream reader threads
+    and the synchronizing thread, optionally bounded.
+
+    When the queue is full (it holds **max_lines** lines or **max_bytes**
+    bytes), the **overflow** policy is applied for new lines:
+
+     - 'block': the reader thread waits until there is room in the queue.
+       It then stops reading the stream, so the producer is slowed down
+       (the pipe or the ssh channel window fills up).
+     - 'drop': the line is dropped.
+     - 'sample': only one line out of **sample_rate** is kept; it
+       replaces the oldest lines of the queue, which are dropped.
+
+    The **stats** attribute holds counters: 'throttled' (number of times
+    a reader had to wait), 'throttle_time' (total time spent waiting, in
+    seconds), 'dropped' (number of dropped lines), 'peak_lines' and
+    'peak_bytes'.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop', 'sample')
+
+    __slots__ = ('max_lines', 'max_bytes', 'overflow', 'sample_rate',
+                 'stats', '_items', '_bytes', '_overflowed', '_closed',
+                 '_cond')
+
+    def __init__(self, max_lines=None, max_bytes=None, overflow='block',
+                 sample_rate=10):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: %r' % overflow)
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.stats = dict(_NO_FLOW_STATS)
+        self._items = deque()
+        self._bytes = 0
+        self._overflowed = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _full(self):
+        if self.max_lines is not None and len(self._items) >= self.max_lines:
+            return True
+        return (self.max_bytes is not None and self._items and
+                self._bytes >= self.max_bytes)
+
+    def put(self, item):
+        size = len(item[0])
+        with self._cond:
+            if self._closed:
+                return
+            if self._full():
+                if self.overflow == 'drop':
+                    self.stats['dropped'] += 1
+                    return
+                if self.overflow == 'sample':
+                    self._overflowed += 1
+                    if self._overflowed % self.sample_rate:
+                        self.stats['dropped'] += 1
+                        return
+                    # the sampled line replaces the oldest lines
+                    while self._full():
+                        self._bytes -= len(self._items.popleft()[0])
+                        self.stats['dropped'] += 1
+                else:
+                    start = time.time()
+                    self.stats['throttled'] += 1
+                    while self._full() and not self._closed:
+                        self._cond.wait()
+                    self.stats['throttle_time'] += time.time() - start
+                    if self._closed:
+                        return
+            self._items.append(item)
+            self._bytes += size
+            stats = self.stats
+            stats['peak_lines'] = max(stats['peak_lines'], len(self._items))
+            stats['peak_bytes'] = max(stats['peak_bytes'], self._bytes)
+            self._cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            if block and not self._items:
+                self._cond.wait(timeout)
+            if not self._items:
+                raise Empty
+            item = self._items.popleft()
+            self._bytes -= len(item[0])
+            self._cond.notify_all()
+            return item
+
+    def empty(self):
+        with self._cond:
+            return not self._items
+
+    def close(self):
+        """
+        Discard the content of the queue and the new lines, and release
+        the reader threads waiting for room in the queue.
+        """
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._cond.notify_all()
 
 
 class StreamsReader(object):
@@ -37,23 +179,81 @@ class StreamsReader(object):
         timeout at all.
     :param output_timeout: a timeout for the output in seconds, or None
         for no timeout at all.
+    :param raw_stdout: if True, stdout is not read line by line: the
+        stdout callback is called with the raw chunks of bytes read.
+    :param max_queue_lines: maximum number of lines read but not yet
+        given to the callbacks, or None for no limit.
+    :param max_queue_bytes: maximum size of the lines read but not yet
+        given to the callbacks, or None for no limit.
+    :param queue_overflow: what to do when the limits are reached. See
+        :class:`FlowControlQueue`.
+    :param callback_executor: if not None, an instance of
+        :class:`rcontrol.executor.CallbackExecutor` used to run the
+        callbacks, so that slow callbacks do not delay the reading and the
+        timeouts detection. The callbacks are still called in order.
+        In that case, **max_queue_lines** and **max_queue_bytes** also
+        limit the lines waiting in the executor.
+
+    The exceptions raised by the callbacks do not stop the reading: the
+    first one is kept (see :meth:`callback_error`), and the finished or
+    timeout callback is always called.
+    :param priority: the priority of the callbacks in the executor.
+    :param group: the fairness group of the callbacks in the executor.
     """
+    # size of the chunks read when stdout is read in raw mode
+    chunk_size = 16384
+
+    __slots__ = ('stdout_callback', 'stderr_callback', 'finished_callback',
+                 'timeout_callback', 'timeout', 'output_timeout',
+                 'raw_stdout', 'queue', 'callback_executor', 'priority',
+                 'group', 'thread', '_queue_args', '_stats', '_in_flight',
+                 '_in_flight_bytes', '_in_flight_lock', '_callbacks_done',
+                 '_callback_error', '__weakref__')
+
     def __init__(self, stdout_callback=None, stderr_callback=None,
                  finished_callback=None, timeout_callback=None,
-                 timeout=None, output_timeout=None):
-        self.stdout_callback = stdout_callback or (lambda line: True)
-        self.stderr_callback = stderr_callback or (lambda line: True)
-        self.finished_callback = finished_callback or (lambda: True)
-        self.timeout_callback = timeout_callback or (lambda: True)
+                 timeout=None, output_timeout=None, raw_stdout=False,
+                 max_queue_lines=None, max_queue_bytes=None,
+                 queue_overflow='block', callback_executor=None,
+                 priority=0, group=None):
+        self.stdout_callback = stdout_callback or _ignore_line
+        self.stderr_callback = stderr_callback or _ignore_line
+        self.finished_callback = finished_callback or _ignore
+        self.timeout_callback = timeout_callback or _ignore
         self.timeout = timeout
         self.output_timeout = output_timeout
+        self.raw_stdout = raw_stdout
+        if queue_overflow not in FlowControlQueue.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: %r' % queue_overflow)
+        # the queue, its counters (kept once the queue is released) and
+        # the events are only created when the reading starts, so that
+        # the tasks waiting to start stay small
+        self._queue_args = (max_queue_lines, max_queue_bytes, queue_overflow)
+        self.queue = None
+        self._stats = None
+        self.callback_executor = callback_executor
+        self.priority = priority
+        self.group = group
         self.thread = None
+        # number of callbacks submitted to the executor and not yet run,
+        # and the size of their lines
+        self._in_flight = 0
+        self._in_flight_bytes = 0
+        self._callback_error = None
+        self._in_flight_lock = threading.Lock() \
+            if callback_executor is not None else None
+        # set once the finished or timeout callback has been called
+        self._callbacks_done = None
 
     def start(self, *args, **kwargs):
         """
         Start to read the stream(s).
         """
-        queue = Queue()
+        max_lines, max_bytes, overflow = self._queue_args
+        queue = self.queue = FlowControlQueue(
+            max_lines=max_lines, max_bytes=max_bytes, overflow=overflow)
+        self._stats = queue.stats
+        self._callbacks_done = threading.Event()
         stdout_reader, stderr_reader = \
             self._create_readers(queue, *args, **kwargs)
 
@@ -70,22 +270,99 @@ class StreamsReader(object):
         """
         raise NotImplementedError
 
-    def _create_stream_reader(self, stream, queue, callback):
+    def _create_stream_reader(self, stream, queue, callback, raw=False):
         thread = threading.Thread(target=self._read_stream,
-                                  args=(stream, queue, callback))
+                                  args=(stream, queue, callback, raw))
         thread.daemon = True
         thread.start()
         return thread
 
-    def _read_stream(self, stream, queue, callback):
-        while True:
-            line = stream.readline()
-            if not line:
-                break
-            queue.put((line, callback))
+    def _read_stream(self, stream, queue, callback, raw=False):
+        if raw:
+            read = getattr(stream, 'read1', stream.read)
+            while True:
+                data = read(self.chunk_size)
+                if not data:
+                    break
+                queue.put((data, callback))
+        else:
+            while True:
+                line = stream.readline()
+                if not line:
+                    break
+                queue.put((line.rstrip(), callback))
         stream.close()
 
+    def _dispatch(self, callback, arg, size=0):
+        # size is the length of the line given to the callback, counted
+        # like in the queue until the callback has run
+        executor = self.callback_executor
+        if executor is None:
+            self._call(callback, arg)
+            return
+        lock = self._in_flight_lock
+        with lock:
+            self._in_flight += 1
+            self._in_flight_bytes += size
+        executor.submit(self, self._run_callback, callback, arg, size,
+                        lock)
+
+    def _call(self, callback, arg):
+        try:
+            callback(arg)
+        except Exception as exc:
+            if self._callback_error is None:
+                self._callback_error = exc
+
+    def _run_callback(self, callback, arg, size, lock):
+        # the lock is given as the last callback releases the reader
+        try:
+            self._call(callback, arg)
+        finally:
+            with lock:
+                self._in_flight -= 1
+                self._in_flight_bytes -= size
+
+    def _executor_full(self):
+        if self.callback_executor is None or not self._in_flight:
+            return False
+        max_lines, max_bytes = self._queue_args[:2]
+        return ((max_lines is not None and self._in_flight >= max_lines) or
+                (max_bytes is not None and
+                 self._in_flight_bytes >= max_bytes))
+
+    def _last_callback(self, callback):
+        try:
+            callback()
+        finally:
+            self._callbacks_done.set()
+            self._release()
+
+    def _release(self):
+        # nothing is read anymore: drop the callbacks (and the task they
+        # are bound to), the queue and the thread, keeping the counters
+        self.stdout_callback = self.stderr_callback = _ignore_line
+        self.finished_callback = self.timeout_callback = _ignore
+        self.thread = _DONE_THREAD
+        self.queue = None
+        self.callback_executor = None
+        self._in_flight_lock = None
+        self._callbacks_done = _DONE
+
     def _read(self, stdout_reader, stderr_reader, queue):
+        try:
+            timed_out = self._read_lines(stdout_reader, stderr_reader, queue)
+        except Exception as exc:
+            # the task must still be finished, to release what it holds
+            if self._callback_error is None:
+                self._callback_error = exc
+            timed_out = False
+        if timed_out:
+            self._dispatch(self._last_callback, self.timeout_callback)
+        else:
+            self._dispatch(self._last_callback, self.finished_callback)
+
+    def _read_lines(self, stdout_reader, stderr_reader, queue):
         start_time = time.time()
         timed_out = False
         timeout = self.timeout
@@ -97,6 +374,16 @@ class StreamsReader(object):
 
         while (stdout_reader and stdout_reader.is_alive()) or \
                 (stderr_reader and stderr_reader.is_alive()):
+            if self._executor_full():
+                # wait for the callbacks; the lines stay in the queue
+                time.sleep(0.02)
+                now = time.time()
+                if output_timeout is not None:
+                    output_timeout = now + self.output_timeout
+                if timeout is not None and now > timeout:
+                    timed_out = True
+                    break
+                continue
             has_line = True
             try:
                 line, callback = queue.get(True, 0.02)
@@ -110,28 +397,53 @@ class StreamsReader(object):
             else:
                 if output_timeout is not None:
                     output_timeout = now + self.output_timeout
-                callback(line.rstrip())
+                self._dispatch(callback, line, len(line))
             if timeout is not None and now > timeout:
                 timed_out = True
                 break
         if timed_out:
-            self.timeout_callback()
-            return
+            # release the readers that may wait for room in the queue
+            queue.close()
+            return True
         # process remaining lines to read
         while not queue.empty():
             line, callback = queue.get(False)
-            callback(line.rstrip())
+            self._dispatch(callback, line, len(line))
         if stdout_reader:
             stdout_reader.join()
         if stderr_reader:
             stderr_reader.join()
-        if not timed_out:
-            self.finished_callback()
+        return False
 
-    def is_alive(self):
+    def join_callbacks(self, timeout=None):
         """
-        Return true if the synchronizing thread is still alive.
+        Wait until the finished or timeout callback has been called.
         """
         if self.thread:
-            return self.thread.is_alive()
+            self._callbacks_done.wait(timeout)
+
+    def callback_error(self):
+        """
+        Return the first exception raised by a callback (or while reading
+        the output), or None. The callbacks after it are still called.
+        """
+        return self._callback_error
+
+    def flow_stats(self):
+        """
+        Return a copy of the flow control counters (see
+        :class:`FlowControlQueue`).
+        """
+        stats = self._stats
+        return dict(_NO_FLOW_STATS if stats is None else stats)
+
+    def is_alive(self):
+        """
+        Return true if the synchronizing thread is still alive, or if the
+        finished or timeout callback has not been called yet.
+        """
+        thread = self.thread
+        if thread:
+            return (thread.is_alive() or
+                    not self._callbacks_done.is_set())
         return False
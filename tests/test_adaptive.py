@@ -0,0 +1,152 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from rcontrol.adaptive import AdaptiveLimiter
+from rcontrol.core import SessionManager, TaskErrors
+from rcontrol.local import LocalSession
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter(initial=2)
+        # 2 -> 2.5 -> 2.9 -> 3.24
+        for _ in range(3):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 3)
+        self.assertEqual([limit for _, limit in limiter.history], [2, 3])
+
+    def test_history_is_bounded(self):
+        limiter = AdaptiveLimiter(initial=2, history_size=2)
+        for _ in range(20):
+            limiter.release(limiter.acquire())
+        self.assertEqual([limit for _, limit in limiter.history], [5, 6])
+
+    def test_multiplicative_decrease_once_per_window(self):
+        limiter = AdaptiveLimiter(initial=8)
+        starts = [limiter.acquire() for _ in range(4)]
+        for start in starts:
+            limiter.release(start, error=True)
+        # the tasks started before the first decrease are ignored
+        self.assertEqual(limiter.limit, 4)
+        limiter.release(limiter.acquire(), timed_out=True)
+        self.assertEqual(limiter.limit, 2)
+        stats = limiter.stats()
+        self.assertEqual(stats['errors'], 4)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['completed'], 5)
+
+    def test_bounds(self):
+        limiter = AdaptiveLimiter(initial=2, min_limit=2, max_limit=3)
+        limiter.release(limiter.acquire(), error=True)
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(20):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 3)
+        self.assertRaises(ValueError, AdaptiveLimiter, min_limit=0)
+        self.assertRaises(ValueError, AdaptiveLimiter, decrease=1)
+
+    def test_latency_target(self):
+        limiter = AdaptiveLimiter(initial=4, latency_target=0.5)
+        limiter.release(time.time() - 1)
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.stats()['slow'], 1)
+
+    @patch('rcontrol.adaptive._controller_load')
+    def test_max_load(self, load):
+        load.return_value = 2.0
+        limiter = AdaptiveLimiter(initial=4, max_load=1.5)
+        limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.stats()['overloaded'], 1)
+
+    def test_track(self):
+        limiter = AdaptiveLimiter(initial=1)
+        with LocalSession() as session:
+            first = limiter.track(lambda: session.execute('sleep 0.1'))
+            second = limiter.track(
+                lambda: session.execute('false', on_done=lambda t: None))
+            # the limit is 1, so the first task was done before
+            self.assertFalse(first.is_running())
+            second.wait(raise_if_error=False)
+        stats = limiter.stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_track_start_error(self):
+        limiter = AdaptiveLimiter()
+
+        def start():
+            raise OSError('no')
+        self.assertRaises(OSError, limiter.track, start)
+        self.assertEqual(limiter.in_flight(), 0)
+
+
+class TestDoneCallback(unittest.TestCase):
+    def test_add_done_callback(self):
+        done = []
+        with LocalSession() as session:
+            task = session.execute('true')
+            task.add_done_callback(done.append)
+            task.wait()
+            # called immediately once the task is done
+            task.add_done_callback(done.append)
+        self.assertEqual(done, [task, task])
+        self.assertFalse(task.error_handled())
+
+
+class TestSessionManagerLimited(unittest.TestCase):
+    def test_execute(self):
+        sessions = SessionManager()
+        sessions.a = LocalSession()
+        sessions.b = LocalSession()
+        limiter = AdaptiveLimiter(initial=1)
+        with sessions:
+            tasks = sessions.execute('echo $0', limiter=limiter)
+        self.assertEqual(list(tasks), ['a', 'b'])
+        self.assertTrue(all(t.exit_code() == 0 for t in tasks.values()))
+        self.assertEqual(limiter.stats()['completed'], 2)
+
+    def test_execute_errors(self):
+        sessions = SessionManager()
+        sessions.a = LocalSession()
+        with sessions:
+            self.assertRaises(TaskErrors, sessions.execute, 'false')
+            tasks = sessions.execute('false', raise_if_error=False)
+        self.assertEqual(tasks['a'].exit_code(), 1)
+
+    def test_copy_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src = os.path.join(tmpdir, 'src')
+        with open(src, 'w') as f:
+            f.write('data')
+        sessions = SessionManager()
+        sessions.src = LocalSession()
+        sessions.dest = LocalSession()
+        with sessions:
+            tasks = sessions.copy_file(sessions.src, src,
+                                       os.path.join(tmpdir, 'dest'))
+        self.assertEqual(list(tasks), ['dest'])
+        with open(os.path.join(tmpdir, 'dest')) as f:
+            self.assertEqual(f.read(), 'data')
@@ -0,0 +1,85 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from rcontrol.aggregate import OutputAggregator
+from rcontrol.core import SessionManager
+from rcontrol.local import LocalSession
+
+
+class TestOutputAggregator(unittest.TestCase):
+    def test_groups(self):
+        aggregator = OutputAggregator()
+        aggregator.add('a', [b'4.1', b'x'], 0)
+        aggregator.add('b', [u'4.2', u'x'], 0)
+        aggregator.add('c', [u'4.1', u'x'], 0)
+        aggregator.add('d', [u'4.1', u'x'], 1)
+        groups = aggregator.groups()
+        self.assertEqual([g.names for g in groups], [['a', 'c'], ['b'],
+                                                     ['d']])
+        self.assertEqual(groups[0].output, (u'4.1', u'x'))
+        # the output is stored once per group
+        self.assertIs(groups[0].output, aggregator.groups()[0].output)
+
+    def test_lines_copied_once_diverging(self):
+        aggregator = OutputAggregator()
+        aggregator.add('a', [u'x', u'y'], 0)
+        capture = aggregator._capture()
+        capture.add(b'x')
+        capture.add(u'y')
+        # same lines as the biggest group: nothing is copied
+        self.assertIsNone(capture.lines)
+        self.assertIs(capture.output(), aggregator.groups()[0].output)
+        capture = aggregator._capture()
+        capture.add(u'x')
+        capture.add(u'z')
+        self.assertEqual(capture.lines, [u'x', u'z'])
+        capture = aggregator._capture()
+        capture.add(u'x')
+        self.assertEqual(capture.output(), (u'x',))
+
+    def test_mask_numbers(self):
+        aggregator = OutputAggregator(mask_numbers=True)
+        aggregator.add('a', [u'pid 12 up'])
+        aggregator.add('b', [u'pid 4567 up'])
+        aggregator.add('c', [u'pid down'])
+        groups = aggregator.groups()
+        self.assertEqual([g.names for g in groups], [['a', 'b'], ['c']])
+        self.assertEqual(groups[0].output, (u'pid 12 up',))
+
+    def test_report(self):
+        aggregator = OutputAggregator()
+        aggregator.add('a', [u'x'], 0)
+        aggregator.add('b', [u'y'], 2)
+        aggregator.add('c', [u'x'], 0)
+        self.assertEqual(aggregator.report(),
+                         '-------\na,c (2)\n-------\nx\n'
+                         '------------------\n'
+                         'b (1) exit code: 2\n'
+                         '------------------\ny\n')
+
+
+class TestSessionManagerAggregate(unittest.TestCase):
+    def test_aggregate(self):
+        with SessionManager() as sessions:
+            for name in ('a', 'b', 'c'):
+                sessions[name] = LocalSession()
+            aggregator = sessions.aggregate('echo hello; echo err >&2')
+            groups = aggregator.groups()
+            self.assertEqual(len(groups), 1)
+            self.assertEqual(sorted(groups[0].names), ['a', 'b', 'c'])
+            self.assertEqual(groups[0].output, (u'hello', u'err'))
+            self.assertEqual(groups[0].exit_code, 0)
@@ -13,11 +13,14 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import gc
+import threading
 import unittest
+import weakref
 import time
 import abc
 import six
-from mock import Mock
+from mock import Mock, patch
 
 from rcontrol import core
 
@@ -174,6 +177,24 @@ class TestBaseSession(unittest.TestCase):
         # close has been called
         self.session.close.assert_called_once_with()
 
+    @patch('rcontrol.fs.copy_file')
+    def test_copy_file_direct_fallback(self, copy_file):
+        dest = TestableBaseSession()
+        self.session.s_copy_file('src', dest, 'dest', direct=True)
+        copy_file.assert_called_once_with(self.session, 'src', dest, 'dest',
+                                          chunk_size=16384, verify=None,
+                                          expected_digest=None,
+                                          rate_limit=None)
+
+    @patch('rcontrol.fs.copy_file')
+    def test_copy_file_direct(self, copy_file):
+        dest = TestableBaseSession()
+        self.session._direct_copy_file = Mock(return_value=True)
+        self.session.s_copy_file('src', dest, 'dest', direct='key')
+        self.session._direct_copy_file.assert_called_once_with(
+            'src', dest, 'dest', 'key')
+        self.assertFalse(copy_file.called)
+
 
 def create_session(**kwargs):
     return Mock(spec=core.BaseSession, **kwargs)
@@ -190,6 +211,23 @@ class TestSessionManager(unittest.TestCase):
         # test getattr
         self.assertEqual(session, self.sessions.local)
 
+    def test_session_name(self):
+        self.sessions.web = TestableBaseSession()
+        self.assertEqual(self.sessions.web.host_name(), 'web')
+        task = core.ThreadableTask(self.sessions.web, lambda: None, (), {})
+        task.wait()
+        self.assertEqual(task.group, 'web')
+
+    def test_name_collision(self):
+        for name in ('execute', 'copy_file', 'keys'):
+            with self.assertRaises(ValueError):
+                setattr(self.sessions, name, TestableBaseSession())
+        self.assertEqual(self.sessions, {})
+        # item access does not hide anything
+        session = self.sessions['copy'] = TestableBaseSession()
+        self.assertIs(self.sessions['copy'], session)
+        self.assertEqual(session.name, 'copy')
+
     def test_delattr(self):
         self.sessions.local = TestableBaseSession()
         del self.sessions.local
@@ -266,6 +304,19 @@ class TestSessionManager(unittest.TestCase):
         self.sessions.s1.close.assert_called_once_with()
         self.sessions.s2.close.assert_called_once_with()
 
+    @patch('rcontrol.fs.distribute_file')
+    def test_distribute_file(self, distribute_file):
+        src = self.sessions.src = TestableBaseSession()
+        s1 = self.sessions.s1 = TestableBaseSession()
+        s2 = self.sessions.s2 = TestableBaseSession()
+        distribute_file.return_value = [(src, 'src'), (s1, 'dest')]
+
+        parents = self.sessions.distribute_file(src, 'src', 'dest')
+        self.assertEqual(parents, {'s1': 'src', 's2': 's1'})
+        distribute_file.assert_called_once_with(
+            src, 'src', [(s1, 'dest'), (s2, 'dest')], fanout=2, seeds=None,
+            direct=None)
+
     def test_inside_with(self):
         self.sessions.wait_for_tasks = Mock(return_value=[])
         with self.sessions as s:
@@ -309,7 +360,9 @@ class TestCommandTask(unittest.TestCase):
     def create_cmd(self, command="cmd", **kwargs):
         session = create_session()
         reader_class = Mock
-        return core.CommandTask(session, reader_class, command, **kwargs)
+        cmd = core.CommandTask(session, reader_class, command, **kwargs)
+        cmd._reader.callback_error.return_value = None
+        return cmd
 
     def test_exit_code(self):
         cmd = self.create_cmd()
@@ -356,6 +409,22 @@ class TestCommandTask(unittest.TestCase):
         # task is unregistered in session
         cmd.session._unregister_task.assert_called_once_with(cmd)
 
+    def test_callbacks_released_once_finished(self):
+        class Callback(object):
+            def __call__(self, *args):
+                pass
+        callback = Callback()
+        ref = weakref.ref(callback)
+        cmd = self.create_cmd(on_stdout=callback, on_finished=callback,
+                              on_done=callback)
+        del callback
+        self.assertFalse(hasattr(cmd, '__dict__'))
+        cmd._on_finished()
+        gc.collect()
+        self.assertIsNone(ref())
+        # the on_done callback still marks the error as handled
+        self.assertTrue(cmd.error_handled())
+
     def test_is_running(self):
         cmd = self.create_cmd()
 
@@ -433,3 +502,87 @@ class TestThreadableTask(unittest.TestCase):
         thread = self.create_task(cb, (), {})
         with self.assertRaises(Exception):
             thread.wait()
+
+
+class TestTaskGraph(unittest.TestCase):
+    def setUp(self):
+        self.session = TestableBaseSession()
+        self.order = []
+        self.lock = threading.Lock()
+
+    def start(self, name, duration=0.01, fail=False):
+        def run():
+            time.sleep(duration)
+            with self.lock:
+                self.order.append(name)
+            if fail:
+                raise Exception(name)
+        return lambda: core.ThreadableTask(self.session, run, (), {},
+                                           on_done=Mock())
+
+    def test_dependencies(self):
+        graph = core.TaskGraph()
+        graph.add('c', self.start('c'), depends=['a', 'b'])
+        graph.add('a', self.start('a', 0.05))
+        graph.add('b', self.start('b'))
+        graph.add('d', self.start('d'), depends=['c'])
+        self.assertEqual(graph.run(), [])
+        self.assertEqual(self.order, ['b', 'a', 'c', 'd'])
+        self.assertTrue(all(n.state == 'succeeded'
+                            for n in graph.nodes.values()))
+        self.assertEqual([n.name for n in graph.critical_path()],
+                         ['a', 'c', 'd'])
+        self.assertIn('critical path: a -> c -> d', graph.report())
+
+    def test_skip_dependents_of_failed_nodes(self):
+        graph = core.TaskGraph()
+        graph.add('a', self.start('a', fail=True))
+        graph.add('b', self.start('b'), depends=['a'])
+        graph.add('c', self.start('c'), depends=['b'])
+        graph.add('d', self.start('d'))
+        with self.assertRaises(core.TaskErrors) as cm:
+            graph.run()
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertEqual(sorted(self.order), ['a', 'd'])
+        self.assertEqual([graph.nodes[n].state for n in 'abcd'],
+                         ['failed', 'skipped', 'skipped', 'succeeded'])
+
+    def test_start_error(self):
+        graph = core.TaskGraph()
+
+        def start():
+            raise OSError('cannot start')
+        graph.add('a', start)
+        graph.add('b', self.start('b'), depends=['a'])
+        errors = graph.run(raise_if_error=False)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('cannot start', str(errors[0]))
+        self.assertEqual(graph.nodes['b'].state, 'skipped')
+
+    def test_limits(self):
+        other = TestableBaseSession()
+        graph = core.TaskGraph(host_limit=1)
+        graph.add('a1', self.start('a1', 0.05), sessions=[self.session])
+        graph.add('a2', self.start('a2'), sessions=[self.session])
+        graph.add('b', self.start('b'), sessions=[other])
+        graph.run()
+        # b does not wait for the first host
+        self.assertEqual(self.order, ['b', 'a1', 'a2'])
+        self.assertGreaterEqual(graph.nodes['a2'].queue_wait(), 0.04)
+        self.assertLess(graph.nodes['b'].queue_wait(), 0.04)
+
+        self.order = []
+        graph = core.TaskGraph(max_running=1)
+        graph.add('a', self.start('a', 0.05))
+        graph.add('b', self.start('b'))
+        graph.run()
+        self.assertEqual(self.order, ['a', 'b'])
+
+    def test_invalid_graphs(self):
+        graph = core.TaskGraph()
+        graph.add('a', self.start('a'), depends=['b'])
+        self.assertRaises(ValueError, graph.add, 'a', self.start('a'))
+        self.assertRaises(ValueError, graph.run)
+        graph.add('b', self.start('b'), depends=['a'])
+        self.assertRaises(ValueError, graph.run)
+        self.assertEqual(self.order, [])
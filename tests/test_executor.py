@@ -0,0 +1,196 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from mock import Mock
+
+from rcontrol.executor import ThreadPoolCallbackExecutor
+from rcontrol.local import ProcessReader
+
+
+class TestThreadPoolCallbackExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolCallbackExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_order_is_kept_per_key(self):
+        results = {'a': [], 'b': []}
+
+        def callback(key, i):
+            time.sleep(0.001)
+            results[key].append(i)
+        for i in range(50):
+            self.executor.submit('a', callback, 'a', i)
+            self.executor.submit('b', callback, 'b', i)
+        self.executor.shutdown()
+        self.assertEqual(results['a'], list(range(50)))
+        self.assertEqual(results['b'], list(range(50)))
+
+    def test_keys_run_in_parallel(self):
+        event = threading.Event()
+        done = []
+        # a blocked key does not prevent others from running
+        self.executor.submit('a', event.wait)
+        self.executor.submit('b', done.append, 1)
+        self.executor.submit('b', event.set)
+        self.assertTrue(event.wait(1))
+        self.assertEqual(done, [1])
+
+    def test_priority_and_groups(self):
+        class Key(object):
+            def __init__(self, group, priority):
+                self.group = group
+                self.priority = priority
+        executor = ThreadPoolCallbackExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        event, started = threading.Event(), threading.Event()
+        done = []
+
+        def block():
+            started.set()
+            event.wait()
+        executor.submit(Key('bulk', 0), block)
+        self.assertTrue(started.wait(1))
+        for name, key in (('bulk1', Key('bulk', 0)),
+                          ('bulk2', Key('bulk', 0)),
+                          ('urgent', Key('bulk', 5)),
+                          ('check', Key('health', 0))):
+            executor.submit(key, done.append, name)
+        event.set()
+        executor.shutdown()
+        # the bulk group already had its turn with the blocking callback
+        self.assertEqual(done, ['check', 'urgent', 'bulk1', 'bulk2'])
+
+    def test_exceptions_do_not_stop_the_key(self):
+        done = []
+
+        def fail():
+            raise Exception('expected in tests')
+        self.executor.submit('a', fail)
+        self.executor.submit('a', done.append, 1)
+        self.executor.shutdown()
+        self.assertEqual(done, [1])
+        self.assertEqual([str(e) for e in self.executor.errors],
+                         ['expected in tests'])
+
+    def test_submit_after_shutdown(self):
+        self.executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            self.executor.submit('a', Mock())
+
+
+class TestReaderWithExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolCallbackExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_timeout_with_slow_callback(self):
+        data = []
+        timeout = Mock()
+
+        def slow(line):
+            time.sleep(1)
+            data.append(line)
+        reader = ProcessReader(stdout_callback=slow, timeout=0.2,
+                               timeout_callback=timeout,
+                               callback_executor=self.executor)
+        proc = subprocess.Popen([sys.executable, '-c', '''
+import time
+print(1)
+time.sleep(0.5)
+'''], stdout=subprocess.PIPE)
+        start = time.time()
+        reader.start(proc)
+        reader.thread.join()
+        # the timeout is detected even if the callback is still running
+        self.assertLess(time.time() - start, 0.8)
+        self.assertTrue(reader.is_alive())
+        reader.join_callbacks()
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(data, [b'1'])
+        timeout.assert_called_once_with()
+        proc.wait()
+
+    def test_lines_in_order(self):
+        data = []
+        finished = Mock(side_effect=lambda: data.append('finished'))
+        reader = ProcessReader(stdout_callback=data.append,
+                               finished_callback=finished,
+                               max_queue_lines=5,
+                               callback_executor=self.executor)
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 'for i in range(100): print(i)'],
+                                stdout=subprocess.PIPE)
+        reader.start(proc)
+        reader.thread.join()
+        reader.join_callbacks()
+        proc.wait()
+        self.assertEqual(data, [str(i).encode() for i in range(100)] +
+                         ['finished'])
+
+    def _test_max_bytes_in_executor(self, text):
+        event = threading.Event()
+        data = []
+
+        def callback(line):
+            event.wait()
+            data.append(line)
+        reader = ProcessReader(stdout_callback=callback,
+                               max_queue_bytes=10,
+                               callback_executor=self.executor)
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 'for i in range(100): print("x" * 4)'],
+                                stdout=subprocess.PIPE,
+                                universal_newlines=text)
+        reader.start(proc)
+        time.sleep(0.2)
+        # the lines wait in the queue, not in the executor
+        self.assertEqual(reader._in_flight, 3)
+        event.set()
+        reader.thread.join()
+        reader.join_callbacks()
+        proc.wait()
+        self.assertEqual(len(data), 100)
+
+    def test_max_bytes_in_executor(self):
+        self._test_max_bytes_in_executor(False)
+
+    def test_max_bytes_in_executor_text_lines(self):
+        # like the lines read from an ssh channel
+        self._test_max_bytes_in_executor(True)
+
+    def test_callback_error(self):
+        data = []
+
+        def callback(line):
+            if line == b'1':
+                raise ValueError('bad line')
+            data.append(line)
+        reader = ProcessReader(stdout_callback=callback,
+                               callback_executor=self.executor)
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 'for i in range(3): print(i)'],
+                                stdout=subprocess.PIPE)
+        reader.start(proc)
+        reader.thread.join()
+        reader.join_callbacks()
+        proc.wait()
+        self.assertEqual(data, [b'0', b'2'])
+        self.assertEqual(str(reader.callback_error()), 'bad line')
+        self.assertEqual(self.executor.errors, [])
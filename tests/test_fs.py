@@ -0,0 +1,486 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import Mock, patch
+
+from rcontrol import fs, core
+from rcontrol.local import LocalSession
+
+
+class FsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = LocalSession()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+
+class TestCopyFile(FsTestCase):
+    data = b'some data\n' * 1000
+
+    def test_copy_file(self):
+        src = self.write('src', self.data)
+        fs.copy_file(self.session, src, self.session, self.path('dest'),
+                     chunk_size=100)
+        self.assertEqual(self.read('dest'), self.data)
+
+    def test_copy_file_verify(self):
+        src = self.write('src', self.data)
+        fs.copy_file(self.session, src, self.session, self.path('dest'),
+                     verify='sha256')
+        self.assertEqual(self.read('dest'), self.data)
+
+    def test_copy_file_unsupported_verify(self):
+        src = self.write('src', self.data)
+        with self.assertRaises(ValueError):
+            fs.copy_file(self.session, src, self.session, self.path('dest'),
+                         verify='blake2b')
+        self.assertFalse(os.path.exists(self.path('dest')))
+
+    def test_copy_file_expected_digest(self):
+        src = self.write('src', self.data)
+        digest = hashlib.sha256(self.data).hexdigest()
+        fs.copy_file(self.session, src, self.session, self.path('dest'),
+                     expected_digest=digest)
+
+        with self.assertRaises(core.ChecksumError):
+            fs.copy_file(self.session, src, self.session, self.path('dest'),
+                         verify='sha256', expected_digest='abcd')
+
+    def test_remote_digest(self):
+        src = self.write('src', self.data)
+        self.assertEqual(fs.remote_digest(self.session, src, 'md5'),
+                         hashlib.md5(self.data).hexdigest())
+        with self.assertRaises(ValueError):
+            fs.remote_digest(self.session, src, 'unknown')
+
+    def test_remote_digest_special_name(self):
+        src = self.write('a\\b', self.data)
+        self.assertEqual(fs.remote_digest(self.session, src),
+                         hashlib.sha256(self.data).hexdigest())
+
+    def test_remote_digest_bad_output(self):
+        session = Mock()
+        for output in ([], [u''], [u'not a digest  -']):
+            def execute(command, on_stdout, **kwargs):
+                for line in output:
+                    on_stdout(None, line)
+                return Mock()
+            session.execute.side_effect = execute
+            with self.assertRaises(core.ChecksumError):
+                fs.remote_digest(session, '/a')
+
+
+class SlowFile(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.data = []
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.data.append(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = fs.TokenBucket()
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def test_consume_waits(self):
+        bucket = fs.TokenBucket(1000, burst=100)
+        self.assertEqual(bucket.consume(100), 0)
+        start = time.time()
+        waited = bucket.consume(100)
+        self.assertGreater(waited, 0.05)
+        self.assertGreaterEqual(time.time() - start, waited)
+
+    def test_set_rate(self):
+        bucket = fs.TokenBucket(10, burst=10)
+        bucket.consume(10)
+        bucket.set_rate(10 ** 6)
+        self.assertLess(bucket.consume(1000), 0.01)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+        self.assertRaises(ValueError, bucket.set_rate, 0)
+
+    def test_set_rate_while_waiting(self):
+        bucket = fs.TokenBucket(10, burst=10)
+        bucket.consume(10)
+        waited = []
+        thread = threading.Thread(
+            target=lambda: waited.append(bucket.consume(100)))
+        thread.start()
+        time.sleep(0.1)
+        # without the new rate, the wait would last 10 seconds
+        bucket.set_rate(10 ** 6)
+        thread.join(5)
+        self.assertLess(waited[0], 1)
+
+    def test_waiters_in_order(self):
+        bucket = fs.TokenBucket(1000, burst=100)
+        bucket.consume(100)
+        self.assertGreater(bucket.consume(100), 0.05)
+        start = time.time()
+        waited = []
+        threads = [threading.Thread(
+            target=lambda: waited.append(bucket.consume(50)))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 100 tokens at 1000 per second
+        self.assertGreater(time.time() - start, 0.09)
+        self.assertLess(min(waited), 0.08)
+
+
+class TestBandwidthLimits(FsTestCase):
+    data = b'0123456789' * 1000
+
+    def test_copy_file_stats(self):
+        src = self.write('src', self.data)
+        stats = fs.copy_file(self.session, src, self.session,
+                             self.path('dest'))
+        self.assertEqual(stats.size, len(self.data))
+        self.assertEqual((stats.src, stats.dest), (src, self.path('dest')))
+        self.assertEqual(stats.throttled, 0)
+        self.assertIn('10000 bytes', str(stats))
+
+    def test_rate_limit(self):
+        src = self.write('src', self.data)
+        stats = fs.copy_file(self.session, src, self.session,
+                             self.path('dest'), chunk_size=1000,
+                             rate_limit=fs.TokenBucket(50000, burst=1000))
+        self.assertEqual(self.read('dest'), self.data)
+        # 9000 bytes over the burst at 50000 bytes/s
+        self.assertGreater(stats.throttled, 0.15)
+        self.assertLess(stats.rate, 60000)
+
+    def test_session_limit(self):
+        src = self.write('src', self.data)
+        dest_session = LocalSession()
+        dest_session.set_bandwidth_limit(50000, burst=1000)
+        task = self.session.copy_file(src, dest_session, self.path('dest'),
+                                      chunk_size=1000)
+        task.wait()
+        self.assertGreater(task.result().throttled, 0.15)
+
+    def test_global_limit(self):
+        self.addCleanup(fs.set_bandwidth_limit, None)
+        fs.set_bandwidth_limit(50000, burst=1000)
+        self.write('src', self.data)
+        stats = fs.copy_dir(self.session, self.tmpdir, self.session,
+                            self.path('dest'), chunk_size=1000)
+        self.assertEqual([s.dest for s in stats], [self.path('dest', 'src')])
+        self.assertGreater(stats[0].throttled, 0.15)
+        self.assertEqual(self.read('dest/src'), self.read('src'))
+
+    def test_broadcast_rate_limit(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('dest%d' % i)) for i in range(2)]
+        start = time.time()
+        fs.broadcast_file(self.session, src, dests, chunk_size=1000,
+                          rate_limit=fs.TokenBucket(100000, burst=2000))
+        # the limit counts the data sent to each destination
+        self.assertGreater(time.time() - start, 0.15)
+        for i in range(2):
+            self.assertEqual(self.read('dest%d' % i), self.data)
+
+
+class TestBroadcastFile(FsTestCase):
+    data = b'0123456789' * 1000
+
+    def test_broadcast_file(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('dest%d' % i)) for i in range(5)]
+        slow = fs.broadcast_file(self.session, src, dests, max_parallel=2,
+                                 chunk_size=1000)
+        self.assertEqual(slow, [])
+        for i in range(5):
+            self.assertEqual(self.read('dest%d' % i), self.data)
+
+    def test_slow_destination_is_retried(self):
+        src = self.write('src', self.data)
+        files = [SlowFile(0.5), SlowFile(0)]
+        slow_session = Mock(open=Mock(side_effect=files))
+        dests = [(slow_session, 'slow'), (self.session, self.path('dest'))]
+        slow = fs.broadcast_file(self.session, src, dests, chunk_size=1000,
+                                 queue_size=1, slow_timeout=0.05)
+        self.assertEqual(slow, [(slow_session, 'slow')])
+        self.assertEqual(self.read('dest'), self.data)
+        # the retry got the full content
+        self.assertEqual(b''.join(files[1].data), self.data)
+
+    def test_broadcast_errors(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('nodir', 'dest')),
+                 (self.session, self.path('dest'))]
+        with self.assertRaises(core.TaskErrors) as cm:
+            fs.broadcast_file(self.session, src, dests)
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertEqual(self.read('dest'), self.data)
+
+    def test_rate_limit(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('dest%d' % i)) for i in range(3)]
+        bucket = fs.TokenBucket(10 ** 6)
+        with patch.object(LocalSession, 's_copy_file',
+                          autospec=True,
+                          side_effect=LocalSession.s_copy_file) as copy:
+            fs.distribute_file(self.session, src, dests, rate_limit=bucket)
+        self.assertEqual(copy.call_count, 3)
+        for call in copy.call_args_list:
+            # the direct copies would not be limited
+            self.assertFalse(call[1]['direct'])
+            self.assertIs(call[1]['rate_limit'], bucket)
+        for i in range(3):
+            self.assertEqual(self.read('dest%d' % i), self.data)
+
+
+class BrokenSourceSession(LocalSession):
+    """A local session that can receive files, but not send them"""
+    def open(self, filename, mode='r', bufsize=-1):
+        if 'r' in mode:
+            raise IOError('can not read %s' % filename)
+        return LocalSession.open(self, filename, mode=mode, bufsize=bufsize)
+
+
+class TestDistributeFile(FsTestCase):
+    data = b'0123456789' * 100
+
+    def test_distribute_file(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('dest%d' % i)) for i in range(10)]
+        parents = fs.distribute_file(self.session, src, dests, fanout=2,
+                                     seeds=1)
+        for i in range(10):
+            self.assertEqual(self.read('dest%d' % i), self.data)
+        # the first host got the file from the source
+        self.assertEqual(parents[0], (self.session, src))
+        # others got it from relays
+        self.assertTrue(any(p != (self.session, src) for p in parents[1:]))
+
+    def test_reparent_around_failed_nodes(self):
+        src = self.write('src', self.data)
+        broken = BrokenSourceSession()
+        dests = [(broken, self.path('broken'))] + [
+            (self.session, self.path('dest%d' % i)) for i in range(5)]
+        parents = fs.distribute_file(self.session, src, dests, fanout=1,
+                                     seeds=1, max_source_failures=1)
+        for i in range(5):
+            self.assertEqual(self.read('dest%d' % i), self.data)
+        self.assertNotIn((broken, self.path('broken')), parents)
+
+    def test_unreachable_destination(self):
+        src = self.write('src', self.data)
+        dests = [(self.session, self.path('nodir', 'dest')),
+                 (self.session, self.path('dest'))]
+        with self.assertRaises(core.TaskErrors) as cm:
+            fs.distribute_file(self.session, src, dests, retries=1)
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertEqual(self.read('dest'), self.data)
+
+
+class TestRelayBlame(unittest.TestCase):
+    def setUp(self):
+        self.root = fs._RelayNode(None, 'src')
+        self.parents = [fs._RelayNode(None, 'p%d' % i) for i in range(3)]
+
+    def test_broken_destination_is_charged(self):
+        dead = fs._RelayNode(None, 'dead')
+        fs._blame(self.root, self.root, dead, 1)
+        for parent in self.parents:
+            fs._blame(self.root, parent, dead, 1)
+        self.assertEqual(dead.attempts, 4)
+        self.assertEqual(dead.bad_parents, set(self.parents))
+        for parent in self.parents:
+            self.assertFalse(parent.evicted)
+
+    def test_parent_failing_for_different_nodes(self):
+        parent = self.parents[0]
+        nodes = [fs._RelayNode(None, 'n%d' % i) for i in range(2)]
+        fs._blame(self.root, parent, nodes[0], 2)
+        self.assertFalse(parent.evicted)
+        fs._blame(self.root, parent, nodes[1], 2)
+        self.assertTrue(parent.evicted)
+        # the second node fails with another parent too: it was not the
+        # parent fault
+        self.assertEqual(fs._blame(self.root, self.parents[1], nodes[1], 2),
+                         [parent])
+        self.assertFalse(parent.evicted)
+        self.assertFalse(self.parents[1].evicted)
+
+
+class TestPutCached(FsTestCase):
+    def setUp(self):
+        FsTestCase.setUp(self)
+        self.cache = self.path('cache')
+
+    def put(self, name, dest, **kwargs):
+        return fs.put_cached(self.session, self.path(name), self.session,
+                             self.path(dest), cache_dir=self.cache, **kwargs)
+
+    def test_put_cached(self):
+        data = b'bundle' * 100
+        self.write('src', data)
+        self.assertFalse(self.put('src', 'dest1'))
+        self.assertEqual(self.read('dest1'), data)
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(os.listdir(self.cache), [digest])
+        # now this is in cache
+        self.assertTrue(self.put('src', 'dest2'))
+        self.assertEqual(self.read('dest2'), data)
+        # a copy by default
+        self.assertEqual(os.stat(self.path('dest2')).st_nlink, 1)
+
+    def test_put_cached_link(self):
+        self.write('src', b'data')
+        self.put('src', 'dest1')
+        self.assertTrue(self.put('src', 'dest2', link=True))
+        self.assertEqual(self.read('dest2'), b'data')
+        digest = hashlib.sha256(b'data').hexdigest()
+        self.assertEqual(os.stat(self.path('dest2')).st_ino,
+                         os.stat(os.path.join(self.cache, digest)).st_ino)
+
+    def test_put_cached_invalid_digest(self):
+        self.write('src', b'data')
+        for digest in ('x; rm -rf ~', 'AB' * 32, 'ab' * 31):
+            with self.assertRaises(ValueError):
+                self.put('src', 'dest', digest=digest)
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_evict_cache(self):
+        for i in range(3):
+            self.write('src%d' % i, b'x' * 100 * (i + 1))
+            self.put('src%d' % i, 'dest%d' % i)
+            # ensure distinct mtimes
+            digest = hashlib.sha256(self.read('src%d' % i)).hexdigest()
+            os.utime(os.path.join(self.cache, digest), (i, i))
+        # use the first one, it becomes the most recently used
+        self.assertTrue(self.put('src0', 'dest'))
+        removed = fs.evict_cache(self.session, 400, cache_dir=self.cache)
+        self.assertEqual(removed,
+                         [hashlib.sha256(self.read('src1')).hexdigest()])
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+
+class TestFind(FsTestCase):
+    def setUp(self):
+        FsTestCase.setUp(self)
+        for path in ('a/.git', 'b'):
+            os.makedirs(self.path(path))
+        for name in ('a/x.log', 'a/.git/y.log', 'b/z.txt', 'top.log'):
+            self.write(name, b'data')
+        os.utime(self.path('top.log'), (1000, 1000))
+
+    def find(self, **kwargs):
+        return sorted(e.path[len(self.tmpdir) + 1:]
+                      for e in fs.find(self.session, self.tmpdir, **kwargs))
+
+    def test_find(self):
+        self.assertEqual(self.find(), ['a', 'a/.git', 'a/.git/y.log',
+                                       'a/x.log', 'b', 'b/z.txt', 'top.log'])
+
+    def test_include_exclude(self):
+        self.assertEqual(self.find(include=['*.log'], exclude=['.git']),
+                         ['a/x.log', 'top.log'])
+
+    def test_mtime_and_depth(self):
+        self.assertEqual(self.find(max_mtime=2000), ['top.log'])
+        self.assertEqual(self.find(min_mtime=2000, max_depth=1), ['a', 'b'])
+        self.assertEqual(self.find(max_depth=0), [])
+
+    def test_entries(self):
+        entry = list(fs.find(self.session, self.tmpdir, include=['top.*']))[0]
+        self.assertEqual(entry, (self.path('top.log'), 'f', 4, 1000))
+
+
+class TestCopyDir(FsTestCase):
+    def test_copy_dir(self):
+        os.makedirs(self.path('src/a/b'))
+        os.makedirs(self.path('src/c'))
+        self.write('src/a/b/f', b'data')
+        dest_session = LocalSession()
+        dest_session.apply_fs_ops = Mock(
+            side_effect=dest_session.apply_fs_ops)
+        fs.copy_dir(self.session, self.path('src'), dest_session,
+                    self.path('dest'))
+        # all the directories are created at once
+        self.assertEqual(dest_session.apply_fs_ops.call_count, 1)
+        self.assertEqual(
+            sorted(dest_session.apply_fs_ops.call_args[0][0]),
+            [('mkdir', self.path(p)) for p in ('dest', 'dest/a',
+                                               'dest/a/b', 'dest/c')])
+        self.assertEqual(self.read('dest/a/b/f'), b'data')
+
+
+class TestFsOpsScript(unittest.TestCase):
+    def test_script(self):
+        self.assertEqual(fs.fs_ops_script([
+            ('mkdir', '/a'), ('mkdir', '/a/b c'), ('mkdir', '/d', 0o700),
+            ('chmod', '/a', 0o755), ('chmod', '/d', 0o755),
+            ('rename', '/a', '/e'), ('symlink', '/e', '/l'),
+            ('unlink', '/l'),
+        ]), "mkdir -- /a '/a/b c'\n"
+            "mkdir -m 700 -- /d\n"
+            "chmod 755 -- /a /d\n"
+            "mv -f -- /a /e\n"
+            "ln -s -- /e /l\n"
+            "rm -- /l\n")
+
+    def test_batches(self):
+        script = fs.fs_ops_script([('unlink', str(i)) for i in range(5)],
+                                  batch_size=2)
+        self.assertEqual(script, 'rm -- 0 1\nrm -- 2 3\nrm -- 4\n')
+
+    def test_invalid_op(self):
+        with self.assertRaises(ValueError):
+            fs.fs_ops_script([('chown', '/a', 0)])
+
+
+class TestCommandStat(FsTestCase):
+    def test_many_paths_in_one_command(self):
+        paths = [self.write('f%d' % i, b'x' * i) for i in range(3000)]
+        self.session.execute = Mock(side_effect=self.session.execute)
+        result = fs._command_stat(self.session,
+                                  paths + [self.path('missing')])
+        self.assertEqual(self.session.execute.call_count, 1)
+        self.assertEqual(len(result), 3000)
+        self.assertEqual(result[paths[12]][1], 12)
+        self.assertEqual(result[paths[12]][0], os.stat(paths[12]).st_mode)
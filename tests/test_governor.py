@@ -0,0 +1,184 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from rcontrol.core import TaskError, ThreadableTask
+from rcontrol.governor import ResourceGovernor, set_governor, get_governor
+from rcontrol.local import LocalSession
+
+
+class TestResourceGovernor(unittest.TestCase):
+    def test_limits(self):
+        governor = ResourceGovernor(limits={'channels': 2})
+        self.assertTrue(governor.acquire('a', channels=1))
+        self.assertTrue(governor.acquire('b', channels=1))
+        self.assertFalse(governor.acquire('c', channels=1, timeout=0.01))
+        governor.release('a', channels=1)
+        self.assertTrue(governor.acquire('c', channels=1, timeout=0.01))
+        self.assertEqual(governor.usage(), {
+            'total': {'channels': 2, 'threads': 0, 'fds': 0},
+            'hosts': {'b': {'channels': 1}, 'c': {'channels': 1}},
+            'waiting': 0,
+        })
+
+    def test_host_limits(self):
+        governor = ResourceGovernor(host_limits={'channels': 1})
+        self.assertTrue(governor.acquire('a', channels=1))
+        self.assertTrue(governor.acquire('b', channels=1))
+        self.assertFalse(governor.acquire('a', channels=1, timeout=0.01))
+
+    def test_host_limit_does_not_block_other_hosts(self):
+        governor = ResourceGovernor(limits={'channels': 3},
+                                    host_limits={'channels': 1})
+        governor.acquire('a', channels=1)
+        governor.acquire('b', channels=1)
+        granted = []
+        threads = []
+        for host, priority in (('a', 10), ('b', 0), ('c', 0)):
+            thread = threading.Thread(
+                target=lambda h=host, p=priority: granted.append(
+                    governor.acquire(h, priority=p, group='all',
+                                     channels=1) and h))
+            thread.start()
+            threads.append(thread)
+            while governor.usage()['waiting'] + len(granted) < len(threads):
+                time.sleep(0.001)
+        # the waiters of a and b are blocked by their host limit, but c
+        # is granted
+        threads[2].join(5)
+        self.assertEqual(granted, ['c'])
+        governor.release('b', channels=1)
+        threads[1].join(5)
+        self.assertEqual(granted, ['c', 'b'])
+        governor.release('a', channels=1)
+        threads[0].join(5)
+        self.assertEqual(granted, ['c', 'b', 'a'])
+
+    def test_oversized_request(self):
+        governor = ResourceGovernor(limits={'threads': 2})
+        self.assertTrue(governor.acquire(threads=5, timeout=0.01))
+        self.assertFalse(governor.acquire(threads=1, timeout=0.01))
+
+    def test_waiters_in_order(self):
+        governor = ResourceGovernor(limits={'fds': 2})
+        governor.acquire(fds=2)
+        order = []
+
+        def acquire(name, count):
+            governor.acquire(fds=count)
+            order.append(name)
+
+        threads = []
+        for name, count in (('big', 2), ('small', 1)):
+            thread = threading.Thread(target=acquire, args=(name, count))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.05)
+        # the small request does not pass before the big one
+        governor.release(fds=1)
+        time.sleep(0.05)
+        self.assertEqual(order, [])
+        governor.release(fds=1)
+        threads[0].join()
+        governor.release(fds=2)
+        threads[1].join()
+        self.assertEqual(order, ['big', 'small'])
+        stats = governor.stats()['fds']
+        self.assertEqual(stats['waits'], 2)
+        self.assertGreater(stats['wait_time'], 0)
+        self.assertEqual(stats['peak'], 2)
+
+    def test_fair_and_priority_waiters(self):
+        governor = ResourceGovernor(limits={'fds': 1})
+        governor.acquire(fds=1)
+        order = []
+        acquired = threading.Semaphore(0)
+
+        def acquire(name, group, priority):
+            governor.acquire(group=group, priority=priority, fds=1)
+            order.append(name)
+            acquired.release()
+
+        threads = []
+        for args in (('bulk1', 'bulk', 0), ('bulk2', 'bulk', 0),
+                     ('bulk3', 'bulk', 0), ('urgent', 'bulk', 10),
+                     ('check', 'health', 0)):
+            thread = threading.Thread(target=acquire, args=args)
+            thread.start()
+            threads.append(thread)
+            # wait for the request to be queued, to keep the order
+            while governor.usage()['waiting'] < len(threads):
+                time.sleep(0.001)
+        for _ in threads:
+            governor.release(fds=1)
+            acquired.acquire()
+        self.assertEqual(order, ['urgent', 'check', 'bulk1', 'bulk2',
+                                 'bulk3'])
+
+    def test_nested_does_not_wait(self):
+        governor = ResourceGovernor(limits={'threads': 1})
+        with governor.reserve(threads=1):
+            self.assertTrue(governor.acquire(threads=1, timeout=0))
+            self.assertEqual(governor.usage()['total']['threads'], 2)
+
+
+class TestGovernedTasks(unittest.TestCase):
+    def setUp(self):
+        self.governor = ResourceGovernor(limits={'fds': 2})
+        set_governor(self.governor)
+        self.addCleanup(set_governor, None)
+
+    def test_execute_waits_for_slots(self):
+        self.assertIs(get_governor(), self.governor)
+        session = LocalSession()
+        tasks = [session.execute('sleep 0.1') for _ in range(4)]
+        for task in tasks:
+            task.wait()
+        stats = self.governor.stats()
+        self.assertEqual(stats['fds']['peak'], 2)
+        self.assertGreater(stats['fds']['waits'], 0)
+        self.assertEqual(self.governor.usage()['total'],
+                         {'fds': 0, 'threads': 0, 'channels': 0})
+
+    def test_callback_error_releases_the_resources(self):
+        session = LocalSession()
+
+        def on_stdout(task, line):
+            raise ValueError('bad line')
+        task = session.execute('echo hi', on_stdout=on_stdout)
+        with self.assertRaises(TaskError) as cm:
+            task.wait()
+        self.assertIn('bad line', str(cm.exception))
+        self.assertEqual(self.governor.usage()['total'],
+                         {'fds': 0, 'threads': 0, 'channels': 0})
+        self.assertEqual(session.tasks(), [])
+        self.assertEqual(session.execute('true').wait(), 0)
+
+    def test_threadable_task(self):
+        session = LocalSession()
+        results = []
+
+        def run():
+            # does not wait for the threads of the running task
+            task = session.execute('echo 1', on_stdout=lambda t, line:
+                                   results.append(line))
+            task.wait()
+        self.governor.set_limit('threads', 1)
+        ThreadableTask(session, run, (), {}).wait()
+        self.assertEqual(results, [b'1'])
+        self.assertEqual(self.governor.usage()['total']['threads'], 0)
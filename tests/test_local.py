@@ -13,10 +13,18 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
+import shutil
+import stat
 import sys
+import tempfile
+import time
 import unittest
 
-from rcontrol import local
+from rcontrol import local, core
+from rcontrol.local import LocalSession
+from rcontrol.executor import ThreadPoolCallbackExecutor
 
 
 class TestLocalSession(unittest.TestCase):
@@ -28,3 +36,246 @@ class TestLocalSession(unittest.TestCase):
         task = self.session.execute(cmd)
         task.wait()
         self.assertIsInstance(task, local.LocalExec)
+
+    def test_run_argv(self):
+        out = []
+        task = self.session.execute(
+            [sys.executable, '-c', 'import sys; print(sys.argv[1:])', '$a b'],
+            on_stdout=lambda t, line: out.append(line))
+        task.wait()
+        self.assertEqual(out, [b"['$a b']"])
+
+    def test_run_argv_not_found(self):
+        with self.assertRaises(OSError):
+            self.session.execute(['/this/does/not/exist'])
+        self.assertEqual(self.session.tasks(), [])
+
+    def test_wait_for_callbacks_in_executor(self):
+        executor = ThreadPoolCallbackExecutor()
+        self.addCleanup(executor.shutdown)
+        finished = []
+
+        def on_finished(task):
+            time.sleep(0.1)
+            finished.append(task)
+        task = self.session.execute('echo 1', on_finished=on_finished,
+                                    callback_executor=executor)
+        task.wait()
+        self.assertEqual(finished, [task])
+        self.assertFalse(task.is_running())
+        self.assertEqual(self.session.tasks(), [])
+
+    def test_callback_error_in_executor(self):
+        executor = ThreadPoolCallbackExecutor()
+        self.addCleanup(executor.shutdown)
+
+        def on_stdout(task, line):
+            raise ValueError('bad line')
+        task = self.session.execute('echo 1', on_stdout=on_stdout,
+                                    callback_executor=executor)
+        with self.assertRaises(core.TaskError) as cm:
+            task.wait()
+        self.assertIn('bad line', str(cm.exception))
+
+    def _run_cat(self, **kwargs):
+        out = []
+        task = self.session.execute(
+            'cat', on_stdout=lambda t, line: out.append(line), **kwargs)
+        return task, out
+
+    def test_stdin_bytes(self):
+        task, out = self._run_cat(stdin=b'1\n2\n')
+        task.wait()
+        self.assertEqual(out, [b'1', b'2'])
+
+    def test_stdin_file(self):
+        task, out = self._run_cat(stdin=io.BytesIO(b'x' * 100000))
+        task.wait()
+        self.assertEqual(out, [b'x' * 100000])
+
+    def test_stdin_iterator(self):
+        task, out = self._run_cat(stdin=(b'%d\n' % i for i in range(3)))
+        task.wait()
+        self.assertEqual(out, [b'0', b'1', b'2'])
+
+    def test_stdin_write(self):
+        task, out = self._run_cat(stdin=True)
+        task.write(b'hello\n')
+        task.close_stdin()
+        task.wait()
+        self.assertEqual(out, [b'hello'])
+
+    def test_stdin_read_error(self):
+        def chunks():
+            yield b'1\n'
+            raise IOError('disk error')
+        task, out = self._run_cat(stdin=chunks())
+        with self.assertRaises(core.TaskError) as cm:
+            task.wait()
+        self.assertIn('disk error', str(cm.exception))
+        self.assertEqual(task.exit_code(), 0)
+        self.assertEqual(out, [b'1'])
+
+    def test_stdin_not_read(self):
+        # the broken pipe is not an error
+        task = self.session.execute('exit 0', stdin=b'x' * 1000000)
+        self.assertEqual(task.wait(), 0)
+
+    def test_write_requires_stdin(self):
+        task = self.session.execute('true')
+        self.assertRaises(ValueError, task.write, b'data')
+        self.assertRaises(ValueError, task.close_stdin)
+        task.wait()
+
+    def test_wait_for_output(self):
+        task = self.session.execute(
+            "echo starting; echo ready >&2; sleep 1",
+            output_patterns=[b'rea(dy)'])
+        self.addCleanup(task.wait)
+        match = task.wait_for_output(b'rea(dy)', timeout=5)
+        self.assertEqual(match.group(1), b'dy')
+        self.assertTrue(task.is_running())
+
+    def test_wait_for_output_timeout(self):
+        task = self.session.execute("sleep 1")
+        self.addCleanup(task.wait)
+        with self.assertRaises(core.TimeoutError):
+            task.wait_for_output(b'ready', timeout=0.1)
+
+    def test_wait_for_output_finished(self):
+        task = self.session.execute("echo done")
+        self.assertIsNone(task.wait_for_output(b'ready', timeout=5))
+        self.assertFalse(task.is_running())
+
+    def test_output_patterns(self):
+        found = []
+        task = self.session.execute(
+            "printf 'a 1\\nb 2\\na 3\\n'",
+            output_patterns={
+                b'a (\\d)': lambda t, m: found.append(m.group(1)),
+            })
+        task.wait()
+        self.assertEqual(found, [b'1', b'3'])
+
+    def test_wait_for_output_printed_before(self):
+        task = self.session.execute("echo ready; sleep 1")
+        self.addCleanup(task.wait)
+        time.sleep(0.2)
+        self.assertEqual(task.wait_for_output(b'ready', timeout=5).group(0),
+                         b'ready')
+
+    def test_output_pattern_callback_error(self):
+        def callback(task, match):
+            raise ValueError('bad match')
+        task = self.session.execute("echo a; echo b",
+                                    output_patterns={b'a': callback})
+        with self.assertRaises(core.TaskError) as cm:
+            task.wait()
+        self.assertIn('bad match', str(cm.exception))
+
+
+class TestLocalSessionFs(unittest.TestCase):
+    def setUp(self):
+        self.session = LocalSession()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    def test_makedirs(self):
+        self.session.makedirs(self.path('a/b'))
+        self.session.makedirs(self.path('a/b'))
+        self.assertTrue(os.path.isdir(self.path('a/b')))
+        with self.assertRaises(OSError):
+            self.session.makedirs(self.path('a/b'), exist_ok=False)
+
+    def test_apply_fs_ops(self):
+        self.session.apply_fs_ops([
+            ('mkdir', self.path('a')),
+            ('mkdir', self.path('b'), 0o700),
+            ('symlink', 'a', self.path('l')),
+            ('rename', self.path('a'), self.path('c')),
+            ('chmod', self.path('c'), 0o750),
+        ])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['b', 'c', 'l'])
+        self.assertEqual(os.readlink(self.path('l')), 'a')
+        self.assertEqual(os.stat(self.path('c')).st_mode & 0o777, 0o750)
+        self.session.apply_fs_ops([('unlink', self.path('l'))])
+        self.assertFalse(os.path.lexists(self.path('l')))
+
+    def test_default_apply_fs_ops(self):
+        # the generic implementation, with a shell script
+        core.BaseSession.apply_fs_ops(self.session, [
+            ('mkdir', self.path('a')),
+            ('rename', self.path('a'), self.path('b c')),
+        ])
+        self.assertEqual(os.listdir(self.tmpdir), ['b c'])
+        with self.assertRaises(IOError):
+            core.BaseSession.apply_fs_ops(self.session,
+                                          [('unlink', self.path('d'))])
+
+    def test_default_stat(self):
+        # the generic implementation, with the stat command
+        path = self.path('a b ')
+        with open(path, 'w') as f:
+            f.write('data')
+        os.symlink(path, self.path('l'))
+        attr = core.BaseSession.stat(self.session, self.path('l'))
+        self.assertEqual(attr.st_size, 4)
+        self.assertEqual(attr.st_mtime, int(os.stat(path).st_mtime))
+        attr = core.BaseSession.stat(self.session, self.path('l'),
+                                     follow_symlinks=False)
+        self.assertTrue(stat.S_ISLNK(attr.st_mode))
+        with self.assertRaises(OSError):
+            core.BaseSession.stat(self.session, self.path('c'))
+
+
+class TestPipe(unittest.TestCase):
+    def setUp(self):
+        self.session = LocalSession()
+
+    def _pipe(self, src, dest, **kwargs):
+        out = []
+        pipeline = core.pipe(self.session, src, self.session, dest,
+                             dest_kwargs=dict(
+                                 on_stdout=lambda t, line: out.append(line)),
+                             **kwargs)
+        return pipeline, out
+
+    def test_pipe(self):
+        pipeline, out = self._pipe("seq 1 20000", "wc -l")
+        self.assertEqual(pipeline.wait(), [0, 0])
+        self.assertEqual(out, [b'20000'])
+
+    def test_pipe_compress(self):
+        pipeline, out = self._pipe("seq 1 20000", "tail -n 1",
+                                   compress='gzip')
+        self.assertEqual(pipeline.wait(), [0, 0])
+        self.assertEqual(out, [b'20000'])
+
+    def test_pipe_errors(self):
+        pipeline, out = self._pipe("echo 1; exit 2", "cat; exit 3",
+                                   compress='gzip')
+        with self.assertRaises(core.TaskErrors) as cm:
+            pipeline.wait()
+        self.assertEqual(len(cm.exception.errors), 2)
+        self.assertEqual(pipeline.exit_codes(), [2, 3])
+        self.assertEqual(out, [b'1'])
+
+    def test_dest_exits_early(self):
+        pipeline, out = self._pipe("seq 1 1000000000", "head -n 1",
+                                   buffer_size=1)
+        with self.assertRaises(core.TaskErrors) as cm:
+            pipeline.wait()
+        self.assertEqual(out, [b'1'])
+        self.assertEqual(pipeline.exit_codes()[1], 0)
+        # the source is stopped, the pipeline is failed
+        self.assertTrue(pipeline.broken)
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertIs(cm.exception.errors[0].task, pipeline.tasks[0])
+
+    def test_dest_reads_everything(self):
+        pipeline, out = self._pipe("echo 1", "sleep 0.2; head -n 1")
+        self.assertEqual(pipeline.wait(), [0, 0])
+        self.assertFalse(pipeline.broken)
@@ -0,0 +1,110 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import unittest
+from mock import Mock, MagicMock
+
+from rcontrol.matcher import OutputMatcher
+
+
+class TestOutputMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = OutputMatcher()
+
+    def test_callbacks(self):
+        error, ready = Mock(), Mock()
+        self.matcher.add(r'error: (\w+)', error)
+        self.matcher.add('ready', ready)
+        for line in (u'starting', u'error: disk', u'ready', u'error: net'):
+            self.matcher.feed(line)
+        self.assertEqual([c[0][0].group(1) for c in error.call_args_list],
+                         ['disk', 'net'])
+        self.assertEqual(ready.call_count, 1)
+
+    def test_plain_and_bytes(self):
+        callback = Mock()
+        self.matcher.add(u'a.b', callback, plain=True)
+        self.matcher.feed(b'axb')
+        self.assertFalse(callback.called)
+        self.matcher.feed(b'[a.b]')
+        self.assertEqual(callback.call_args[0][0].group(0), b'a.b')
+
+    def test_wait_previous_match(self):
+        self.matcher.add(u'ready')
+        self.matcher.feed(u'ready')
+        self.assertEqual(self.matcher.wait(u'ready').group(0), u'ready')
+
+    def test_wait_from_thread(self):
+        timer = threading.Timer(0.05, self.matcher.feed, args=(u'ready',))
+        timer.start()
+        self.assertIsNotNone(self.matcher.wait(u'ready', timeout=5))
+
+    def test_wait_finished(self):
+        self.matcher.finish()
+        self.assertIsNone(self.matcher.wait(u'ready'))
+
+    def test_wait_timeout(self):
+        self.assertIsNone(self.matcher.wait(u'ready', timeout=0.05))
+        self.assertFalse(self.matcher.is_finished())
+
+    def test_groups_and_flags(self):
+        first, second, third = Mock(), Mock(), Mock()
+        self.matcher.add(r'(?P<name>\w+)=', first)
+        self.matcher.add(r'(?P<name>\w+):(\w)\2', second)
+        self.matcher.add(r'(?i)ERROR', third)
+        self.matcher.add(u'plain', plain=True)
+        self.matcher.feed(u'key:aa error')
+        self.assertIsNone(self.matcher.error)
+        self.assertFalse(first.called)
+        self.assertEqual(second.call_args[0][0].group('name'), u'key')
+        self.assertTrue(third.called)
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(re.error):
+            self.matcher.add(u'(')
+
+    def test_callback_error(self):
+        callback = Mock(side_effect=[ValueError('bad'), None])
+        self.matcher.add(u'ready', callback)
+        self.matcher.feed(u'ready')
+        self.matcher.feed(u'ready')
+        self.assertEqual(str(self.matcher.error), 'bad')
+        self.assertEqual(callback.call_count, 2)
+        # waiting stops on the error
+        self.assertIsNone(self.matcher.wait(u'other', timeout=5))
+
+    def test_wait_recent_lines(self):
+        self.matcher.feed(u'ready 1')
+        self.matcher.feed(u'ready 2')
+        self.assertEqual(self.matcher.wait(u'ready \\d').group(0),
+                         u'ready 1')
+
+    def test_history_is_bounded(self):
+        matcher = OutputMatcher(history=2)
+        for line in (u'ready', u'a', u'b'):
+            matcher.feed(line)
+        self.assertIsNone(matcher.wait(u'ready', timeout=0.01))
+
+    def test_history_dropped_on_finish(self):
+        self.matcher.feed(u'ready')
+        self.matcher.finish()
+        self.assertIsNone(self.matcher.wait(u'ready'))
+
+    def test_feed_without_pattern_does_not_lock(self):
+        self.matcher._cond = MagicMock()
+        self.matcher.feed(u'ready')
+        self.assertFalse(self.matcher._cond.__enter__.called)
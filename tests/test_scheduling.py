@@ -0,0 +1,100 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from rcontrol.scheduling import FairQueue
+
+
+class TestFairQueue(unittest.TestCase):
+    def pop_all(self, queue):
+        items = []
+        while queue:
+            items.append(queue.pop())
+        return items
+
+    def test_fifo_in_a_group(self):
+        queue = FairQueue()
+        for i in range(5):
+            queue.push(i)
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(queue.peek(), 0)
+        self.assertEqual(self.pop_all(queue), [0, 1, 2, 3, 4])
+        self.assertRaises(IndexError, queue.pop)
+
+    def test_priority_in_a_group(self):
+        queue = FairQueue()
+        queue.push('low1')
+        queue.push('high', priority=5)
+        queue.push('low2')
+        self.assertEqual(self.pop_all(queue), ['high', 'low1', 'low2'])
+
+    def test_fair_across_groups(self):
+        queue = FairQueue()
+        for i in range(4):
+            queue.push('bulk%d' % i, group='bulk')
+        queue.push('check0', group='health')
+        queue.push('check1', group='health')
+        self.assertEqual(self.pop_all(queue),
+                         ['bulk0', 'check0', 'bulk1', 'check1', 'bulk2',
+                          'bulk3'])
+
+    def test_weights(self):
+        queue = FairQueue(weights={'a': 3})
+        for i in range(6):
+            queue.push('a', group='a')
+            queue.push('b', group='b')
+        self.assertEqual(''.join(self.pop_all(queue)[:8]), 'abaabaaa')
+
+    def test_idle_group_gets_no_credit(self):
+        queue = FairQueue()
+        for i in range(4):
+            queue.push('a', group='a')
+        for i in range(3):
+            queue.pop()
+        for i in range(3):
+            queue.push('b', group='b')
+        queue.push('a', group='a')
+        # b starts at the current virtual time: it is one turn ahead of
+        # a, but it does not get its 3 items before a
+        self.assertEqual(''.join(self.pop_all(queue)), 'babba')
+
+    def test_remove(self):
+        queue = FairQueue()
+        queue.push('a')
+        queue.push('b', group=1)
+        queue.remove('b')
+        self.assertEqual(len(queue), 1)
+        self.assertRaises(ValueError, queue.remove, 'b')
+        self.assertRaises(ValueError, queue.set_weight, 1, 0)
+
+    def test_iteration_order(self):
+        queue = FairQueue(weights={'a': 2})
+        for i in range(4):
+            queue.push('a%d' % i, group='a')
+            queue.push('b%d' % i, group='b', priority=i)
+        expected = ['a0', 'b3', 'a1', 'a2', 'b2', 'a3', 'b1', 'b0']
+        self.assertEqual(list(queue), expected)
+        self.assertEqual(self.pop_all(queue), expected)
+
+    def test_pop_item(self):
+        queue = FairQueue()
+        queue.push('a0', group='a')
+        queue.push('a1', group='a')
+        queue.push('b0', group='b')
+        self.assertEqual(queue.pop('a1'), 'a1')
+        # a1 counts in the share of a
+        self.assertEqual(self.pop_all(queue), ['b0', 'a0'])
+        self.assertRaises(ValueError, queue.pop, 'a1')
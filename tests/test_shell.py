@@ -0,0 +1,184 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from mock import Mock
+
+from rcontrol import core, shell
+from rcontrol.local import LocalSession, LocalShell
+
+
+class TestDemultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.demux = shell.Demultiplexer('TOKEN')
+
+    def test_dispatch_in_order(self):
+        task1, task2 = Mock(), Mock()
+        self.demux.add(task1)
+        self.demux.add(task2)
+
+        self.demux.stdout_line(b'line1\n')
+        self.demux.stdout_line(b'partTOKEN 3\n')
+        self.demux.stdout_line(b'line2\n')
+        self.demux.stderr_line(b'TOKEN\n')
+        self.demux.stderr_line(b'err2\n')
+
+        task1._feed_stdout.assert_any_call(b'line1\n')
+        task1._feed_stdout.assert_any_call(b'part')
+        task1._end_stdout.assert_called_once_with(3)
+        task1._end_stderr.assert_called_once_with()
+        task2._feed_stdout.assert_called_once_with(b'line2\n')
+        task2._feed_stderr.assert_called_once_with(b'err2\n')
+        self.assertFalse(task2._end_stdout.called)
+
+    def test_begin(self):
+        task1, task2, task3 = Mock(), Mock(), Mock()
+        self.demux.add(task1)
+        self.demux.add(task2)
+        self.assertFalse(task1._begin.called)
+        self.demux.start()
+        task1._begin.assert_called_once_with()
+        self.assertFalse(task2._begin.called)
+        self.demux.stdout_line(b'TOKEN 0\n')
+        task2._begin.assert_called_once_with()
+        self.demux.add(task3)
+        self.assertFalse(task3._begin.called)
+
+    def test_begin_output_read_before_start(self):
+        task1, task2 = Mock(), Mock()
+        self.demux.add(task1)
+        self.demux.add(task2)
+        self.demux.stdout_line(b'TOKEN 0\n')
+        self.assertFalse(task2._begin.called)
+        self.demux.start()
+        task1._begin.assert_called_once_with()
+        task2._begin.assert_called_once_with()
+
+    def test_begin_concurrent(self):
+        demux = shell.Demultiplexer('TOKEN', concurrent=True)
+        task1, task2, task3 = Mock(), Mock(), Mock()
+        demux.add(task1)
+        demux.add(task2)
+        demux.start()
+        demux.add(task3)
+        for task in (task1, task2, task3):
+            task._begin.assert_called_once_with()
+
+    def test_abort(self):
+        task1, task2 = Mock(), Mock()
+        self.demux.add(task1)
+        self.demux.abort('gone')
+        task1._abort.assert_called_once_with('gone')
+        # tasks added later are aborted
+        self.demux.add(task2)
+        task2._abort.assert_called_once_with('gone')
+
+
+class TestLocalShell(unittest.TestCase):
+    def setUp(self):
+        self.session = LocalSession()
+        self.shell = self.session.open_shell()
+        self.addCleanup(self.session.close)
+
+    def test_execute(self):
+        self.assertIsInstance(self.shell, LocalShell)
+        out, err = [], []
+        task = self.shell.execute('echo 1; echo 2 >&2; printf 3',
+                                  on_stdout=lambda t, line: out.append(line),
+                                  on_stderr=lambda t, line: err.append(line))
+        self.assertEqual(task.wait(), 0)
+        self.assertEqual(out, [b'1', b'3'])
+        self.assertEqual(err, [b'2'])
+
+    def test_exit_codes(self):
+        tasks = [self.shell.execute('exit %d' % i, expected_exit_code=None)
+                 for i in range(5)]
+        self.assertEqual([t.wait() for t in tasks], list(range(5)))
+        task = self.shell.execute('false')
+        with self.assertRaises(core.ExitCodeError):
+            task.wait()
+
+    def test_commands_are_isolated(self):
+        out = []
+        self.shell.execute('cd /; FOO=1').wait()
+        self.shell.execute('if').wait(raise_if_error=False)
+        self.shell.execute('pwd; echo "[$FOO]"',
+                           on_stdout=lambda t, line: out.append(line)).wait()
+        self.assertNotEqual(out[0], b'/')
+        self.assertEqual(out[1], b'[]')
+
+    def test_combine_stderr(self):
+        out = []
+        self.shell.execute('echo 1 >&2', combine_stderr=True,
+                           on_stdout=lambda t, line: out.append(line)).wait()
+        self.assertEqual(out, [b'1'])
+
+    def test_shell_terminated(self):
+        self.shell._proc.kill()
+        task = self.shell.execute('echo 1')
+        with self.assertRaises(core.TaskError):
+            task.wait()
+
+    def test_closed_with_session(self):
+        self.session.close()
+        with self.assertRaises(ValueError):
+            self.shell.execute('echo 1')
+
+
+class TestExecuteBatch(unittest.TestCase):
+    def setUp(self):
+        self.session = LocalSession()
+
+    def _test_batch(self, concurrent):
+        out = []
+        tasks = self.session.execute_batch(
+            ['echo 1', 'echo 2; exit 3', ('false', {'expected_exit_code': 1}),
+             'sleep 0.1; echo 4 >&2'],
+            concurrent=concurrent,
+            on_stdout=lambda t, line: out.append((t, line)))
+        errors = self.session.wait_for_tasks(raise_if_error=False)
+        self.assertEqual([t.exit_code() for t in tasks], [0, 3, 1, 0])
+        # each task calls its callbacks in its own thread
+        self.assertEqual(sorted((tasks.index(t), line) for t, line in out),
+                         [(0, b'1'), (1, b'2'), (3, b'4')])
+        # only the second command has an error
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], core.ExitCodeError)
+        self.assertIs(errors[0].task, tasks[1])
+
+    def test_execute_batch(self):
+        self._test_batch(False)
+
+    def test_execute_batch_concurrent(self):
+        self._test_batch(True)
+
+    def test_timeout_starts_with_the_command(self):
+        tasks = self.session.execute_batch(['sleep 0.3', 'sleep 0.3'],
+                                           timeout=0.5)
+        self.session.wait_for_tasks()
+        self.assertFalse(any(t.timed_out() for t in tasks))
+        tasks = self.session.execute_batch(['sleep 1', 'true'], timeout=0.3)
+        self.assertIsNone(tasks[0].wait(raise_if_error=False))
+        self.assertTrue(tasks[0].timed_out())
+        self.assertEqual(tasks[1].wait(), 0)
+
+    def test_separate_stderr(self):
+        err = []
+        tasks = self.session.execute_batch(
+            ['echo 1 >&2', 'echo 2 >&2'], concurrent=True,
+            on_stderr=lambda t, line: err.append((t, line)))
+        self.session.wait_for_tasks()
+        self.assertEqual(sorted((tasks.index(t), line) for t, line in err),
+                         [(0, b'1'), (1, b'2')])
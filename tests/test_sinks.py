@@ -0,0 +1,130 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from rcontrol.core import SessionManager
+from rcontrol.local import LocalSession
+from rcontrol.sinks import FileSink
+
+
+class TestFileSink(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def read(self, *path):
+        with open(os.path.join(self.tmpdir, *path), 'rb') as f:
+            return f.read().splitlines()
+
+    def test_per_host(self):
+        with FileSink(self.tmpdir, timestamps=False) as sink:
+            sink.write('a', 'stdout', b'1')
+            sink.write('b', 'stdout', u'2')
+            sink.write('a', 'stderr', b'3')
+        self.assertEqual(self.read('a.log'), [b'1', b'[stderr] 3'])
+        self.assertEqual(self.read('b.log'), [b'2'])
+
+    def test_host_name_with_separators(self):
+        with FileSink(self.tmpdir, timestamps=False) as sink:
+            sink.write('/etc/x', 'stdout', b'1')
+            sink.write('../y', 'stdout', b'2')
+        self.assertEqual(self.read('_etc_x.log'), [b'1'])
+        self.assertEqual(self.read('.._y.log'), [b'2'])
+
+    def test_combined_timestamps(self):
+        path = os.path.join(self.tmpdir, 'all.log')
+        with FileSink(path, combined=True) as sink:
+            sink.host('a').write('stdout', b'1')
+            sink.host('b').write('stdout', b'2')
+            sink.flush()
+            lines = self.read('all.log')
+        self.assertEqual(len(lines), 2)
+        self.assertRegexpMatches(
+            lines[0].decode('ascii'),
+            r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3} a 1$')
+        self.assertTrue(lines[1].endswith(b' b 2'))
+
+    def test_gzip(self):
+        with FileSink(self.tmpdir, timestamps=False, compress='gzip') as sink:
+            sink.write('a', 'stdout', b'hello')
+        with gzip.open(os.path.join(self.tmpdir, 'a.log.gz')) as f:
+            self.assertEqual(f.read(), b'hello\n')
+
+    def test_rotation(self):
+        with FileSink(self.tmpdir, timestamps=False, max_size=4,
+                      backup_count=2) as sink:
+            for i in range(5):
+                sink.write('a', 'stdout', str(i))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['a.log', 'a.log.1', 'a.log.2'])
+        self.assertEqual(self.read('a.log.2'), [b'0', b'1'])
+        self.assertEqual(self.read('a.log.1'), [b'2', b'3'])
+        self.assertEqual(self.read('a.log'), [b'4'])
+
+    def test_max_pending(self):
+        sink = FileSink(self.tmpdir, max_pending=0)
+        sink.write('a', 'stdout', b'1')
+        sink.close()
+        self.assertEqual(sink.dropped, 1)
+
+    def test_write_error(self):
+        sink = FileSink(self.tmpdir)
+        # this file can not be opened
+        os.mkdir(os.path.join(self.tmpdir, 'b.log'))
+        sink.write('b', 'stdout', b'1')
+        self.assertRaises(IOError, sink.flush)
+        sink.write('a', 'stdout', b'2')
+        self.assertRaises(IOError, sink.flush)
+        self.assertRaises(IOError, sink.close)
+        self.assertEqual(sink.dropped, 1)
+        self.assertEqual(os.listdir(self.tmpdir), ['b.log'])
+
+
+class TestSessionManagerOutputSink(unittest.TestCase):
+    def test_set_output_sink(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with FileSink(tmpdir, timestamps=False) as sink:
+            with SessionManager() as sessions:
+                sessions.a = LocalSession()
+                sessions.b = LocalSession()
+                sessions.set_output_sink(sink)
+                sessions.a.execute('echo 1; echo 2 >&2', combine_stderr=False)
+                sessions.b.execute('echo 3')
+                sessions.b.execute('echo 4', output_sink=False)
+        with open(os.path.join(tmpdir, 'a.log'), 'rb') as f:
+            self.assertEqual(sorted(f.read().splitlines()),
+                             [b'1', b'[stderr] 2'])
+        with open(os.path.join(tmpdir, 'b.log'), 'rb') as f:
+            self.assertEqual(f.read(), b'3\n')
+
+    def test_session_output_sink(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with FileSink(tmpdir, timestamps=False) as sink:
+            session = LocalSession()
+            session.output_sink = sink
+            session.execute('echo 1').wait()
+            with SessionManager() as sessions:
+                sessions.a = LocalSession()
+                sessions.a.output_sink = sink
+                sessions.a.execute('echo 2')
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         ['a.log', 'localhost.log'])
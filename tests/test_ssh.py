@@ -0,0 +1,311 @@
+# This file is part of rcontrol.
+#
+# rcontrol is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# rcontrol is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+from mock import Mock, patch
+
+import paramiko
+
+from rcontrol import fs
+from rcontrol.local import LocalSession
+from rcontrol.ssh import SshSession
+
+
+def attributes(filename, mode):
+    attr = paramiko.SFTPAttributes()
+    attr.filename = filename
+    attr.st_mode = mode
+    return attr
+
+
+def not_found(path):
+    raise IOError(2, 'No such file', path)
+
+
+class TestLazySshSession(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('rcontrol.ssh.ssh_client')
+        self.ssh_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connect_on_demand(self):
+        session = SshSession(host='bilbo', username='user', port=2222)
+        self.assertEqual(str(session), '<SshSession user@bilbo>')
+        self.assertFalse(session.is_connected())
+        self.assertFalse(self.ssh_client.called)
+        client = session.ssh_client
+        self.ssh_client.assert_called_once_with('bilbo', username='user',
+                                                port=2222)
+        self.assertIs(session.ssh_client, client)
+        self.assertTrue(session.is_connected())
+        self.assertFalse(client.open_sftp.called)
+        session.exists('/a')
+        client.open_sftp.return_value.stat.assert_called_once_with('/a')
+
+    def test_host_name(self):
+        session = SshSession(host='bilbo', username='user')
+        self.assertEqual(session.host_name(), 'bilbo')
+        session.name = 'web'
+        self.assertEqual(session.host_name(), 'web')
+
+    def test_close_never_connected(self):
+        session = SshSession(host='bilbo')
+        session.close()
+        self.assertFalse(self.ssh_client.called)
+
+    def test_close(self):
+        session = SshSession(host='bilbo')
+        sftp = session.sftp
+        session.close()
+        sftp.close.assert_called_once_with()
+        self.ssh_client.return_value.close.assert_called_once_with()
+        self.assertFalse(session.is_connected())
+
+    def test_client_or_host_required(self):
+        with self.assertRaises(ValueError):
+            SshSession()
+
+    def test_release_idle_sftp(self):
+        session = SshSession(host='bilbo', sftp_idle_timeout=0.05)
+        self.addCleanup(session.close)
+        client = self.ssh_client.return_value
+        client.open_sftp.side_effect = lambda: Mock(name='sftp')
+        fileobj = session.open('/a')
+        fileobj._closed = False
+        sftp = session.sftp
+        time.sleep(0.2)
+        # a file is still open
+        self.assertIs(session.sftp, sftp)
+        fileobj._closed = True
+        time.sleep(0.2)
+        sftp.close.assert_called_once_with()
+        self.assertIsNot(session.sftp, sftp)
+        self.assertEqual(client.open_sftp.call_count, 2)
+
+    def test_sftp_not_released_during_an_operation(self):
+        session = SshSession(host='bilbo', sftp_idle_timeout=0.05)
+        self.addCleanup(session.close)
+        sftp = session.sftp
+
+        def listdir_attr(top):
+            time.sleep(0.2)
+            self.assertFalse(sftp.close.called)
+            return []
+        sftp.listdir_attr.side_effect = listdir_attr
+        self.assertEqual(list(session.walk('/top')), [('/top', [], [])])
+        self.assertFalse(sftp.close.called)
+        time.sleep(0.2)
+        sftp.close.assert_called_once_with()
+
+
+class TestSshSessionDirectCopy(unittest.TestCase):
+    def setUp(self):
+        client = Mock(hostname='frodo', username='user')
+        self.channel = client.get_transport.return_value.open_session \
+            .return_value
+        self.channel.makefile.side_effect = lambda mode: io.StringIO()
+        self.channel.recv_exit_status.return_value = 0
+        self.session = SshSession(client)
+        dest_client = Mock(hostname='sam', username='root')
+        dest_client.get_transport.return_value.getpeername.return_value = \
+            ('10.0.0.2', 2222)
+        self.dest = SshSession(dest_client)
+
+    @patch('rcontrol.ssh.paramiko.agent.AgentRequestHandler')
+    def test_agent_command(self, handler):
+        self.assertTrue(self.session.direct_copy_file('/a b', self.dest,
+                                                      '/c'))
+        handler.assert_called_once_with(self.channel)
+        self.channel.exec_command.assert_called_once_with(
+            "ssh -o BatchMode=yes -o ConnectTimeout=10"
+            " -o StrictHostKeyChecking=accept-new -p 2222 root@sam"
+            " 'cat > /c' < '/a b'")
+
+    @patch('rcontrol.ssh.paramiko.agent.AgentRequestHandler')
+    def test_failed_transfer(self, handler):
+        self.channel.recv_exit_status.return_value = 255
+        self.assertFalse(self.session.direct_copy_file('/a', self.dest,
+                                                       '/c'))
+
+    @patch('rcontrol.core.fs.copy_file')
+    def test_key_install_failure_falls_back(self, copy_file):
+        self.session._install_temporary_key = Mock(
+            side_effect=IOError('no space left'))
+        self.session.s_copy_file('/a', self.dest, '/c', direct='key')
+        self.assertFalse(self.channel.exec_command.called)
+        copy_file.assert_called_once_with(
+            self.session, '/a', self.dest, '/c', chunk_size=16384,
+            verify=None, expected_digest=None, rate_limit=None)
+
+
+class TestSshSessionStatCache(unittest.TestCase):
+    def create_session(self, **kwargs):
+        session = SshSession(Mock(), **kwargs)
+        self.sftp = session.sftp
+        return session
+
+    def test_exists(self):
+        session = self.create_session()
+        self.sftp.stat.side_effect = not_found
+        self.assertFalse(session.exists('/a'))
+        self.assertFalse(session.exists('/a'))
+        # no cache by default
+        self.assertEqual(self.sftp.stat.call_count, 2)
+
+    def test_cache(self):
+        session = self.create_session(stat_cache_ttl=60)
+        self.sftp.stat.return_value = attributes('a', stat.S_IFDIR)
+        self.assertTrue(session.isdir('/a'))
+        self.assertTrue(session.exists('/a'))
+        self.assertEqual(self.sftp.stat.call_count, 1)
+
+    def test_cache_invalidation(self):
+        session = self.create_session(stat_cache_ttl=60)
+        self.sftp.stat.side_effect = not_found
+        self.assertFalse(session.exists('/a/b'))
+        session.mkdir('/a')
+        self.sftp.stat.side_effect = None
+        self.sftp.stat.return_value = attributes('b', stat.S_IFREG)
+        self.assertTrue(session.exists('/a/b'))
+        session.open('/a/b', 'w')
+        self.assertTrue(session.exists('/a/b'))
+        self.assertEqual(self.sftp.stat.call_count, 3)
+
+    def test_makedirs_invalidates_parents(self):
+        session = self.create_session(stat_cache_ttl=60)
+        self.sftp.stat.side_effect = not_found
+        for path in ('/a', '/a/b', '/c'):
+            self.assertFalse(session.exists(path))
+        with patch('rcontrol.ssh._command_output') as command_output:
+            session.makedirs('/a/b/c/')
+        command_output.assert_called_once_with(session,
+                                               'mkdir -p -- /a/b/c/')
+        self.assertEqual(sorted(session._stat_cache), ['/c'])
+
+    def test_open_for_write_keeps_other_paths(self):
+        session = self.create_session(stat_cache_ttl=60)
+        self.sftp.stat.return_value = attributes('b', stat.S_IFREG)
+        self.assertTrue(session.exists('/a'))
+        self.assertTrue(session.exists('/a/b'))
+        session.open('/a', 'w')
+        self.assertTrue(session.exists('/a/b'))
+        self.assertTrue(session.exists('/a'))
+        self.assertEqual(self.sftp.stat.call_count, 3)
+
+    def test_walk_fills_cache(self):
+        session = self.create_session(stat_cache_ttl=60)
+        self.sftp.listdir_attr.side_effect = lambda top: {
+            '/top': [attributes('d', stat.S_IFDIR),
+                     attributes('f', stat.S_IFREG),
+                     attributes('l', stat.S_IFLNK)],
+            '/top/d': [],
+        }[top]
+        self.sftp.stat.return_value = attributes('l', stat.S_IFDIR)
+        self.assertEqual(list(session.walk('/top')), [
+            ('/top', ['d', 'l'], ['f']),
+            ('/top/d', [], []),
+        ])
+        # only the link needs a stat
+        self.sftp.stat.assert_called_once_with('/top/l')
+        self.assertTrue(session.isdir('/top/d'))
+        self.assertTrue(session.islink('/top/l'))
+        self.assertFalse(self.sftp.lstat.called)
+
+    def test_stat_many(self):
+        session = self.create_session(stat_cache_ttl=60)
+
+        def execute(command, on_stdout, **kwargs):
+            # the trailing spaces of the lines are removed
+            on_stdout(None, u'81a4 12 100 90 0 0 /a b /')
+            return Mock(wait=Mock(return_value=123))
+        session.execute = Mock(side_effect=execute)
+        result = session.stat_many(['/a b ', '/c'])
+        self.assertEqual(session.execute.call_count, 1)
+        self.assertEqual(session.execute.call_args[1]['stdin'],
+                         b'/a b \0/c')
+        self.assertEqual(result['/a b '].st_size, 12)
+        self.assertTrue(stat.S_ISREG(result['/a b '].st_mode))
+        self.assertIsNone(result['/c'])
+        # now in cache
+        self.assertFalse(session.exists('/c'))
+        self.assertFalse(self.sftp.stat.called)
+
+    def test_stat_many_fallback(self):
+        session = self.create_session()
+        session.execute = Mock(return_value=Mock(wait=Mock(return_value=127)))
+        self.sftp.stat.return_value = attributes('a', stat.S_IFREG)
+        result = session.stat_many(['/a'])
+        self.assertIs(result['/a'], self.sftp.stat.return_value)
+
+
+class TestSshSessionFind(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for path in ('a/.git', 'b'):
+            os.makedirs(os.path.join(self.tmpdir, path))
+        for name in ('a/x.log', 'a/.git/y.log', 'b/z.txt'):
+            open(os.path.join(self.tmpdir, name), 'w').close()
+        self.session = SshSession(Mock())
+        # run the commands locally
+        self.local = LocalSession()
+        self.session.execute = Mock(side_effect=self.local.execute)
+
+    def test_server_find(self):
+        entries = fs.find(self.session, self.tmpdir, include=['*.log'],
+                          exclude=['.git'])
+        self.assertEqual([e[:3] for e in entries],
+                         [(os.path.join(self.tmpdir, 'a/x.log'), 'f', 0)])
+        self.assertEqual(self.session.execute.call_count, 1)
+        self.assertFalse(self.session.sftp.listdir_attr.called)
+
+    def test_abandoned_iteration(self):
+        # more results than what can be queued
+        for i in range(3000):
+            open(os.path.join(self.tmpdir, 'b', str(i)), 'w').close()
+        entries = fs.find(self.session, self.tmpdir)
+        next(entries)
+        entries.close()
+        self.local.wait_for_tasks()
+
+    def test_fallback_to_walk(self):
+        self.session.execute = Mock(
+            side_effect=lambda cmd, **kw: self.local.execute('exit 127',
+                                                             **kw))
+        self.session.sftp.listdir_attr.return_value = []
+        self.assertEqual(list(fs.find(self.session, '/top')), [])
+        self.session.sftp.listdir_attr.assert_called_once_with('/top')
+
+
+class TestSshSessionFsOps(unittest.TestCase):
+    def test_apply_fs_ops(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        session = SshSession(Mock())
+        # run the script locally
+        session.execute = LocalSession().execute
+        session.apply_fs_ops([('mkdir', os.path.join(tmpdir, 'a')),
+                              ('mkdir', os.path.join(tmpdir, 'a/b'))])
+        self.assertTrue(os.path.isdir(os.path.join(tmpdir, 'a/b')))
+        with self.assertRaises(IOError) as cm:
+            session.apply_fs_ops([('mkdir', os.path.join(tmpdir, 'a')),
+                                  ('mkdir', os.path.join(tmpdir, 'c'))])
+        self.assertIn('File exists', str(cm.exception))
@@ -14,9 +14,13 @@
 # along with rcontrol. If not, see <http://www.gnu.org/licenses/>.
 
 from rcontrol.local import ProcessReader
+from rcontrol.streamreader import FlowControlQueue
 from mock import Mock
+from six.moves.queue import Empty
 import subprocess
 import sys
+import threading
+import time
 import unittest
 
 
@@ -93,3 +97,125 @@ print(3)
         proc.kill()
         self.assertEquals(data, [b'2'])  # 2 has been printed, not 3
         cb.assert_called_once_with()  # timeout callback
+
+    def test_raw_stdout(self):
+        data = []
+        self._basic_print(stdout_callback=data.append, raw_stdout=True)
+        self.assertEqual(b''.join(data), b'stdout!\n')
+
+
+class TestFlowControlQueue(unittest.TestCase):
+    def test_unbounded(self):
+        queue = FlowControlQueue()
+        for i in range(100):
+            queue.put((b'line', None))
+        self.assertEqual(queue.stats['peak_lines'], 100)
+        self.assertEqual(queue.get(), (b'line', None))
+        self.assertFalse(queue.empty())
+
+    def test_get_timeout(self):
+        with self.assertRaises(Empty):
+            FlowControlQueue().get(True, 0.01)
+
+    def test_drop(self):
+        queue = FlowControlQueue(max_lines=2, overflow='drop')
+        for i in range(5):
+            queue.put((b'%d' % i, None))
+        self.assertEqual([queue.get(False)[0] for i in range(2)],
+                         [b'0', b'1'])
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.stats['dropped'], 3)
+
+    def test_sample(self):
+        queue = FlowControlQueue(max_bytes=1, overflow='sample',
+                                 sample_rate=3)
+        for i in range(7):
+            queue.put((b'%d' % i, None))
+        # the first line fills the queue, then one line out of 3 is kept
+        # in place of the queued line
+        self.assertEqual(queue.stats['dropped'], 6)
+        self.assertEqual(queue.stats['peak_lines'], 1)
+        self.assertEqual(queue.get()[0], b'6')
+        self.assertTrue(queue.empty())
+
+    def test_sample_bounded(self):
+        queue = FlowControlQueue(max_lines=5, overflow='sample',
+                                 sample_rate=2)
+        for i in range(100):
+            queue.put((b'%d' % i, None))
+        self.assertEqual(queue.stats['peak_lines'], 5)
+        self.assertEqual(queue.stats['dropped'], 95)
+        lines = [queue.get()[0] for i in range(5)]
+        self.assertEqual(lines, [b'90', b'92', b'94', b'96', b'98'])
+
+    def test_block(self):
+        queue = FlowControlQueue(max_bytes=10)
+        queue.put((b'x' * 10, None))
+        thread = threading.Thread(target=queue.put, args=((b'y', None),))
+        thread.start()
+        time.sleep(0.05)
+        # the second put waits for room in the queue
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(queue.get()[0], b'x' * 10)
+        thread.join()
+        self.assertEqual(queue.get()[0], b'y')
+        self.assertEqual(queue.stats['throttled'], 1)
+        self.assertGreater(queue.stats['throttle_time'], 0.04)
+
+    def test_close_releases_blocked_put(self):
+        queue = FlowControlQueue(max_lines=1)
+        queue.put((b'x', None))
+        thread = threading.Thread(target=queue.put, args=((b'y', None),))
+        thread.start()
+        queue.close()
+        thread.join()
+        self.assertTrue(queue.empty())
+
+
+class TestReaderRelease(unittest.TestCase):
+    def test_released_once_done(self):
+        callback = Mock()
+        reader = ProcessReader(stdout_callback=callback,
+                               finished_callback=Mock())
+        # nothing is allocated for the reading before it starts
+        self.assertIsNone(reader.queue)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(reader.flow_stats()['peak_lines'], 0)
+        proc = subprocess.Popen([sys.executable, '-c', 'print(1)'],
+                                stdout=subprocess.PIPE)
+        reader.start(proc)
+        reader.thread.join()
+        reader.join_callbacks()
+        proc.wait()
+        callback.assert_called_once_with(b'1')
+        self.assertFalse(reader.is_alive())
+        # the callbacks, the queue and the thread are not kept
+        self.assertIsNot(reader.stdout_callback, callback)
+        self.assertIsNone(reader.queue)
+        self.assertNotIsInstance(reader.thread, threading.Thread)
+        reader.thread.join()
+        self.assertEqual(reader.flow_stats()['peak_lines'], 1)
+        self.assertFalse(hasattr(reader, '__dict__'))
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, ProcessReader, queue_overflow='x')
+
+
+class TestFlowControl(unittest.TestCase):
+    def test_slow_callback_throttles_producer(self):
+        data = []
+
+        def callback(line):
+            time.sleep(0.001)
+            data.append(line)
+        reader = ProcessReader(stdout_callback=callback, max_queue_lines=10)
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 'for i in range(500): print(i)'],
+                                stdout=subprocess.PIPE)
+        reader.start(proc)
+        reader.thread.join()
+        proc.wait()
+        self.assertEqual(len(data), 500)
+        stats = reader.flow_stats()
+        self.assertLessEqual(stats['peak_lines'], 10)
+        self.assertGreater(stats['throttled'], 0)